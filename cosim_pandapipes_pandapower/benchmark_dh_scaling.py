@@ -0,0 +1,85 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+'''
+Scaling benchmark of the district heating network model: per-step wall time of the static and dynamic temperature
+flow calculation for generated radial and ring networks with N consumer substations.
+'''
+
+import numpy as np
+import pandas as pd
+from time import perf_counter
+
+from simulators.dh_network.network_generator import generate_network
+
+# Benchmark defaults.
+SIZES = [2, 5, 10, 20, 50, 100, 200, 500]
+LAYOUTS = ['radial', 'ring']
+MODES = ['static', 'dynamic']
+STEP_SIZE = 60
+N_STEPS = 20
+DEMAND_VARIATION = 0.1  # Relative random variation of the heat demand and mass flow setpoints per step
+
+
+def runBenchmark(n_consumers, layout, mode, n_steps, step_size, seed=0, model_params=None):
+    '''
+    Builds a generated network and runs n_steps steps with randomly varying demand.
+    Returns the construction time and the wall time of each step.
+    '''
+    rng = np.random.default_rng(seed)
+
+    t_start = perf_counter()
+    model = generate_network(n_consumers, layout=layout, seed=seed,
+                             dynamic_temp_flow_enabled=(mode == 'dynamic'), **(model_params or {}))
+    build_time = perf_counter() - t_start
+
+    Qdot_design = model.Qdot_cons.copy()
+    mdot_design = model.mdot_cons_set.copy()
+
+    step_times = []
+    for step in range(n_steps):
+        variation = 1 + DEMAND_VARIATION * rng.uniform(-1, 1, size=n_consumers)
+        model.Qdot_cons[:] = Qdot_design * variation
+        model.mdot_cons_set[:] = mdot_design * variation
+
+        t_start = perf_counter()
+        model.step_single(step * step_size)
+        step_times.append(perf_counter() - t_start)
+
+    return build_time, np.array(step_times)
+
+
+if __name__ == '__main__':
+    import argparse
+    import warnings
+
+    # Parse command line options.
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--outfile', default = 'dh_scaling_results.csv', help = 'results file name')
+    parser.add_argument('--sizes', type = int, nargs = '+', default = SIZES, help = 'numbers of consumers')
+    parser.add_argument('--layouts', nargs = '+', default = LAYOUTS, choices = LAYOUTS, help = 'network layouts')
+    parser.add_argument('--modes', nargs = '+', default = MODES, choices = MODES, help = 'temperature flow modes')
+    parser.add_argument('--steps', type = int, default = N_STEPS, help = 'number of simulated steps per run')
+    parser.add_argument('--step-size', type = int, default = STEP_SIZE, help = 'step size in seconds')
+    parser.add_argument('--seed', type = int, default = 0, help = 'seed of the network generator')
+    args = parser.parse_args()
+
+    warnings.filterwarnings('ignore', category = UserWarning)
+
+    results = []
+    for layout in args.layouts:
+        for mode in args.modes:
+            for n in args.sizes:
+                build_time, step_times = runBenchmark(n, layout, mode, args.steps, args.step_size, seed = args.seed)
+
+                # The first step includes the initial hydraulic solve from the junction initial values.
+                steady = step_times[1:] if len(step_times) > 1 else step_times
+                results.append({
+                    'layout': layout, 'mode': mode, 'n_consumers': n, 'build_time_s': build_time,
+                    'first_step_s': step_times[0], 'mean_step_s': steady.mean(),
+                    'median_step_s': np.median(steady), 'max_step_s': steady.max(),
+                })
+                print('%s %s N=%i: build %.3f s, step mean %.4f s, median %.4f s, max %.4f s' % (
+                    layout, mode, n, build_time, steady.mean(), np.median(steady), steady.max()))
+
+    pd.DataFrame(results).to_csv(args.outfile, index = False)
+    print('Saved to: {0}'.format(args.outfile))
@@ -1,5 +1,5 @@
 # District Heating Network
-from .dh_network import DHNetworkSimulator
+from .dh_network import DHNetworkSimulator, DHTopologySimulator
 
 # Electrical Network
 from .el_network import ElectricNetworkSimulator
@@ -1 +1,2 @@
-from .mosaik_wrapper import DHNetworkSimulator
\ No newline at end of file
+from .mosaik_wrapper import DHNetworkSimulator
+from .topology_wrapper import DHTopologySimulator
@@ -0,0 +1,115 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import multiprocessing
+import traceback
+
+
+def _worker_main(conn, factory, output_fn):
+    '''
+    Worker loop: owns the entities created by it, executes the commands received from the pool.
+    '''
+    entities = {}
+    while True:
+        cmd, args = conn.recv()
+        try:
+            if cmd == 'create':
+                for eid, params in args.items():
+                    entities[eid] = factory(**params)
+                result = None
+            elif cmd == 'step':
+                time, inputs = args
+                result = {}
+                for eid, esim in entities.items():
+                    for attr, value in inputs.get(eid, {}).items():
+                        setattr(esim, attr, value)
+                    esim.step_single(time)
+                    result[eid] = output_fn(esim)
+            elif cmd == 'collect':
+                for esim in entities.values():
+                    esim.close()
+                result = entities
+            elif cmd == 'close':
+                conn.send(('ok', None))
+                break
+            else:
+                raise ValueError(f'Unknown command: {cmd}')
+        except Exception:
+            conn.send(('error', traceback.format_exc()))
+            continue
+        conn.send(('ok', result))
+    conn.close()
+
+
+class EntityPool:
+    '''
+    Process pool for independent simulation entities. Each worker process owns a fixed subset of the entities
+    (assigned round-robin); only entity inputs and outputs cross the process boundaries.
+
+    factory(**params) creates an entity in the worker, output_fn(entity) returns the dict of its outputs after a
+    step. Entities must provide step_single(time) and close().
+    '''
+
+    def __init__(self, n_workers, factory, output_fn):
+        ctx = multiprocessing.get_context()
+        self.owner = {}  # eid -> worker index
+        self.conns = []
+        self.processes = []
+        for _ in range(n_workers):
+            conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_worker_main, args=(child_conn, factory, output_fn), daemon=True)
+            process.start()
+            child_conn.close()
+            self.conns.append(conn)
+            self.processes.append(process)
+
+    def create(self, entity_params):
+        '''
+        Creates the entities {eid: params} (in parallel) and returns once all are built.
+        '''
+        batches = [{} for _ in self.conns]
+        for eid, params in entity_params.items():
+            worker = len(self.owner) % len(self.conns)
+            self.owner[eid] = worker
+            batches[worker][eid] = params
+        self._run('create', batches)
+
+    def step(self, time, inputs):
+        '''
+        Sets the inputs {eid: {attr: value}}, steps all entities and returns their outputs {eid: outputs}.
+        '''
+        batches = [{} for _ in self.conns]
+        for eid, data in inputs.items():
+            batches[self.owner[eid]][eid] = data
+        outputs = {}
+        for result in self._run('step', [(time, batch) for batch in batches]):
+            outputs.update(result)
+        return outputs
+
+    def collect(self):
+        '''
+        Closes the entities and returns them {eid: entity} (e.g. for final statistics).
+        '''
+        entities = {}
+        for result in self._run('collect', [None] * len(self.conns)):
+            entities.update(result)
+        return entities
+
+    def close(self):
+        for conn, process in zip(self.conns, self.processes):
+            if process.is_alive():
+                conn.send(('close', None))
+                conn.recv()
+            process.join()
+            conn.close()
+        self.conns, self.processes = [], []
+
+    def _run(self, cmd, args):
+        # Send to all workers first, then wait for all results
+        for conn, arg in zip(self.conns, args):
+            conn.send((cmd, arg))
+        results = [conn.recv() for conn in self.conns]
+        errors = [result for status, result in results if status == 'error']
+        if errors:
+            raise RuntimeError('Entity worker failed:\n' + errors[0])
+        return [result for _, result in results]
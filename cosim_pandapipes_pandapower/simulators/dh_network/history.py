@@ -0,0 +1,140 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import numpy as np
+import pandas as pd
+
+
+def get_result_row(net):
+    '''
+    Returns the stored results of a solved network as one history row: junction temperatures [degC], then
+    (temperature [degC], mass flow [kg/s], delay [s]) per pipe, rounded to 2 decimals.
+    '''
+    n_junctions = len(net.junction)
+    n_pipes = len(net.pipe)
+
+    # Get temperature and mass flow results
+    temp_j = net.res_junction['t_k'].values - 273.15
+    temp_p = net.res_pipe['t_to_k'].values - 273.15
+    mdot_p = net.res_pipe['mdot_from_kg_per_s'].values
+
+    # Determine thermal inertia
+    dx = net.pipe['length_km'].values * 1000
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dt_p = dx / net.res_pipe['v_mean_m_per_s'].values
+
+    values = np.empty(n_junctions + 3 * n_pipes)
+    values[:n_junctions] = temp_j
+    pipe_values = values[n_junctions:].reshape(n_pipes, 3)
+    pipe_values[:, 0] = temp_p
+    pipe_values[:, 1] = mdot_p
+    pipe_values[:, 2] = dt_p
+
+    return np.round(values, 2)
+
+
+class HistoryBuffer:
+    '''
+    Preallocated, array-backed history of network results.
+
+    Stores one time vector plus one column per recorded quantity. Rows are appended in amortized O(1),
+    columns are kept contiguous in memory so that they can be passed to np.interp directly.
+    Old rows can be dropped with evict_before(), their memory is reused by later appends.
+    '''
+
+    def __init__(self, columns, capacity=1024):
+        self.columns = list(columns)
+        self.col_idx = {name: i for i, name in enumerate(self.columns)}
+
+        self._t = np.empty(capacity)
+        self._data = np.empty((len(self.columns), capacity))  # column-major: one contiguous row per column
+        self._start = 0  # Index of the oldest stored row
+        self._end = 0  # Index after the newest stored row
+
+    def __len__(self):
+        return self._end - self._start
+
+    @property
+    def capacity(self):
+        return self._t.shape[0]
+
+    @property
+    def time(self):
+        return self._t[self._start:self._end]
+
+    def column(self, name):
+        return self._data[self.col_idx[name], self._start:self._end]
+
+    def append(self, t, values):
+        '''
+        Append one row of values (ordered as self.columns) at time t.
+        A row with the same time stamp as the newest row replaces it (same-time loops).
+        '''
+        if self._end > self._start and self._t[self._end - 1] == t:
+            self._data[:, self._end - 1] = values
+            return
+
+        if self._end == self.capacity:
+            if len(self) <= self.capacity // 2:
+                self._compact()
+            else:
+                self._grow()
+
+        self._t[self._end] = t
+        self._data[:, self._end] = values
+        self._end += 1
+
+    def evict_before(self, t):
+        '''
+        Drop all rows older than t, except the newest row at or before t (needed to interpolate at t).
+        '''
+        idx = np.searchsorted(self.time, t, side='right') - 1
+        if idx > 0:
+            self._start += idx
+
+    def interp(self, t, name):
+        '''
+        Linear interpolation of a column at time t (values are held constant outside the stored range).
+        '''
+        return np.interp(t, self.time, self.column(name))
+
+    def interp_columns(self, t, cols):
+        '''
+        Vectorized linear interpolation: returns column cols[k] at time t[k] for all k (same semantics as interp).
+        '''
+        time = self.time
+        data = self._data[:, self._start:self._end]
+        if len(time) == 1:
+            return data[cols, 0]
+
+        t = np.clip(t, time[0], time[-1])
+        i = np.clip(np.searchsorted(time, t, side='right'), 1, len(time) - 1)
+        w = (t - time[i - 1]) / (time[i] - time[i - 1])
+        return data[cols, i - 1] * (1 - w) + data[cols, i] * w
+
+    def to_frame(self):
+        return pd.DataFrame(data=self._data[:, self._start:self._end].T.copy(), index=self.time.copy(),
+                            columns=self.columns)
+
+    def to_dict(self):
+        '''
+        Dict view of the history ({column: {time: value}}), as produced by pd.DataFrame.to_dict().
+        '''
+        return self.to_frame().to_dict()
+
+    def _compact(self):
+        # Move the stored rows to the front of the preallocated arrays
+        n = len(self)
+        self._t[:n] = self._t[self._start:self._end]
+        self._data[:, :n] = self._data[:, self._start:self._end]
+        self._start, self._end = 0, n
+
+    def _grow(self):
+        n = len(self)
+        capacity = max(2 * n, 16)
+        t = np.empty(capacity)
+        data = np.empty((len(self.columns), capacity))
+        t[:n] = self.time
+        data[:, :n] = self._data[:, self._start:self._end]
+        self._t, self._data = t, data
+        self._start, self._end = 0, n
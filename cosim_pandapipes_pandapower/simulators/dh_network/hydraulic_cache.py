@@ -0,0 +1,48 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+from collections import OrderedDict
+import numpy as np
+
+
+class HydraulicCache:
+    '''
+    LRU cache mapping quantized mass flow setpoints to a converged hydraulic state.
+
+    Setpoints are quantized with the absolute tolerance tol, i.e., setpoint vectors that round to the same
+    multiples of tol share one entry. The least recently used entry is dropped once maxsize is exceeded.
+    '''
+
+    def __init__(self, maxsize=128, tol=0.01):
+        self.maxsize = maxsize
+        self.tol = tol
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def make_key(self, setpoints):
+        return tuple(np.round(np.asarray(setpoints, dtype=float) / self.tol).astype(int))
+
+    def get(self, key):
+        state = self._entries.get(key)
+        if state is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return state
+
+    def put(self, key, state):
+        self._entries[key] = state
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self._entries)}
@@ -3,6 +3,8 @@
 
 from itertools import count
 from .simulator import DHNetwork
+from .profiling import PHASES
+from .entity_pool import EntityPool
 from mosaik_api import Simulator
 from typing import Dict
 
@@ -17,6 +19,18 @@ META = {
                 'T_supply_grid',
                 'P_grid_bar',
                 'dynamic_temp_flow_enabled',
+                'warm_start_pipeflow',  # Start each pipeflow from the previous pressures
+                'valve_control_mode',  # 'pid' (default), 'secant' (adaptive gain) or 'newton' (coupled inverse valve sizing)
+                'valve_controller',  # 'single' (one controller per valve, default) or 'group' (vectorized)
+                'decoupled_solve',  # Solve hydraulics only if mass flow setpoints or valve states changed
+                'hydraulic_tol',  # Setpoint change that triggers a new hydraulic solve
+                'hydraulic_cache_size',  # Number of cached hydraulic solutions (0: disabled)
+                'hydraulic_cache_tol',  # Quantization of mass flow setpoints for the cache
+                'network_cache_dir',  # Directory of pickled network snapshots (faster construction)
+                'log_full_history',  # Keep full result history instead of the plug-flow horizon only
+                'temp_flow_sections',  # Sections per pipe in the dynamic temperature flow (0: lumped, -1: pipe sections)
+                'profile_phases',  # Time the phases of each step (outputs profile_<phase>)
+                'log_convergence',  # Record per-step valve control and pipeflow convergence telemetry
                 ],
             'attrs': [
                 # Input
@@ -42,6 +56,9 @@ META = {
                 'mdot_cons1',  # Mass flow at consumer 1
                 'mdot_cons2',  # Mass flow at consumer 2
                 'initialized',  # is the initialization finished?
+                ] + [
+                # Wall time of the step phases in the last step [s] (0 if profile_phases is disabled)
+                'profile_%s' % phase for phase in PHASES
                 ],
             'trigger': ['T_tank_forward', 'Qdot_evap'],
             # 'trigger': ['mdot_cons1_set', 'mdot_cons2_set', 'T_tank_forward'],
@@ -52,11 +69,24 @@ META = {
     }
 
 
+# Entity attributes returned by the workers in process pool mode
+POOL_ATTRS = [attr for attr in META['models']['DHNetwork']['attrs']
+              if attr != 'initialized' and not attr.startswith('profile_')]
+
+
+def get_entity_outputs(esim):
+    data = {attr: getattr(esim, attr) for attr in POOL_ATTRS}
+    data.update({'profile_%s' % phase: esim.get_last_phase_time(phase) for phase in PHASES})
+    return data
+
+
 class DHNetworkSimulator(Simulator):
 
     step_size = 10
     eid_prefix = ''
     last_time = 0
+    convergence_log_file = None
+    pool = None
 
     def __init__(self, META=META):
         super().__init__(META)
@@ -65,8 +95,10 @@ class DHNetworkSimulator(Simulator):
         self.eid_counters = {}
         self.simulators: Dict[DHNetwork] = {}
         self.entityparams = {}
+        self.entity_outputs = {}  # Outputs of the entities in process pool mode
         self.output_vars = {'T_return_tank', 'T_evap_in', 'T_return_grid', 'T_supply_cons1', 'T_supply_cons2', 'T_return_cons1', 'T_return_cons2',
                             'mdot_tank_in', 'mdot_grid', 'mdot_cons1', 'mdot_cons2', 'initialized'}
+        self.profile_vars = {'profile_%s' % phase: phase for phase in PHASES}
         self.input_vars = {'mdot_grid_set', 'T_tank_forward', 'mdot_tank_in_set', 'mdot_cons1_set', 'mdot_cons2_set', 'Qdot_evap', 'Qdot_cons1', 'Qdot_cons2'}
         self.init_dict = {}
         self.init_attrs = ['T_tank_forward', 'Qdot_evap']
@@ -74,9 +106,14 @@ class DHNetworkSimulator(Simulator):
         self.init_finished = {}
         self.all_init_finished = False
 
-    def init(self, sid, time_resolution, step_size=10, eid_prefix="DHNetwork"):
+    def init(self, sid, time_resolution, step_size=10, eid_prefix="DHNetwork", convergence_log_file=None,
+             workers=0):
         self.step_size = step_size
         self.eid_prefix = eid_prefix
+        self.convergence_log_file = convergence_log_file  # HDF5 store for the convergence logs (frame per entity)
+        if workers > 0:
+            # Process pool mode: entities are distributed over the worker processes and stepped in parallel
+            self.pool = EntityPool(workers, DHNetwork, get_entity_outputs)
 
         return self.meta
 
@@ -84,6 +121,7 @@ class DHNetworkSimulator(Simulator):
     def create(self, num, model, **model_params):
         counter = self.eid_counters.setdefault(model, count())
         entities = []
+        new_params = {}
 
         for _ in range(num):
 
@@ -95,12 +133,16 @@ class DHNetworkSimulator(Simulator):
             self.init_dict[eid] = {}
 
             self.entityparams[eid] = model_params
-            esim = DHNetwork(**model_params)
-
-            self.simulators[eid] = esim
+            if self.pool is None:
+                self.simulators[eid] = DHNetwork(**model_params)
+            else:
+                new_params[eid] = model_params
 
             entities.append({'eid': eid, 'type': model})
 
+        if self.pool is not None:
+            self.pool.create(new_params)
+
         return entities
 
 
@@ -109,7 +151,9 @@ class DHNetworkSimulator(Simulator):
         # if time < 200:
         #     print('dh network step: %s - %s' % (time, inputs))
 
-        for eid, esim in self.simulators.items():
+        pool_inputs = {}
+        for eid in self.entityparams:
+            entity_inputs = {}
             data = inputs.get(eid, {})
             for attr, incoming in data.items():
                 if attr in self.input_vars:
@@ -124,7 +168,7 @@ class DHNetworkSimulator(Simulator):
                             newval = -list(incoming.values())[0]  # Reverse the sign of incoming mass flow values
                         else:
                             newval = list(incoming.values())[0]
-                        setattr(esim, attr, newval)
+                        entity_inputs[attr] = newval
                     else:
                         print(f'input is None for {attr}')
 
@@ -142,7 +186,13 @@ class DHNetworkSimulator(Simulator):
                 else:
                     raise AttributeError(f"DHNetworkSimulator {eid} has no input attribute {attr}.")
 
-            esim.step_single(time)
+            if self.pool is None:
+                esim = self.simulators[eid]
+                for attr, newval in entity_inputs.items():
+                    setattr(esim, attr, newval)
+                esim.step_single(time)
+            else:
+                pool_inputs[eid] = entity_inputs
 
             # Check if initialization is finished
             if time == 0:
@@ -158,6 +208,10 @@ class DHNetworkSimulator(Simulator):
                         print('     dh network: No convergence after 1950 same time loops.')
                         self.init_finished[eid][attr] = True
 
+        if self.pool is not None:
+            # Step all entities in parallel
+            self.entity_outputs = self.pool.step(time, pool_inputs)
+
         if not self.all_init_finished:
             tmp_all_init_finished = True
             for eid in self.init_finished:
@@ -178,7 +232,7 @@ class DHNetworkSimulator(Simulator):
         else:
             data = {}
 
-        for eid, esim in self.simulators.items():
+        for eid in self.entityparams:
             requests = outputs.get(eid, [])
             mydata = {}
 
@@ -186,8 +240,15 @@ class DHNetworkSimulator(Simulator):
                 if attr in self.input_vars or attr in self.output_vars:
                     if attr == 'initialized':
                         mydata[attr] = self.init_finished[eid]
+                    elif self.pool is not None:
+                        mydata[attr] = self.entity_outputs[eid][attr]
                     else:
-                        mydata[attr] = getattr(esim, attr)
+                        mydata[attr] = getattr(self.simulators[eid], attr)
+                elif attr in self.profile_vars:
+                    if self.pool is not None:
+                        mydata[attr] = self.entity_outputs[eid][attr]
+                    else:
+                        mydata[attr] = self.simulators[eid].get_last_phase_time(self.profile_vars[attr])
                 else:
                     raise AttributeError(f"DHNetworkSimulator {eid} has no attribute {attr}.")
 
@@ -198,6 +259,50 @@ class DHNetworkSimulator(Simulator):
 
         return data
 
+    def finalize(self):
+        if self.pool is not None:
+            # Fetch the entities from the workers for the final statistics
+            self.simulators = self.pool.collect()
+            self.pool.close()
+        for eid, esim in self.simulators.items():
+            esim.close()
+            if esim.warm_start_pipeflow:
+                stats = esim.get_pipeflow_stats()
+                print('     dh network %s: %d warm-started pipeflows (%d iterations), %d cold-started pipeflows '
+                      '(%d iterations), approx. %.0f iterations saved.' % (
+                        eid, stats['warm_calls'], stats['warm_iterations'], stats['cold_calls'],
+                        stats['cold_iterations'], stats['iterations_saved']))
+            if esim.decoupled_solve:
+                stats = esim.get_pipeflow_stats()
+                print('     dh network %s: %d hydraulic solves, %d skipped (frozen mass flows).' % (
+                        eid, stats['hydraulic_runs'], stats['hydraulic_skips']))
+            if esim.hydraulic_cache is not None:
+                stats = esim.get_hydraulic_cache_stats()
+                print('     dh network %s: hydraulic cache %d hits, %d misses.' % (eid, stats['hits'], stats['misses']))
+            if esim.valve_control_mode != 'pid' or esim.valve_controller != 'single':
+                stats = esim.get_valve_control_stats()
+                print('     dh network %s: valve control (%s, %s) %d runs, %.1f iterations on average, max. %d, '
+                      '%d not converged.' % (eid, esim.valve_control_mode, esim.valve_controller, stats['runs'],
+                                             stats['mean_iterations'], stats['max_iterations'],
+                                             stats['not_converged']))
+            if esim.timer is not None:
+                profile = esim.get_profile()
+                for phase in PHASES:
+                    if phase in profile:
+                        print('     dh network %s: phase %s %.3f s total (%.1f %%), %d calls, %.2f ms on average.' % (
+                                eid, phase, profile[phase]['total_s'], 100 * profile[phase]['share'],
+                                profile[phase]['count'], 1000 * profile[phase]['mean_s']))
+            if esim.convergence_log is not None:
+                summary = esim.convergence_log.get_summary()
+                print('     dh network %s: %d steps, %d hydraulic solves (%d not converged), %d cached, %d skipped, '
+                      '%d Newton iterations (hydraulic), %d (thermal).' % (
+                        eid, summary['steps'], summary['solved'], summary['not_converged'], summary['cached'],
+                        summary['skipped'], summary['newton_iterations'], summary['newton_iterations_T']))
+                if self.convergence_log_file:
+                    key = '%s_convergence' % eid
+                    esim.convergence_log.to_hdf(self.convergence_log_file, key)
+                    print('Saved to store: {0}, dataframe: {1}'.format(self.convergence_log_file, key))
+
 
 if __name__ == '__main__':
 
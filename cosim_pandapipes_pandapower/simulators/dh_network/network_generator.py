@@ -0,0 +1,94 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import numpy as np
+from .topology_network import TopologyDHNetwork, make_topology
+
+CP_WATER = 4186  # Specific heat capacity of water [J/(kgK)]
+RHO_WATER = 980  # Density of water (approx. at 70 degC) [kg/m3]
+
+
+def generate_topology(n_consumers, layout='radial', seed=0, pipe_length_km=(0.05, 0.3), Qdot_kw=(50, 300),
+                      dT_consumer=30, v_design=1.0, d_min=0.05, service_length_km=0.01, p_bar=6, t_supply_c=75):
+    '''
+    Generates a district heating network description (see load_topology) with n_consumers substations.
+
+    layout='radial': every junction pair (supply/return) is connected to a randomly chosen upstream pair
+    (random recursive tree rooted at the feed-in). layout='ring': the junction pairs form a ring through the feed-in.
+    Each substation is connected with short service pipes to its junction pair. Pipe lengths and heat demands are
+    drawn uniformly from the given ranges; the mass flow setpoints follow from the heat demand and dT_consumer.
+    Pipe diameters are sized for v_design at the design mass flow (at least d_min).
+    '''
+    if layout not in ('radial', 'ring'):
+        raise ValueError(f'Unknown network layout: {layout}')
+    rng = np.random.default_rng(seed)
+    n = n_consumers
+
+    # Heat demand and design mass flow of the consumers
+    qdot = rng.uniform(*Qdot_kw, size=n)
+    mdot = qdot * 1000 / (CP_WATER * dT_consumer)
+
+    # Trunk: parent junction pair of each junction pair 1..n (0: feed-in)
+    if layout == 'radial':
+        parent = np.array([rng.integers(0, k) for k in range(1, n + 1)], dtype=int)
+    else:
+        parent = np.arange(n, dtype=int)
+
+    # Design mass flow of each trunk pipe: sum of all consumers downstream
+    mdot_pipe = mdot.copy()
+    for k in range(n, 0, -1):
+        if parent[k - 1] > 0:
+            mdot_pipe[parent[k - 1] - 1] += mdot_pipe[k - 1]
+    if layout == 'ring':
+        # Ring is fed from both sides
+        mdot_pipe[:] = mdot.sum() / 2
+
+    def diameter(mdot_design):
+        return max(d_min, round(float(np.sqrt(4 * mdot_design / (RHO_WATER * np.pi * v_design))), 3))
+
+    junctions, pipes, consumers = [], [], []
+    junctions.extend([{'name': 's0'}, {'name': 'r0'}])
+    for k in range(1, n + 1):
+        junctions.extend([{'name': 's%i' % k}, {'name': 'r%i' % k}, {'name': 'cs%i' % k}, {'name': 'cr%i' % k}])
+
+        # Trunk pipes (supply: parent -> k, return: k -> parent)
+        length = rng.uniform(*pipe_length_km)
+        d = diameter(mdot_pipe[k - 1])
+        sections = max(1, int(round(length / 0.1)))
+        pipes.append({'name': 'ls%i' % k, 'from_junction': 's%i' % parent[k - 1], 'to_junction': 's%i' % k,
+                      'length_km': length, 'diameter_m': d, 'sections': sections})
+        pipes.append({'name': 'lr%i' % k, 'from_junction': 'r%i' % k, 'to_junction': 'r%i' % parent[k - 1],
+                      'length_km': length, 'diameter_m': d, 'sections': sections})
+
+        # Service pipes and substation
+        d = diameter(mdot[k - 1])
+        pipes.append({'name': 'lcs%i' % k, 'from_junction': 's%i' % k, 'to_junction': 'cs%i' % k,
+                      'length_km': service_length_km, 'diameter_m': d})
+        pipes.append({'name': 'lcr%i' % k, 'from_junction': 'cr%i' % k, 'to_junction': 'r%i' % k,
+                      'length_km': service_length_km, 'diameter_m': d})
+        consumers.append({'name': 'cons%i' % k, 'supply_junction': 'cs%i' % k, 'return_junction': 'cr%i' % k,
+                          'diameter_m': d, 'Qdot_kw': qdot[k - 1], 'mdot_set': mdot[k - 1]})
+
+    if layout == 'ring' and n > 1:
+        # Close the ring (last junction pair -> feed-in)
+        length = rng.uniform(*pipe_length_km)
+        d = diameter(mdot_pipe[-1])
+        sections = max(1, int(round(length / 0.1)))
+        pipes.append({'name': 'ls%i' % (n + 1), 'from_junction': 's0', 'to_junction': 's%i' % n,
+                      'length_km': length, 'diameter_m': d, 'sections': sections})
+        pipes.append({'name': 'lr%i' % (n + 1), 'from_junction': 'r%i' % n, 'to_junction': 'r0',
+                      'length_km': length, 'diameter_m': d, 'sections': sections})
+
+    feed_ins = [{'name': 'grid', 'supply_junction': 's0', 'return_junction': 'r0', 'p_bar': p_bar,
+                 't_supply_c': t_supply_c}]
+
+    return make_topology({'junctions': junctions, 'pipes': pipes, 'consumers': consumers, 'feed_ins': feed_ins})
+
+
+def generate_network(n_consumers, layout='radial', seed=0, topology_params=None, **model_params):
+    '''
+    Generates a TopologyDHNetwork with n_consumers substations (see generate_topology), model_params are passed to
+    the DHNetwork constructor.
+    '''
+    tables = generate_topology(n_consumers, layout=layout, seed=seed, **(topology_params or {}))
+    return TopologyDHNetwork(tables=tables, **model_params)
@@ -0,0 +1,111 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import numpy as np
+
+
+class PipeSections:
+    '''
+    Temperature state of pipes divided into sections of equal length (semi-Lagrangian plug flow).
+
+    Each pipe p with S[p] sections has S[p] + 1 state points, the inlet (point 0) and the outlet of each section,
+    measured from the inlet in flow direction. All points are stored in one flat array (pipe p at
+    off[p] ... off[p] + S[p]). In each step, the temperature at a point is the temperature of the water parcel that
+    was at x - v * dt at the previous time (interpolated between the points) or, if the parcel entered the pipe
+    during the step, the inlet temperature at its entry time (interpolated between the previous and the current
+    inlet temperature). The parcel cools down towards the ambient temperature over its travel time.
+
+    Contrary to the lumped pipe model (one delay dx / v with the current velocity), parcels keep their position
+    when the flow velocity changes, and fronts entering the pipe within a step are resolved.
+    '''
+
+    def __init__(self, n_sections, length_m):
+        self.n_sections = np.maximum(np.asarray(n_sections, dtype=int), 1)
+        self.length = np.asarray(length_m, dtype=float)
+        self.h = self.length / self.n_sections  # Section length per pipe [m]
+
+        n_points = self.n_sections + 1
+        self.off = np.concatenate(([0], np.cumsum(n_points)[:-1]))  # First point (inlet) of each pipe
+        self.point_pipe = np.repeat(np.arange(len(n_points)), n_points)
+        self.point_pos = np.arange(n_points.sum()) - self.off[self.point_pipe]  # Point index within its pipe
+        self.point_x = self.point_pos * self.h[self.point_pipe]
+        self.outlet = self.off + self.n_sections
+        self.sections = np.flatnonzero(self.point_pos > 0)  # All points except the inlets
+
+        # Committed state at t_base (previous time step) and state computed for t_new (same-time loops)
+        self.t_base = None
+        self.T_base = None
+        self.forward_base = None
+        self.t_new = None
+        self.T_new = None
+        self.forward_new = None
+
+    def has_base(self):
+        return self.T_base is not None
+
+    def initialize(self, t, t_in, t_amb, k_x, forward):
+        '''
+        Steady state temperature profile for the inlet temperatures t_in, k_x: decay rate per length [1/m].
+        '''
+        p = self.point_pipe
+        with np.errstate(invalid='ignore', over='ignore'):
+            T = t_amb[p] + (t_in[p] - t_amb[p]) * np.exp(- k_x[p] * self.point_x)
+        self.t_base = self.T_base = self.forward_base = None
+        self.t_new, self.T_new, self.forward_new = t, np.where(np.isfinite(T), T, t_in[p]), forward.copy()
+
+    def prepare(self, t, forward):
+        '''
+        Makes the last computed state the base state if time advanced and aligns it with the flow direction.
+        Without a base state (first step), the profile has to be initialized.
+        '''
+        if t != self.t_new:
+            self.t_base, self.T_base, self.forward_base = self.t_new, self.T_new, self.forward_new
+        if self.T_base is None:
+            return
+
+        # Reverse the points of pipes with changed flow direction
+        flipped = forward != self.forward_base
+        if np.any(flipped):
+            points = flipped[self.point_pipe]
+            p = self.point_pipe[points]
+            self.T_base = self.T_base.copy()
+            self.T_base[points] = self.T_base[self.off[p] + self.n_sections[p] - self.point_pos[points]]
+            self.forward_base = forward.copy()
+
+    def compute(self, points, t, t_in, v, t_amb, k_t):
+        '''
+        Temperatures at the given points at time t. t_in, v, t_amb: current inlet temperature, flow velocity [m/s]
+        and ambient temperature per pipe, k_t: decay rate per time [1/s] per pipe.
+        '''
+        p = self.point_pipe[points]
+        x = self.point_x[points]
+        dt = t - self.t_base
+        v = v[p]
+
+        # Parcels from inside the pipe (interpolated between the points of the previous state)
+        src = x - v * dt
+        inside = src >= 0
+        pos = np.where(inside, src, 0) / self.h[p]
+        i0 = np.minimum(np.floor(pos).astype(int), self.n_sections[p] - 1)
+        w = pos - i0
+        T_base = self.T_base
+        T_inside = T_base[self.off[p] + i0] * (1 - w) + T_base[self.off[p] + i0 + 1] * w
+
+        # Parcels that entered during the step (entry time t - x / v)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tau_enter = x / v
+            f = np.clip(1 - tau_enter / dt, 0, 1)
+        T_enter = T_base[self.off[p]] * (1 - f) + t_in[p] * f
+
+        T_src = np.where(inside, T_inside, T_enter)
+        tau = np.where(inside, dt, tau_enter)
+        return t_amb[p] + (T_src - t_amb[p]) * np.exp(- k_t[p] * tau)
+
+    def commit(self, t, t_in, v, t_amb, k_t, forward):
+        '''
+        Computes and stores the state of all points at time t.
+        '''
+        T = np.empty(len(self.point_pipe))
+        T[self.off] = t_in
+        T[self.sections] = self.compute(self.sections, t, t_in, v, t_amb, k_t)
+        self.t_new, self.T_new, self.forward_new = t, T, forward.copy()
@@ -0,0 +1,66 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+from bisect import bisect_right
+from time import perf_counter
+import numpy as np
+
+# Phases of DHNetwork.step_single (in execution order)
+PHASES = ['update', 'hydraulics', 'topology', 'static_pipeflow', 'heatflow', 'store_output', 'outputs']
+
+
+class PhaseTimer:
+    '''
+    Lap timer for the phases of a simulation step. start() marks the beginning of a step, each lap(phase) books the
+    time since the previous mark to the given phase. Per phase the total time, the number of laps, the duration in
+    the last step and a histogram of the lap durations (logarithmic bins) are kept.
+    '''
+
+    def __init__(self, bin_edges=None):
+        if bin_edges is None:
+            bin_edges = np.logspace(-6, 2, 33)  # 1 us ... 100 s, 4 bins per decade
+        self.bin_edges = list(bin_edges)
+        self.totals = {}
+        self.counts = {}
+        self.last = {}
+        self.histograms = {}
+        self._mark = perf_counter()
+
+    def start(self):
+        self.last.clear()
+        self._mark = perf_counter()
+
+    def lap(self, phase):
+        t = perf_counter()
+        dt = t - self._mark
+        self._mark = t
+
+        if phase not in self.totals:
+            self.totals[phase] = 0.
+            self.counts[phase] = 0
+            self.histograms[phase] = np.zeros(len(self.bin_edges) + 1, dtype=int)
+        self.totals[phase] += dt
+        self.counts[phase] += 1
+        self.last[phase] = dt
+        self.histograms[phase][bisect_right(self.bin_edges, dt)] += 1
+
+    def reset(self):
+        self.totals.clear()
+        self.counts.clear()
+        self.last.clear()
+        self.histograms.clear()
+
+    def get_profile(self):
+        '''
+        Returns {phase: {'total_s', 'count', 'mean_s', 'share', 'histogram'}}, 'share' is the fraction of the total
+        time of all phases. histogram[0] counts laps shorter than bin_edges[0], histogram[-1] laps of at least
+        bin_edges[-1].
+        '''
+        total = sum(self.totals.values())
+        return {phase: {
+            'total_s': self.totals[phase],
+            'count': self.counts[phase],
+            'mean_s': self.totals[phase] / self.counts[phase],
+            'share': self.totals[phase] / total if total > 0 else 0.,
+            'histogram': self.histograms[phase].copy(),
+        } for phase in self.totals}
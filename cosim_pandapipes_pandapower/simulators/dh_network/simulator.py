@@ -1,15 +1,27 @@
 # Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
 # Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
 
+import os
 import sys
 import math
 from dataclasses import dataclass, field
 from typing import Dict
-import pandas as pd
 import numpy as np
 import pandapipes as pp
 import pandapipes.control.run_control as run_control
-from .valve_control import CtrlValve
+from pandapipes.control.run_control import prepare_run_ctrl
+from pandapipes.idx_node import PINIT
+from pandapipes.idx_branch import VINIT
+from pandapower.control import ControllerNotConverged
+from .valve_control import CtrlValve, CtrlValveGroup, CoupledValveControl
+from .history import HistoryBuffer, get_result_row
+from .topology import TopologyIndex
+from .pipe_sections import PipeSections
+from .hydraulic_cache import HydraulicCache
+from .snapshot import snapshot_key, load_snapshot, save_snapshot
+from .profiling import PhaseTimer
+from .static_worker import StaticReferenceWorker
+from .telemetry import ConvergenceLog, HYDRAULICS_SKIPPED, HYDRAULICS_CACHED, HYDRAULICS_SOLVED
 # import matplotlib.pyplot as plt
 # import pandapipes.plotting as plot
 
@@ -18,6 +30,21 @@ if not sys.warnoptions:
 
 # Global
 # OUTPUT_PLOTTING_PERIOD = 60 * 60 * 4 - 60
+V_MEAN_MIN_HORIZON = 1e-3  # Flow velocities below this value do not extend the history horizon [m/s]
+
+# Output variables and the junctions (temperatures) / valves (mass flows) they are read from
+TEMP_OUTPUTS = [('T_return_tank', 'n3r'), ('T_evap_in', 'n3r'), ('T_return_grid', 'n1r'), ('T_supply_cons1', 'n5s'),
+                ('T_supply_cons2', 'n7s'), ('T_return_cons1', 'n5r'), ('T_return_cons2', 'n7r')]
+MDOT_OUTPUTS = [('mdot_cons1', 'sub_v1'), ('mdot_cons2', 'sub_v2'), ('mdot_bypass', 'bypass'), ('mdot_grid', 'grid_v1'),
+                ('mdot_tank_out', 'tank_v1')]
+
+# Result columns restored from the hydraulic cache (pressures, mass flows and velocities, prefixes)
+HYDRAULIC_RESULT_PREFIXES = ('p_', 'mdot', 'v')
+
+# Parameters that determine the constructed network (key of the network snapshots)
+NETWORK_PARAMS = ['T_supply_grid', 'P_grid_bar', 'P_hp_bar', 'T_amb', 'tank_installed', 'Qdot_cons1', 'Qdot_cons2',
+                  'Qdot_evap', 'T_tank_forward', 'mdot_grid', 'mdot_tank_out', 'valve_control_mode', 'valve_controller']
+NETWORK_SOURCES = [os.path.join(os.path.dirname(__file__), name) for name in ['simulator.py', 'valve_control.py']]
 
 @dataclass
 class DHNetwork:
@@ -33,9 +60,26 @@ class DHNetwork:
     P_hp_bar: float = 6  # Pressure of the heat pump + storage unit [bar]
     tank_installed: bool = True  # Enable hp + tank connection point
     dynamic_temp_flow_enabled: bool = True  # Enable external temperature flow sim incl. network inertia
+    warm_start_pipeflow: bool = False  # Initialize each pipeflow with the pressures of the previous one
+    valve_control_mode: str = 'pid'  # 'pid': one P controller per valve, 'secant': P controllers with adaptive gain,
+                                     # 'newton': coupled inverse valve sizing
+    valve_controller: str = 'single'  # 'single': one CtrlValve per valve, 'group': one CtrlValveGroup per control level
+    hydraulic_cache_size: int = 0  # Number of cached hydraulic solutions (0: disabled)
+    hydraulic_cache_tol: float = 0.01  # Quantization of the mass flow setpoints for cache lookups [kg/s]
+    decoupled_solve: bool = False  # Solve hydraulics only if mass flow setpoints or valve states changed
+    hydraulic_tol: float = 0.01  # Setpoint changes below this value keep the frozen mass flows [kg/s]
+    vectorized_temp_flow: bool = True  # Compute the dynamic temperature flow for all pipes of a level at once
+    temp_flow_sections: int = 0  # Sections per pipe in the dynamic temperature flow (0: lumped pipes with one delay,
+                                 # -1: use the 'sections' of each pandapipes pipe)
+    log_full_history: bool = False  # Keep the full result history (otherwise only the plug-flow horizon is kept)
+    history_margin: float = 3600  # Safety margin added to the plug-flow history horizon [s]
+    profile_phases: bool = False  # Record the wall time of the phases of each step (see get_profile)
+    log_convergence: bool = False  # Record per-step valve control and pipeflow convergence (see convergence_log)
+    network_cache_dir: str = None  # Directory of pickled network snapshots (None: always build the network)
 
     # Magnitudes
     CP_WATER: float = 4186  # Specific heat capacity of water [J/(kgK)]
+    RHO_WATER: float = 980  # Density of water (heat loss of stagnant pipe sections) [kg/m3]
 
     # Input
     Qdot_evap: float = 0  # Heat consumption of heat pump evaporator [kW]
@@ -69,7 +113,21 @@ class DHNetwork:
     # Internal variables
     # plot_results_enabled: bool = False  # calculates static and dynamic heat flow and compares both results (only when dynamic temp flow enabled!)
     compare_to_static_results: bool = False  # calculates static and dynamic heat flow and compares both results (only when dynamic temp flow enabled
-    store: Dict[str, pd.DataFrame] = field(default_factory=dict)
+    static_worker: bool = True  # Compute the static comparison in a background process (merged asynchronously)
+    static_reference: StaticReferenceWorker = None
+    store: Dict[str, HistoryBuffer] = field(default_factory=dict)
+    history_log: Dict[str, HistoryBuffer] = field(default_factory=dict)
+    v_mean_min: np.ndarray = None  # Minimum flow velocity per pipe seen so far [m/s]
+    junction_cols: np.ndarray = None  # History columns of the junction temperatures
+    pipeflow_stats: Dict[str, int] = field(default_factory=lambda: {
+        'cold_calls': 0, 'cold_iterations': 0, 'warm_calls': 0, 'warm_iterations': 0, 'hydraulic_runs': 0,
+        'hydraulic_skips': 0})
+    valve_control_stats: Dict[str, int] = field(default_factory=lambda: {
+        'runs': 0, 'not_converged': 0, 'iterations': 0, 'max_iterations': 0})
+    step_telemetry: Dict[str, int] = field(default_factory=lambda: {
+        'hydraulics': HYDRAULICS_SKIPPED, 'converged': 1, 'pipeflow_calls': 0, 'newton_iterations': 0,
+        'newton_iterations_T': 0})
+    last_control_error: str = None  # Exception of the last non-converged valve control run
     cur_t: float = 0  # Actual time [s]
 
     # Network utils
@@ -79,40 +137,170 @@ class DHNetwork:
     heat_exchanger: list = None
     valve: list = None
     controller: list = None
+    valve_ctrl: dict = None  # Controller name -> (controller object, position within a CtrlValveGroup)
     sink: list = None
     source: list = None
     circ_pump: list = None
+    topology: TopologyIndex = None
+    pipe_sections: PipeSections = None  # Section temperatures of the pipes (None: lumped pipes)
+    hydraulic_cache: HydraulicCache = None
+    timer: PhaseTimer = None  # Phase timer (None: profiling disabled)
+    convergence_log: ConvergenceLog = None  # Convergence telemetry (None: disabled)
+    idx: Dict[str, np.ndarray] = field(default_factory=dict)  # Integer positions of the input and output elements
+    hydraulic_inputs: np.ndarray = None  # Setpoints and valve states of the last converged hydraulic solve
+    hydraulic_sol_vec: np.ndarray = None  # Pressures and velocities of the last hydraulic solve (heat mode start)
 
     def __post_init__(self):
-        self._create_network()
+        if self.network_cache_dir is None:
+            self._create_network()
+        else:
+            self._load_or_create_network()
+        self._init_element_index()
+        self.topology = TopologyIndex(self.net)
+        if self.temp_flow_sections != 0:
+            sections = self.net.pipe['sections'].values if self.temp_flow_sections < 0 else \
+                np.full(len(self.net.pipe), self.temp_flow_sections)
+            self.pipe_sections = PipeSections(sections, self.net.pipe['length_km'].values * 1000)
+        if self.hydraulic_cache_size > 0:
+            self.hydraulic_cache = HydraulicCache(maxsize=self.hydraulic_cache_size, tol=self.hydraulic_cache_tol)
+        if self.profile_phases:
+            self.timer = PhaseTimer()
+        if self.log_convergence:
+            self.convergence_log = ConvergenceLog(self.valve_ctrl.keys())
         self._init_output_store()
         warnings.filterwarnings('ignore', message='Pipeflow converged, however, the results are phyisically incorrect as pressure is negative at nodes*')
 
+    def _load_or_create_network(self):
+        '''
+        Loads the ready-to-solve network (incl. controllers) from a snapshot with the same construction parameters,
+        or builds it and stores a new snapshot.
+        '''
+        key = snapshot_key(self._get_network_params(), self._get_network_sources())
+        snapshot = load_snapshot(self.network_cache_dir, key)
+        if snapshot is not None:
+            for name, value in snapshot.items():
+                setattr(self, name, value)
+            return
+
+        self._create_network()
+        save_snapshot(self.network_cache_dir, key, {name: getattr(self, name) for name in [
+            'net', 'junction', 'pipe', 'heat_exchanger', 'valve', 'controller', 'valve_ctrl', 'sink', 'source']})
+
+    def _get_network_params(self):
+        return {name: getattr(self, name) for name in NETWORK_PARAMS}
+
+    def _get_network_sources(self):
+        return NETWORK_SOURCES
+
+    def _init_element_index(self):
+        '''
+        Resolves the named elements written in _update and read in step_single to integer positions (once).
+        '''
+        j = self.junction
+        v = self.valve
+        hex = self.heat_exchanger
+        sink = self.sink
+        source = self.source
+        idx = self.idx
+
+        idx['out_temp'] = np.array([j.index(name) for _, name in TEMP_OUTPUTS], dtype=int)
+        idx['out_mdot'] = np.array([v.index(name) for _, name in MDOT_OUTPUTS], dtype=int)
+
+        # Inputs: sinks ('sink_grid', 'sink_tank'), heat exchangers ('hex1', 'hex2', 'hp_evap'), tank supply
+        sinks = ['sink_grid', 'sink_tank'] if self.tank_installed else ['sink_grid']
+        hexes = ['hex1', 'hex2', 'hp_evap'] if self.tank_installed else ['hex1', 'hex2']
+        idx['in_sink'] = np.array([sink.index(name) for name in sinks], dtype=int)
+        idx['in_hex'] = np.array([hex.index(name) for name in hexes], dtype=int)
+        if self.tank_installed:
+            idx['in_tank'] = source.index('supply_tank')
+
     def _init_output_store(self):
+        # Define stored quantities (one column per junction temperature and per pipe temperature, mass flow and delay)
+        columns = ['temp_' + j for j in self.junction]
+        for l in self.pipe:
+            columns.extend(['temp_' + l, 'mdot_' + l, 'dt_' + l])
+
         # Init output storage
         if self.dynamic_temp_flow_enabled:
-            self.store['dynamic'] = {}
-            if self.compare_to_static_results:
-                self.store['static'] = {}
-
+            labels = ['dynamic', 'static'] if self.compare_to_static_results else ['dynamic']
         else:
-            self.store['static'] = {}
+            labels = ['static']
+
+        for label in labels:
+            self.store[label] = HistoryBuffer(columns)
+            if self.log_full_history:
+                self.history_log[label] = HistoryBuffer(columns)
+
+        self.v_mean_min = np.full(len(self.pipe), np.inf)
+        self.junction_cols = np.array([columns.index('temp_' + j) for j in self.junction])
+
+    def get_output_frame(self, label='dynamic'):
+        '''
+        Returns the stored results as pandas DataFrame (indexed by time).
+        Without full history logging only the rows within the plug-flow horizon are available.
+        '''
+        if label == 'static' and self.static_reference is not None:
+            self._merge_static_reference(wait=True)
+        if label in self.history_log:
+            return self.history_log[label].to_frame()
+        return self.store[label].to_frame()
+
+    def get_history_horizon(self):
+        '''
+        Returns the time span of inlet temperature history needed by the slowest pipe plus the safety margin [s].
+        '''
+        dx = self.net.pipe['length_km'].values * 1000
+        v_min = self.v_mean_min
+        delays = dx[np.isfinite(v_min)] / v_min[np.isfinite(v_min)]
+        max_delay = delays.max() if delays.size else 0
+        return max_delay + self.history_margin
+
+    def _evict_history(self):
+        # Update minimum flow velocity per pipe (stagnant pipes are ignored)
+        v_mean = np.abs(self.net.res_pipe['v_mean_m_per_s'].values)
+        v_mean = np.where(v_mean >= V_MEAN_MIN_HORIZON, v_mean, np.inf)
+        np.fmin(self.v_mean_min, v_mean, out=self.v_mean_min)
+
+        # Drop results that are no longer needed for the delayed inlet temperatures
+        t_min = self.cur_t - self.get_history_horizon()
+        for history in self.store.values():
+            history.evict_before(t_min)
 
     def step_single(self, time):
-        j = self.junction
-        v = self.valve
+        timer = self.timer
+        if timer:
+            timer.start()
 
         # Set actual time
         self.cur_t = time
+        self._reset_step_telemetry()
 
         # update inputs
         self._update()
+        if timer:
+            timer.lap('update')
+
+        # Run hydraulic flow (steady-state), skipped for unchanged setpoints and valve states if decoupled
+        if not self.decoupled_solve or self._hydraulics_outdated():
+            if self.run_hydraulic_control():
+                self.hydraulic_inputs = self._get_hydraulic_inputs()
+            self.pipeflow_stats['hydraulic_runs'] += 1
+        else:
+            self.pipeflow_stats['hydraulic_skips'] += 1
+            self.step_telemetry['hydraulics'] = HYDRAULICS_SKIPPED
+        if timer:
+            timer.lap('hydraulics')
 
-        # Run hydraulic flow (steady-state)
-        self.run_hydraulic_control()
+        # Controllers may have closed valves
+        if self.topology.is_outdated(self.net):
+            self.topology.build(self.net)
+        if timer:
+            timer.lap('topology')
 
         if not self.dynamic_temp_flow_enabled:
             self._run_static_pipeflow()
+            if timer:
+                timer.lap('static_pipeflow')
         else:
             self._run_dynamic_pipeflow()
 
@@ -122,112 +310,503 @@ class DHNetwork:
                 # self._plot_outputs()
 
         # Set output variables
-        self.T_return_tank = round(self.net.res_junction.at[j.index('n3r'), 't_k'] - 273.15, 2)
-        self.T_evap_in = round(self.net.res_junction.at[j.index('n3r'), 't_k'] - 273.15, 2)
-        self.T_return_grid = round(self.net.res_junction.at[j.index('n1r'), 't_k'] - 273.15, 2)
-        self.T_supply_cons1 = round(self.net.res_junction.at[j.index('n5s'), 't_k'] - 273.15, 2)
-        self.T_supply_cons2 = round(self.net.res_junction.at[j.index('n7s'), 't_k'] - 273.15, 2)
-        self.T_return_cons1 = round(self.net.res_junction.at[j.index('n5r'), 't_k'] - 273.15, 2)
-        self.T_return_cons2 = round(self.net.res_junction.at[j.index('n7r'), 't_k'] - 273.15, 2)
-
-        self.mdot_cons1 = round(self.net.res_valve.at[v.index('sub_v1'), 'mdot_from_kg_per_s'], 2)
-        self.mdot_cons2 = round(self.net.res_valve.at[v.index('sub_v2'), 'mdot_from_kg_per_s'], 2)
-        self.mdot_bypass = round(self.net.res_valve.at[v.index('bypass'), 'mdot_from_kg_per_s'], 2)
-        self.mdot_grid = round(self.net.res_valve.at[v.index('grid_v1'), 'mdot_from_kg_per_s'], 2)
-        self.mdot_tank_out = round(self.net.res_valve.at[v.index('tank_v1'), 'mdot_from_kg_per_s'], 2)
+        self._set_outputs()
+        if self.convergence_log is not None:
+            self._log_convergence()
+        if timer:
+            timer.lap('outputs')
+
+    def _set_outputs(self):
+        t_k = self.net.res_junction['t_k'].values[self.idx['out_temp']]
+        for (attr, _), value in zip(TEMP_OUTPUTS, np.round(t_k - 273.15, 2)):
+            setattr(self, attr, value)
+
+        mdot = self.net.res_valve['mdot_from_kg_per_s'].values[self.idx['out_mdot']]
+        for (attr, _), value in zip(MDOT_OUTPUTS, np.round(mdot, 2)):
+            setattr(self, attr, value)
         self.mdot_tank_in = - self.mdot_tank_out
 
     def run_hydraulic_control(self):
+        # Reuse converged solution for (nearly) identical setpoints
+        if self.hydraulic_cache is not None:
+            key = self.hydraulic_cache.make_key(self._get_mdot_setpoints())
+            state = self.hydraulic_cache.get(key)
+            if state is not None:
+                self._set_hydraulic_state(state)
+                self.step_telemetry['hydraulics'] = HYDRAULICS_CACHED
+                return True
+
         # Ignore user warnings of control
+        self.step_telemetry['hydraulics'] = HYDRAULICS_SOLVED
         try:
-            run_control(self.net, max_iter=100)
-        except:
+            if self.valve_control_mode == 'newton':
+                self._run_coupled_valve_control()
+            else:
+                # Use own pipeflow function in the control loop (warm start, iteration count)
+                ctrl_variables = prepare_run_ctrl(self.net, None)
+                ctrl_variables['run'] = self._pipeflow
+                run_control(self.net, ctrl_variables=ctrl_variables, max_iter=100)
+        except Exception as e:
+            self._count_valve_control_iterations(converged=False)
+            self.step_telemetry['converged'] = 0
+            self.last_control_error = '%s: %s' % (type(e).__name__, e)
+            if self.convergence_log is not None:
+                self.convergence_log.add_error(self.cur_t, e)
             # Throw UserWarning
-            warnings.warn('Controller not converged: maximum number of iterations per controller is reached at time t={}.'.format(self.cur_t), UserWarning, stacklevel=2)
+            warnings.warn('Controller not converged at time t={} ({}).'.format(self.cur_t, self.last_control_error), UserWarning, stacklevel=2)
+            return False
+        self._count_valve_control_iterations(converged=True)
+
+        if self.hydraulic_cache is not None:
+            self.hydraulic_cache.put(key, self._get_hydraulic_state())
+        return True
+
+    def _get_hydraulic_inputs(self):
+        return np.concatenate((self._get_mdot_setpoints(), self.net.valve['loss_coefficient'].values,
+                               self.net.valve['opened'].values))
+
+    def _hydraulics_outdated(self):
+        '''
+        True if the mass flow setpoints changed by more than hydraulic_tol or any valve state changed since the
+        last converged hydraulic solve.
+        '''
+        if self.hydraulic_inputs is None:
+            return True
+        inputs = self._get_hydraulic_inputs()
+        n = len(self._get_mdot_setpoints())
+        return (np.any(np.abs(inputs[:n] - self.hydraulic_inputs[:n]) > self.hydraulic_tol)
+                or not np.array_equal(inputs[n:], self.hydraulic_inputs[n:]))
+
+    def _run_coupled_valve_control(self):
+        ctrls = [ctrl for ctrl in self.net.controller['object'] if isinstance(ctrl, CtrlValve)]
+        valve_control = CoupledValveControl(self.net, ctrls, run=self._pipeflow)
+        if not valve_control.run_control():
+            raise ControllerNotConverged('Coupled valve control did not converge after %i iterations.'
+                                         % valve_control.i)
+
+    def _count_valve_control_iterations(self, converged):
+        iterations = max((np.max(ctrl.i, initial=0) for ctrl in self.net.controller['object']
+                          if isinstance(ctrl, (CtrlValve, CtrlValveGroup))), default=0)
+        stats = self.valve_control_stats
+        stats['runs'] += 1
+        stats['not_converged'] += not converged
+        stats['iterations'] += iterations
+        stats['max_iterations'] = max(stats['max_iterations'], iterations)
+
+    def get_valve_control_stats(self):
+        '''
+        Returns the number of valve control runs and valve adjustments (iterations of the slowest valve per run).
+        '''
+        stats = dict(self.valve_control_stats)
+        stats['mean_iterations'] = stats['iterations'] / stats['runs'] if stats['runs'] else float('nan')
+        return stats
+
+    def _reset_step_telemetry(self):
+        telemetry = self.step_telemetry
+        telemetry['hydraulics'] = HYDRAULICS_SKIPPED
+        telemetry['converged'] = 1
+        telemetry['pipeflow_calls'] = 0
+        telemetry['newton_iterations'] = 0
+        telemetry['newton_iterations_T'] = 0
+
+    def _get_valve_ctrl_state(self):
+        '''
+        Returns the controlled valves (net index), mass flow setpoints and iteration counts, ordered as valve_ctrl.
+        '''
+        gid, mdot_set, i = [], [], []
+        for ctrl, k in self.valve_ctrl.values():
+            if k is None:
+                gid.append(ctrl.gid)
+                mdot_set.append(ctrl.mdot_set_kg_per_s)
+                i.append(ctrl.i)
+            else:
+                gid.append(ctrl.gid[k])
+                mdot_set.append(ctrl.mdot_set_kg_per_s[k])
+                i.append(ctrl.i[k])
+        return np.array(gid, dtype=int), np.array(mdot_set, dtype=float), np.array(i, dtype=int)
+
+    def _log_convergence(self):
+        gid, mdot_set, i = self._get_valve_ctrl_state()
+        mdot = self.net.res_valve['mdot_from_kg_per_s'].reindex(gid).values
+        telemetry = self.step_telemetry
+        solved = telemetry['hydraulics'] == HYDRAULICS_SOLVED
+        self.convergence_log.append(
+            self.cur_t, telemetry['hydraulics'], telemetry['converged'], np.max(i, initial=0) if solved else 0,
+            telemetry['pipeflow_calls'], telemetry['newton_iterations'], telemetry['newton_iterations_T'],
+            mdot - mdot_set, i if solved else np.zeros_like(i))
+
+    def _get_mdot_setpoints(self):
+        return [self.mdot_cons1_set, self.mdot_cons2_set, self.mdot_grid_set, self.mdot_tank_in_set,
+                self.mdot_bypass_set]
+
+    def _get_hydraulic_state(self):
+        net = self.net
+        results = {}
+        for table in net.keys():
+            if table.startswith('res_'):
+                columns = [c for c in net[table].columns if c.startswith(HYDRAULIC_RESULT_PREFIXES)]
+                results[table] = net[table][columns].copy()
+        return {
+            'loss_coefficient': net.valve['loss_coefficient'].values.copy(),
+            'opened': net.valve['opened'].values.copy(),
+            'sol_vec': self.hydraulic_sol_vec,
+            'results': results,
+        }
+
+    def _set_hydraulic_state(self, state):
+        net = self.net
+        net.valve['loss_coefficient'] = state['loss_coefficient']
+        net.valve['opened'] = state['opened']
+        self.hydraulic_sol_vec = state['sol_vec']
+
+        # Temperatures are kept, they depend on the current feed-in temperatures and the temperature history
+        for table, res in state['results'].items():
+            for column in res.columns:
+                net[table][column] = res[column].values
+
+        # Keep the valve controllers consistent with the restored valve positions
+        for ctrl in net.controller['object']:
+            if isinstance(ctrl, (CtrlValve, CtrlValveGroup)):
+                ctrl.read_from_net(net)
+
+    def get_profile(self):
+        '''
+        Returns the per-phase wall time statistics of step_single (see PhaseTimer.get_profile), empty if
+        profile_phases is disabled.
+        '''
+        return self.timer.get_profile() if self.timer else {}
+
+    def get_last_phase_time(self, phase):
+        '''
+        Returns the wall time of the given phase in the last step [s] (0 if not recorded).
+        '''
+        return self.timer.last.get(phase, 0.) if self.timer else 0.
+
+    def get_hydraulic_cache_stats(self):
+        if self.hydraulic_cache is None:
+            return {'hits': 0, 'misses': 0, 'entries': 0}
+        return self.hydraulic_cache.get_stats()
 
     def _run_static_pipeflow(self):
-        pp.pipeflow(self.net, transient=False, mode='all', max_iter=100, run_control=True, heat_transfer=True)
+        if self.decoupled_solve and self.hydraulic_sol_vec is not None:
+            # Heat transfer only, with the mass flows of the last hydraulic solve
+            try:
+                self._pipeflow(self.net, sol_vec=self.hydraulic_sol_vec, transient=False, mode='heat', max_iter=100,
+                               run_control=True, heat_transfer=True)
+                return
+            except ValueError:
+                # Active nodes/branches of the heat calculation differ from the hydraulic solve
+                self.hydraulic_sol_vec = None
+
+        self._pipeflow(self.net, transient=False, mode='all', max_iter=100, run_control=True, heat_transfer=True)
 
         # Store results
         # self._store_output(label='static')
 
+    def _pipeflow(self, net, **kwargs):
+        '''
+        Runs a pandapipes pipeflow. With warm start enabled, the solver starts from the pressures of the previous
+        solve instead of the junction initial values (restored afterwards). The junction temperatures are not
+        warm-started: pandapipes evaluates the fluid properties at them, so they would change the solution.
+        '''
+        initial = net.junction['pn_bar'].values.copy()
+        warm = self.warm_start_pipeflow and self._set_initial_values_from_results(net)
+        try:
+            pp.pipeflow(net, **kwargs)
+        finally:
+            if warm:
+                # Restore the configured initial values
+                net.junction['pn_bar'] = initial
+            self._count_pipeflow_iterations(net, warm)
+
+        # Keep the hydraulic solution as start vector of heat-only pipeflows
+        if self.decoupled_solve and kwargs.get('mode', 'hydraulics') in ['hydraulics', 'all'] and net.converged:
+            pit = net['_active_pit']
+            self.hydraulic_sol_vec = np.concatenate((pit['node'][:, PINIT], pit['branch'][:, VINIT]))
+
+    def _set_initial_values_from_results(self, net):
+        if 'res_junction' not in net or len(net.res_junction) != len(net.junction):
+            # No results yet (first pipeflow)
+            return False
+
+        p_bar = net.res_junction['p_bar'].values
+        if not np.all(np.isfinite(p_bar)):
+            # Previous solve failed, start from the initial values instead
+            return False
+
+        net.junction['pn_bar'] = p_bar
+        return True
+
+    def _count_pipeflow_iterations(self, net, warm):
+        results = net.get('_internal_results', {})
+        mode = net.get('_options', {}).get('mode', 'hydraulics')
+        iterations = results.get('iterations', 0) if mode in ['hydraulics', 'all'] else 0
+        iterations_T = results.get('iterations_T', 0) if mode in ['heat', 'all'] else 0
+
+        label = 'warm' if warm else 'cold'
+        self.pipeflow_stats[label + '_calls'] += 1
+        self.pipeflow_stats[label + '_iterations'] += iterations + iterations_T
+
+        telemetry = self.step_telemetry
+        telemetry['pipeflow_calls'] += 1
+        telemetry['newton_iterations'] += iterations
+        telemetry['newton_iterations_T'] += iterations_T
+
+    def get_pipeflow_stats(self):
+        '''
+        Returns pipeflow call and iteration counts. 'iterations_saved' estimates the Newton iterations saved by
+        the warm start, based on the mean iteration count of the cold-started solves.
+        '''
+        stats = dict(self.pipeflow_stats)
+        if stats['cold_calls']:
+            cold_mean = stats['cold_iterations'] / stats['cold_calls']
+            stats['iterations_saved'] = stats['warm_calls'] * cold_mean - stats['warm_iterations']
+        else:
+            stats['iterations_saved'] = float('nan')
+        return stats
+
     def _run_dynamic_pipeflow(self):
-        if self.compare_to_static_results:
+        timer = self.timer
+        if self.compare_to_static_results and self.static_worker:
+            # static temperature flow calculation in the background (same inputs and valve positions)
+            self._submit_static_reference()
+            if timer:
+                timer.lap('static_pipeflow')
+        elif self.compare_to_static_results:
             # static temperature flow calculation
             self._run_static_pipeflow()
+            if timer:
+                timer.lap('static_pipeflow')
 
             # Store results
             self._store_output(label='static')
+            if timer:
+                timer.lap('store_output')
 
         # Dynamic heat flow distribution
         self._internal_heatflow_calc()
+        if timer:
+            timer.lap('heatflow')
 
         # Store results
         self._store_output(label='dynamic')
+        self._evict_history()
+        if timer:
+            timer.lap('store_output')
+
+    def _submit_static_reference(self):
+        if self.static_reference is None:
+            self.static_reference = StaticReferenceWorker(self.net)
+        self.static_reference.submit(self.cur_t, self.net)
+        self._merge_static_reference()
+
+    def _merge_static_reference(self, wait=False):
+        for time, values, error in self.static_reference.collect(wait=wait):
+            if values is None:
+                warnings.warn('Static reference pipeflow failed at time t={} ({}).'.format(time, error),
+                              UserWarning, stacklevel=2)
+            else:
+                self._append_output('static', time, values)
+
+    def close(self):
+        '''
+        Waits for the pending static reference results and stops the background worker.
+        '''
+        if self.static_reference is not None:
+            self._merge_static_reference(wait=True)
+            self.static_reference.close()
+            self.static_reference = None
 
     def _internal_heatflow_calc(self):
-        self._calc_forward_pipe_tempflow()
-        self._calc_backward_pipe_tempflow()
-
-    def _calc_forward_pipe_tempflow(self):
-        for pipe in self.pipe[0:7]:  # TODO: Make this applicable to any network topology
-            self._internal_tempflow_calc(pipe)
-            self._update_temperature_flow(pipe)
-
-    def _calc_consumer_return_temperature(self, hex):
-        h = self.heat_exchanger
-        p = self.pipe
-
-        from_j_id = self.net.heat_exchanger.at[h.index(hex), 'from_junction']
-        to_j_id = self.net.heat_exchanger.at[h.index(hex), 'to_junction']
-        qext_w = self.net.heat_exchanger.at[h.index(hex), 'qext_w']
-        forward_temp = self.net.res_junction.at[from_j_id, 't_k']
-        mdot = self.net.res_heat_exchanger.at[h.index(hex), 'mdot_from_kg_per_s']
+        if self.pipe_sections is not None:
+            self._internal_heatflow_calc_sections()
+            return
+
+        if self.vectorized_temp_flow:
+            self._internal_heatflow_calc_vectorized()
+            return
+
+        # Process pipes from upstream to downstream along the solved mass flow
+        for pipe_id in self.topology.pipe_order:
+            self._internal_tempflow_calc(pipe_id)
+            self._update_temperature_flow(pipe_id)
+
+    def _internal_heatflow_calc_vectorized(self):
+        '''
+        Array version of _internal_tempflow_calc and _update_temperature_flow. All pipes of a topological level
+        are computed in one pass, followed by the mixing at the junctions and the heat exchangers they supply.
+        '''
+        net = self.net
+        top = self.topology
+        history = self.store['dynamic']
+        cp_w = self.CP_WATER
+
+        # Pipe data
+        mdot = np.abs(net.res_pipe['mdot_from_kg_per_s'].values)
+        dx = net.pipe['length_km'].values * 1000
+        v_mean = np.abs(net.res_pipe['v_mean_m_per_s'].values)
+        loss_coeff = net.pipe['alpha_w_per_m2k'].values * math.pi * net.pipe['diameter_m'].values  # [W/mK]
+        t_amb = net.pipe['text_k'].values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            delay_t = self.cur_t - dx / v_mean
+            decay = np.exp(- (loss_coeff * dx) / (cp_w * mdot))
+
+        # Heat exchanger data
+        qext_w = net.heat_exchanger['qext_w'].values
+        mdot_hex = net.res_heat_exchanger['mdot_from_kg_per_s'].values
+        hex_t_from = self._get_result_column(net.res_heat_exchanger, 't_from_k')
+        hex_t_to = self._get_result_column(net.res_heat_exchanger, 't_to_k')
+
+        t_junction = net.res_junction['t_k'].values.copy()
+        t_in = np.empty(len(mdot))
+        t_out = np.empty(len(mdot))
+
+        for level in top.levels:
+            pipes = level.pipes
+            j_in = top.pipe_in[pipes]
+
+            # Get historic inlet temperature
+            if len(history):
+                t_in[pipes] = history.interp_columns(delay_t[pipes], self.junction_cols[j_in]) + 273.15
+            else:
+                t_in[pipes] = t_junction[j_in]
+
+            # Dynamic temperature drop along the pipes
+            t_out[pipes] = t_amb[pipes] + (t_in[pipes] - t_amb[pipes]) * decay[pipes]
+
+            # Temperature mix at supplied junctions weighted by share of incoming mass flow
+            mf = mdot[level.mix_pipes]
+            n = len(level.junctions)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t_junction[level.junctions] = (np.bincount(level.mix_slot, mf * t_out[level.mix_pipes], minlength=n)
+                                               / np.bincount(level.mix_slot, mf, minlength=n))
+
+            # Return temperature of supplied hex consumers
+            hexes = level.hexes
+            hex_t_from[hexes] = t_junction[top.hex_from[hexes]]
+            hex_t_to[hexes] = hex_t_from[hexes] - qext_w[hexes] / (cp_w * mdot_hex[hexes])
+            t_junction[top.hex_to[hexes]] = hex_t_to[hexes]
+
+        # Write results (the inlet temperature of pipes behind a hex is always overwritten by a later level)
+        net.res_junction['t_k'] = t_junction
+        net.res_pipe['t_from_k'] = np.where(top.pipe_forward, t_in, t_out)
+        net.res_pipe['t_to_k'] = np.where(top.pipe_forward, t_out, t_in)
+        net.res_heat_exchanger['t_from_k'] = hex_t_from
+        net.res_heat_exchanger['t_to_k'] = hex_t_to
+
+    def _internal_heatflow_calc_sections(self):
+        '''
+        Dynamic temperature flow with pipes divided into sections (see PipeSections). Like
+        _internal_heatflow_calc_vectorized, but the pipe outlet temperatures follow from the section temperatures of
+        the previous step and the current inlet temperatures instead of the delayed inlet temperature history.
+        '''
+        net = self.net
+        top = self.topology
+        sections = self.pipe_sections
+        cp_w = self.CP_WATER
+
+        # Pipe data
+        mdot = np.abs(net.res_pipe['mdot_from_kg_per_s'].values)
+        v_mean = np.nan_to_num(np.abs(net.res_pipe['v_mean_m_per_s'].values))
+        dia = net.pipe['diameter_m'].values
+        loss_coeff = net.pipe['alpha_w_per_m2k'].values * math.pi * dia  # [W/mK]
+        t_amb = net.pipe['text_k'].values
+        rho_area = np.where(v_mean > 0, mdot / np.where(v_mean > 0, v_mean, 1),
+                            self.RHO_WATER * math.pi * dia ** 2 / 4)  # Water mass per length [kg/m]
+        k_t = loss_coeff / (cp_w * rho_area)  # Decay rate per travel time [1/s]
+        with np.errstate(divide='ignore'):
+            k_x = loss_coeff / (cp_w * mdot)  # Decay rate per travel length [1/m]
+
+        # Without a previous state (first step), the pipes start from the steady state profile
+        sections.prepare(self.cur_t, top.pipe_forward)
+        steady = not sections.has_base()
+        with np.errstate(over='ignore'):
+            decay = np.exp(- k_x * sections.length)
+
+        # Heat exchanger data
+        qext_w = net.heat_exchanger['qext_w'].values
+        mdot_hex = net.res_heat_exchanger['mdot_from_kg_per_s'].values
+        hex_t_from = self._get_result_column(net.res_heat_exchanger, 't_from_k')
+        hex_t_to = self._get_result_column(net.res_heat_exchanger, 't_to_k')
+
+        t_junction = net.res_junction['t_k'].values.copy()
+        t_in = np.empty(len(mdot))
+        t_out = np.empty(len(mdot))
+
+        for level in top.levels:
+            pipes = level.pipes
+            t_in[pipes] = t_junction[top.pipe_in[pipes]]
+
+            if steady:
+                t_out[pipes] = t_amb[pipes] + (t_in[pipes] - t_amb[pipes]) * decay[pipes]
+            else:
+                t_out[pipes] = sections.compute(sections.outlet[pipes], self.cur_t, t_in, v_mean, t_amb, k_t)
+
+            # Temperature mix at supplied junctions weighted by share of incoming mass flow
+            mf = mdot[level.mix_pipes]
+            n = len(level.junctions)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t_junction[level.junctions] = (np.bincount(level.mix_slot, mf * t_out[level.mix_pipes], minlength=n)
+                                               / np.bincount(level.mix_slot, mf, minlength=n))
+
+            # Return temperature of supplied hex consumers
+            hexes = level.hexes
+            hex_t_from[hexes] = t_junction[top.hex_from[hexes]]
+            hex_t_to[hexes] = hex_t_from[hexes] - qext_w[hexes] / (cp_w * mdot_hex[hexes])
+            t_junction[top.hex_to[hexes]] = hex_t_to[hexes]
+
+        # Update the section temperatures
+        if steady:
+            sections.initialize(self.cur_t, t_in, t_amb, k_x, top.pipe_forward)
+        else:
+            sections.commit(self.cur_t, t_in, v_mean, t_amb, k_t, top.pipe_forward)
+
+        # Write results
+        net.res_junction['t_k'] = t_junction
+        net.res_pipe['t_from_k'] = np.where(top.pipe_forward, t_in, t_out)
+        net.res_pipe['t_to_k'] = np.where(top.pipe_forward, t_out, t_in)
+        net.res_heat_exchanger['t_from_k'] = hex_t_from
+        net.res_heat_exchanger['t_to_k'] = hex_t_to
+
+    @staticmethod
+    def _get_result_column(res_table, column):
+        if column in res_table:
+            return res_table[column].values.astype(float)
+        return np.full(len(res_table), np.nan)
+
+    def _calc_consumer_return_temperature(self, hex_id):
+        net = self.net
+        top = self.topology
+
+        from_j_id = top.hex_from[hex_id]
+        to_j_id = top.hex_to[hex_id]
+        qext_w = net.heat_exchanger.at[hex_id, 'qext_w']
+        forward_temp = net.res_junction.at[from_j_id, 't_k']
+        mdot = net.res_heat_exchanger.at[hex_id, 'mdot_from_kg_per_s']
         cp_w = self.CP_WATER
 
         # Set forward temperature to hex component
-        self.net.res_heat_exchanger.at[h.index(hex), 't_from_k'] = forward_temp
+        net.res_heat_exchanger.at[hex_id, 't_from_k'] = forward_temp
 
         # Calc return temperature at hex component
         return_temp = forward_temp - qext_w / (cp_w * mdot)
 
         # Set return temperature at hex component and connected junctions and pipes
-        self.net.res_heat_exchanger.at[h.index(hex), 't_to_k'] = return_temp
-        self.net.res_junction.at[to_j_id, 't_k'] = return_temp
-
-        conn_p_name = self.net.pipe['name'].loc[self.net.pipe['from_junction'] == to_j_id].values.tolist()
-        for pipe in conn_p_name:
-            self.net.res_pipe.at[p.index(pipe), 't_from_k'] = return_temp
-
-    def _calc_backward_pipe_tempflow(self):  # TODO: Make this applicable to any network topology
-        pipe_seq = self.pipe[7:14]
-        pipe_seq.reverse()
-        for pipe in pipe_seq:
-            self._internal_tempflow_calc(pipe)
-            self._update_temperature_flow(pipe)
-
-    def _store_output(self, label='static'):  # TODO: Improve due to low performance
-        data = {}
-
-        for j in self.junction:
-            data.update({'temp_' + j: round(self.net.res_junction.at[self.junction.index(j), 't_k'] - 273.15, 2)})
+        net.res_heat_exchanger.at[hex_id, 't_to_k'] = return_temp
+        net.res_junction.at[to_j_id, 't_k'] = return_temp
 
-        for l in self.pipe:
-            # Get temperature
-            data.update({'temp_' + l: round(self.net.res_pipe.at[self.pipe.index(l), 't_to_k'] - 273.15, 2)})
-
-            # Get mass flow
-            data.update({'mdot_' + l: round(self.net.res_pipe.at[self.pipe.index(l), 'mdot_from_kg_per_s'], 2)})
+        for pipe_id in top.hex_pipes_out[hex_id]:
+            t_in_col = 't_from_k' if top.pipe_forward[pipe_id] else 't_to_k'
+            net.res_pipe.at[pipe_id, t_in_col] = return_temp
 
-            # Determine thermal inertia
-            dx = self.net.pipe.at[self.pipe.index(l), 'length_km'] * 1000
-            v_mean = self.net.res_pipe.at[self.pipe.index(l), 'v_mean_m_per_s']
-            dt = dx / v_mean
-            data.update({'dt_' + l: round(dt, 2)})
+    def _store_output(self, label='static'):
+        # Columns are ordered junction temperatures first, then (temp, mdot, dt) per pipe
+        self._append_output(label, self.cur_t, get_result_row(self.net))
 
-        df = pd.DataFrame.from_dict(self.store[label])
-        df = df.append((pd.DataFrame(data=data, index=[self.cur_t])))
-        self.store[label] = df.to_dict()
+    def _append_output(self, label, time, values):
+        self.store[label].append(time, values)
+        if label in self.history_log:
+            self.history_log[label].append(time, values)
 
     # def _plot_outputs(self):
 
@@ -260,32 +839,29 @@ class DHNetwork:
                 # axes.set_prop_cycle(None)  # same colormap for dynamic and static
                 # axes.legend(loc='upper right')
 
-    def _internal_tempflow_calc(self, pipe):
+    def _internal_tempflow_calc(self, pipe_id):
         # Set required input data
-        p = self.pipe
-        j = self.junction
         net = self.net
-        mf = net.res_pipe.at[p.index(pipe), 'mdot_from_kg_per_s']
+        top = self.topology
+        mf = abs(net.res_pipe.at[pipe_id, 'mdot_from_kg_per_s'])
         Cp_w = self.CP_WATER
-        dx = net.pipe.at[p.index(pipe), 'length_km'] * 1000
-        v_mean = net.res_pipe.at[p.index(pipe), 'v_mean_m_per_s']
-        alpha = net.pipe.at[p.index(pipe), 'alpha_w_per_m2k']
-        dia = net.pipe.at[p.index(pipe), 'diameter_m']
+        dx = net.pipe.at[pipe_id, 'length_km'] * 1000
+        v_mean = abs(net.res_pipe.at[pipe_id, 'v_mean_m_per_s'])
+        alpha = net.pipe.at[pipe_id, 'alpha_w_per_m2k']
+        dia = net.pipe.at[pipe_id, 'diameter_m']
         loss_coeff = alpha * math.pi * dia  # Heat loss coefficient in [W/mK]
-        Ta = net.pipe.at[p.index(pipe), 'text_k']
+        Ta = net.pipe.at[pipe_id, 'text_k']
 
-        # Get junction connected to pipe inlet
-        j_in_id = self.net.pipe.at[p.index(pipe), 'from_junction']
-        j_in_name = self.net.junction.at[j_in_id, 'name']
+        # Get junction connected to pipe inlet (in flow direction)
+        j_in_id = top.pipe_in[pipe_id]
+        t_in_col, t_out_col = ('t_from_k', 't_to_k') if top.pipe_forward[pipe_id] else ('t_to_k', 't_from_k')
 
         # Get historic inlet temperature
-        df = pd.DataFrame.from_dict(self.store['dynamic'])
-
-        # Get historic inlet temperature
-        if not df.empty:
+        history = self.store['dynamic']
+        if len(history):
             dt = dx / v_mean
             delay_t = self.cur_t - dt
-            Tin = np.interp(delay_t, df.index, df['temp_' + j_in_name]) + 273.15  # TODO: Reduce calls due to performance
+            Tin = history.interp(delay_t, 'temp_' + self.junction[j_in_id]) + 273.15
         else:
             Tin = net.res_junction.at[j_in_id, 't_k']
 
@@ -293,100 +869,72 @@ class DHNetwork:
         # Tin = net.res_junction.at[j_in_id, 't_k']
 
         # Set current inlet temperature of pipe
-        net.res_pipe.at[p.index(pipe), 't_from_k'] = Tin
+        net.res_pipe.at[pipe_id, t_in_col] = Tin
 
         # Dynamic temperature drop along a pipe
         exp = - (loss_coeff * dx) / (Cp_w * mf)
         Tout = Ta + (Tin - Ta) * math.exp(exp)
 
         # Set pipe outlet temperature
-        net.res_pipe.at[p.index(pipe), 't_to_k'] = Tout
+        net.res_pipe.at[pipe_id, t_out_col] = Tout
 
-    def _update_temperature_flow(self, act_pipe):
-        p = self.pipe
-        v = self.valve
-        j = self.junction
+    def _update_temperature_flow(self, pipe_id):
+        top = self.topology
 
-        # Get connected junctions (direct and indirect)
-        # Check direct connection via junction
-        conn_j_id = []
-        conn_j_id.append(self.net.pipe.at[p.index(act_pipe), 'to_junction'])
-        # Check connection via valve
-        conn_v_name = self.net.valve['name'].loc[self.net.valve['from_junction'].isin(conn_j_id)].values.tolist()
-        for valve in conn_v_name:
-            opened = self.net.valve.at[v.index(valve), 'opened']
-            if opened:
-                conn_j_id.append(self.net.valve.at[v.index(valve), 'to_junction'])
-
-        # Set temperature at connected junctions
-        conn_j_name = self.net.junction['name'].iloc[conn_j_id].values.tolist()
-        for junction in conn_j_name:
-            self._set_pipe_inlet_temperature_at_junction(junction)
-
-        # Get connected hex consumer
-        hex_name = self.net.heat_exchanger['name'].loc[self.net.heat_exchanger['from_junction'].isin(conn_j_id)].values.tolist()
-        for hex in hex_name:
-            # Set temperature at the return side of each hex consumer
-            self._calc_consumer_return_temperature(hex)
-
-    def _set_pipe_inlet_temperature_at_junction(self, junction):
-        j = self.junction
-        p = self.pipe
-        v = self.valve
-        conn_j_id = [j.index(junction)]
-        # Get number of incoming pipes
-        # Check connection via valve
-        conn_v_name = self.net.valve['name'].loc[self.net.valve['to_junction'].isin(conn_j_id)].values.tolist()
-        for valve in conn_v_name:
-            opened = self.net.valve.at[v.index(valve), 'opened']
-            if opened:
-                conn_j_id.append(self.net.valve.at[v.index(valve), 'from_junction'])
-        pipes_in = self.net.pipe['name'].loc[self.net.pipe['to_junction'].isin(conn_j_id)].values.tolist()
-
-        mfsum = []
-        mtsum = []
-        if pipes_in:
-            for name in pipes_in:
-                # Do temperature mix weighted by share of incoming mass flow
-                mdot = self.net.res_pipe.at[p.index(name), 'mdot_from_kg_per_s']
-                t_in = self.net.res_pipe.at[p.index(name), 't_to_k']
-                mfsum.append(mdot)
-                mtsum.append(mdot * t_in)
-            Tset = (1 / sum(mfsum)) * sum(mtsum)
-        else:
-            raise AttributeError(f"Junction '{junction}' not connected to a network pipe.")
+        # Set temperature at connected junctions (direct and via opened valves)
+        for junction_id in top.pipe_out_junctions[pipe_id]:
+            self._set_pipe_inlet_temperature_at_junction(junction_id)
+
+        # Set temperature at the return side of each connected hex consumer
+        for hex_id in top.pipe_out_hex[pipe_id]:
+            self._calc_consumer_return_temperature(hex_id)
+
+    def _set_pipe_inlet_temperature_at_junction(self, junction_id):
+        net = self.net
+        top = self.topology
 
-        self.net.res_junction.at[j.index(junction), 't_k'] = Tset
+        # Get incoming pipes (direct and via opened valves)
+        pipes_in = top.junction_pipes_in[junction_id]
+        if not len(pipes_in):
+            raise AttributeError(f"Junction '{self.junction[junction_id]}' not connected to a network pipe.")
+
+        # Do temperature mix weighted by share of incoming mass flow
+        mfsum = 0
+        mtsum = 0
+        for pipe_id in pipes_in:
+            mdot = abs(net.res_pipe.at[pipe_id, 'mdot_from_kg_per_s'])
+            t_in = net.res_pipe.at[pipe_id, 't_to_k' if top.pipe_forward[pipe_id] else 't_from_k']
+            mfsum += mdot
+            mtsum += mdot * t_in
+        Tset = (1 / mfsum) * mtsum
+
+        net.res_junction.at[junction_id, 't_k'] = Tset
 
     def _update(self):
-        hex = self.heat_exchanger
-        ctrl = self.controller
-        sink = self.sink
-        source = self.source
-        v = self.valve
+        net = self.net
+        idx = self.idx
 
         self.mdot_tank_out_set = - self.mdot_tank_in_set
         self.mdot_grid_set = self.mdot_cons1_set + self.mdot_cons2_set + self.mdot_bypass_set - self.mdot_tank_out_set
 
-        # Update grid mass flow
-        self.net.sink.at[sink.index('sink_grid'), 'mdot_kg_per_s'] = self.mdot_grid_set
-
         # Update controller(s)
-        self.net.controller.at[ctrl.index('bypass_ctrl'), 'object'].set_mdot_setpoint(self.mdot_bypass_set)
-        self.net.controller.at[ctrl.index('hex1_ctrl'), 'object'].set_mdot_setpoint(self.mdot_cons1_set)
-        self.net.controller.at[ctrl.index('hex2_ctrl'), 'object'].set_mdot_setpoint(self.mdot_cons2_set)
-        self.net.controller.at[ctrl.index('grid_ctrl'), 'object'].set_mdot_setpoint(self.mdot_grid_set)
+        self._set_mdot_setpoint('bypass_ctrl', self.mdot_bypass_set)
+        self._set_mdot_setpoint('hex1_ctrl', self.mdot_cons1_set)
+        self._set_mdot_setpoint('hex2_ctrl', self.mdot_cons2_set)
+        self._set_mdot_setpoint('grid_ctrl', self.mdot_grid_set)
 
-        # Update tank
+        # Update grid and tank mass flow, load (same order as idx['in_sink'] and idx['in_hex'])
         if self.tank_installed:
-            self.net.sink.at[sink.index('sink_tank'), 'mdot_kg_per_s'] = self.mdot_tank_out_set
-            self.net.ext_grid.at[source.index('supply_tank'), 't_k'] = self.T_tank_forward + 273.15
-            self.net.controller.at[ctrl.index('tank_ctrl1'), 'object'].set_mdot_setpoint(self.mdot_tank_out_set)
+            net.ext_grid.at[idx['in_tank'], 't_k'] = self.T_tank_forward + 273.15
+            self._set_mdot_setpoint('tank_ctrl1', self.mdot_tank_out_set)
+            sink_mdot = [self.mdot_grid_set, self.mdot_tank_out_set]
+            hex_qext = [self.Qdot_cons1 * 1000, self.Qdot_cons2 * 1000, self.Qdot_evap * 1000]
+        else:
+            sink_mdot = [self.mdot_grid_set]
+            hex_qext = [self.Qdot_cons1 * 1000, self.Qdot_cons2 * 1000]
 
-        # Update load
-        self.net.heat_exchanger.at[hex.index('hex1'), 'qext_w'] = self.Qdot_cons1 * 1000
-        self.net.heat_exchanger.at[hex.index('hex2'), 'qext_w'] = self.Qdot_cons2 * 1000
-        self.net.heat_exchanger.at[hex.index('hp_evap'), 'qext_w'] = self.Qdot_evap * 1000
+        net.sink.loc[idx['in_sink'], 'mdot_kg_per_s'] = sink_mdot
+        net.heat_exchanger.loc[idx['in_hex'], 'qext_w'] = hex_qext
 
     def _create_network(self):
         # create empty network
@@ -570,27 +1118,56 @@ class DHNetwork:
         v = self.valve
         s = self.sink
 
-        # create supply flow control
-        CtrlValve(net=net, gid=v.index('tank_v1'), gain=-3000,
-                  # data_source=data_source, profile_name='tank',
-                  level=0, order=1, tol=0.25, name='tank_ctrl1')
-
-        CtrlValve(net=net, gid=v.index('grid_v1'), gain=-3000,
-                  # data_source=data_source, profile_name='tank',
-                  level=0, order=2, tol=0.25, name='grid_ctrl')
-
-        # create load flow control
-        CtrlValve(net=net, gid=v.index('bypass'), gain=-2000,
-                  # data_source=data_source, profile_name='bypass',
-                  level=1, order=1, tol=0.25, name='bypass_ctrl')
-        CtrlValve(net=net, gid=v.index('sub_v1'), gain=-100,
-                  #data_source=data_source, profile_name='hex1',
-                  level=1, order=2, tol=0.1, name='hex1_ctrl')
-        CtrlValve(net=net, gid=v.index('sub_v2'), gain=-100,
-                  # data_source=data_source, profile_name='hex2',
-                  level=1, order=3, tol=0.1, name='hex2_ctrl')
-
-        self.controller = ['tank_ctrl1', 'grid_ctrl', 'bypass_ctrl', 'hex1_ctrl', 'hex2_ctrl']
+        # Adaptive gain of the P controllers
+        update = 'secant' if self.valve_control_mode == 'secant' else 'pid'
+
+        ctrl_specs = self._get_ctrl_specs()
+
+        self.valve_ctrl = {}
+        if self.valve_controller == 'single':
+            for name, valve, gain, level, order, tol in ctrl_specs:
+                ctrl = CtrlValve(net=net, gid=v.index(valve), gain=gain, update=update,
+                                 level=level, order=order, tol=tol, name=name)
+                self.valve_ctrl[name] = (ctrl, None)
+            self.controller = [spec[0] for spec in ctrl_specs]
+
+        elif self.valve_controller == 'group':
+            if self.valve_control_mode == 'newton':
+                raise ValueError('valve_control_mode newton requires valve_controller single')
+
+            # One vectorized controller per control level
+            self.controller = []
+            for level in sorted(set(spec[3] for spec in ctrl_specs)):
+                specs = [spec for spec in ctrl_specs if spec[3] == level]
+                group_name = 'valve_group_%i' % level
+                ctrl = CtrlValveGroup(net=net, gids=[v.index(spec[1]) for spec in specs],
+                                      gain=[spec[2] for spec in specs], tol=[spec[5] for spec in specs],
+                                      update=update, level=level, order=0, name=group_name)
+                for k, spec in enumerate(specs):
+                    self.valve_ctrl[spec[0]] = (ctrl, k)
+                self.controller.append(group_name)
+
+        else:
+            raise ValueError(f'Unknown valve controller: {self.valve_controller}')
+
+    def _get_ctrl_specs(self):
+        # Valve controllers: name, valve, gain, level, order, tol
+        return [
+            # supply flow control
+            ('tank_ctrl1', 'tank_v1', -3000, 0, 1, 0.25),
+            ('grid_ctrl', 'grid_v1', -3000, 0, 2, 0.25),
+            # load flow control
+            ('bypass_ctrl', 'bypass', -2000, 1, 1, 0.25),
+            ('hex1_ctrl', 'sub_v1', -100, 1, 2, 0.1),
+            ('hex2_ctrl', 'sub_v2', -100, 1, 3, 0.1),
+        ]
+
+    def _set_mdot_setpoint(self, name, setpoint):
+        ctrl, k = self.valve_ctrl[name]
+        if k is None:
+            ctrl.set_mdot_setpoint(setpoint)
+        else:
+            ctrl.set_mdot_setpoint(setpoint, k)
 
     # def _plot(self):
         # plot.simple_plot(self.net, plot_sinks=True, plot_sources=True, sink_size=4.0, source_size=4.0)
@@ -0,0 +1,47 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import hashlib
+import os
+import pickle
+import tempfile
+
+SNAPSHOT_FORMAT = 1  # Increase if the layout of the stored data changes
+
+
+def snapshot_key(params, source_files=()):
+    '''
+    Content address of a network snapshot: hash of the construction parameters and of the source code that
+    builds the network (so that code changes invalidate old snapshots).
+    '''
+    h = hashlib.sha256()
+    h.update(repr((SNAPSHOT_FORMAT, sorted(params.items()))).encode())
+    for path in source_files:
+        with open(path, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+def load_snapshot(cache_dir, key):
+    '''
+    Returns the stored snapshot or None if it does not exist (or cannot be read).
+    '''
+    path = os.path.join(cache_dir, key + '.pkl')
+    try:
+        with open(path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+        return None
+
+
+def save_snapshot(cache_dir, key, data):
+    # Write to a temporary file first, so that concurrent runs never read a partially written snapshot
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, os.path.join(cache_dir, key + '.pkl'))
+    except BaseException:
+        os.remove(tmp_path)
+        raise
@@ -0,0 +1,81 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import warnings
+import numpy as np
+import pandapipes as pp
+from .history import get_result_row
+
+# Network input columns copied to the worker in each step (written by DHNetwork._update and the valve control)
+INPUT_COLUMNS = [
+    ('ext_grid', 't_k'),
+    ('ext_grid', 'p_bar'),
+    ('sink', 'mdot_kg_per_s'),
+    ('source', 'mdot_kg_per_s'),
+    ('heat_exchanger', 'qext_w'),
+    ('valve', 'loss_coefficient'),
+    ('valve', 'opened'),
+]
+
+_net = None  # Network copy of the worker process
+
+
+def _init_worker(net):
+    global _net
+    _net = net
+    warnings.filterwarnings('ignore', category=UserWarning)
+
+
+def _solve_static(time, inputs):
+    '''
+    Runs the static pipeflow for the given network inputs in the worker process.
+    Returns (time, result row, error message).
+    '''
+    net = _net
+    for (table, column), values in inputs.items():
+        net[table][column] = values
+
+    # Start from the previous solution (junctions without a solved temperature keep their initial value)
+    if 'res_junction' in net and len(net.res_junction) == len(net.junction) and \
+            np.all(np.isfinite(net.res_junction['p_bar'].values)):
+        t_k = net.res_junction['t_k'].values
+        net.junction['pn_bar'] = net.res_junction['p_bar'].values
+        net.junction['tfluid_k'] = np.where(np.isfinite(t_k), t_k, net.junction['tfluid_k'].values)
+
+    try:
+        pp.pipeflow(net, transient=False, mode='all', max_iter=100, heat_transfer=True)
+    except Exception as e:
+        return time, None, '%s: %s' % (type(e).__name__, e)
+    return time, get_result_row(net), None
+
+
+class StaticReferenceWorker:
+    '''
+    Computes static pipeflow results in a background process. The worker holds its own copy of the network and is
+    fed with the network inputs of each step (see INPUT_COLUMNS); results are collected in submission order.
+    '''
+
+    def __init__(self, net):
+        self.executor = ProcessPoolExecutor(max_workers=1, initializer=_init_worker, initargs=(net,))
+        self.columns = [(table, column) for table, column in INPUT_COLUMNS
+                        if table in net and column in net[table]]
+        self.pending = deque()
+
+    def submit(self, time, net):
+        inputs = {(table, column): net[table][column].values.copy() for table, column in self.columns}
+        self.pending.append(self.executor.submit(_solve_static, time, inputs))
+
+    def collect(self, wait=False):
+        '''
+        Returns the finished results [(time, row, error)] in submission order. Without wait, collection stops at the
+        first unfinished job.
+        '''
+        results = []
+        while self.pending and (wait or self.pending[0].done()):
+            results.append(self.pending.popleft().result())
+        return results
+
+    def close(self):
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,90 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import numpy as np
+import pandas as pd
+from .history import HistoryBuffer
+
+# Outcome of the hydraulic stage of a step ('hydraulics' column)
+HYDRAULICS_SKIPPED = 0  # Frozen mass flows (decoupled solve)
+HYDRAULICS_CACHED = 1  # Restored from the hydraulic cache
+HYDRAULICS_SOLVED = 2  # Valve control loop was run
+
+STEP_COLUMNS = ['time', 'hydraulics', 'converged', 'ctrl_iterations', 'pipeflow_calls', 'newton_iterations',
+                'newton_iterations_T']
+
+
+class ConvergenceLog:
+    '''
+    Per-step convergence telemetry of a DHNetwork: outcome of the hydraulic stage, valve control iterations,
+    pipeflow calls and Newton iterations (hydraulic and thermal) plus the final mass flow error and the
+    iteration count of each valve controller.
+
+    Rows are numbered consecutively (same-time loops get one row each), the data is kept in a HistoryBuffer.
+    Exceptions raised by the control loop are kept in errors as (row, time, message).
+    '''
+
+    def __init__(self, valve_names, capacity=1024):
+        self.valve_names = list(valve_names)
+        columns = STEP_COLUMNS + ['mdot_err_' + name for name in self.valve_names] + \
+            ['i_' + name for name in self.valve_names]
+        self.buffer = HistoryBuffer(columns, capacity=capacity)
+        self.errors = []
+        self._row = np.empty(len(columns))
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def append(self, time, hydraulics, converged, ctrl_iterations, pipeflow_calls, newton_iterations,
+               newton_iterations_T, mdot_err, ctrl_i):
+        n = len(STEP_COLUMNS)
+        m = len(self.valve_names)
+        row = self._row
+        row[:n] = (time, hydraulics, converged, ctrl_iterations, pipeflow_calls, newton_iterations,
+                   newton_iterations_T)
+        row[n:n + m] = mdot_err
+        row[n + m:] = ctrl_i
+        self.buffer.append(len(self.buffer), row)
+
+    def add_error(self, time, error):
+        self.errors.append((len(self.buffer), time, '%s: %s' % (type(error).__name__, error)))
+
+    def to_frame(self):
+        frame = self.buffer.to_frame()
+        frame.index = frame.index.astype(int)
+        frame.index.name = 'row'
+        return frame
+
+    def get_summary(self):
+        '''
+        Returns aggregated statistics: steps, solved/cached/skipped hydraulic stages, non-converged runs,
+        mean and max. control iterations of the solved runs, Newton iterations and the largest final mass flow
+        error per valve.
+        '''
+        frame = self.to_frame()
+        solved = frame[frame['hydraulics'] == HYDRAULICS_SOLVED]
+        err_cols = ['mdot_err_' + name for name in self.valve_names]
+        return {
+            'steps': len(frame),
+            'solved': len(solved),
+            'cached': int((frame['hydraulics'] == HYDRAULICS_CACHED).sum()),
+            'skipped': int((frame['hydraulics'] == HYDRAULICS_SKIPPED).sum()),
+            'not_converged': int((solved['converged'] == 0).sum()),
+            'mean_ctrl_iterations': solved['ctrl_iterations'].mean() if len(solved) else float('nan'),
+            'max_ctrl_iterations': int(solved['ctrl_iterations'].max()) if len(solved) else 0,
+            'newton_iterations': int(frame['newton_iterations'].sum()),
+            'newton_iterations_T': int(frame['newton_iterations_T'].sum()),
+            'max_abs_mdot_err': dict(zip(self.valve_names, frame[err_cols].abs().max().values)),
+        }
+
+    def to_hdf(self, store_name, key):
+        '''
+        Writes the log to the HDF5 store store_name (frame <key>, errors <key>_errors).
+        '''
+        store = pd.HDFStore(store_name)
+        try:
+            store[key] = self.to_frame()
+            if self.errors:
+                store[key + '_errors'] = pd.DataFrame(self.errors, columns=['row', 'time', 'error'])
+        finally:
+            store.close()
@@ -0,0 +1,143 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+from dataclasses import dataclass
+import numpy as np
+
+
+@dataclass
+class PipeLevel:
+    '''
+    Pipes whose inlet junctions share the same topological level, together with the elements they supply.
+    '''
+    pipes: np.ndarray  # Pipes of this level
+    junctions: np.ndarray  # Junctions whose last feeding pipe is in this level (directly or via opened valves)
+    mix_pipes: np.ndarray  # All pipes feeding these junctions (this or earlier levels) ...
+    mix_slot: np.ndarray  # ... and the position of the fed junction in 'junctions'
+    hexes: np.ndarray  # Heat exchangers supplied by these junctions
+
+
+class TopologyIndex:
+    '''
+    Integer incidence arrays of a pandapipes network (pipe, valve and heat exchanger -> junction).
+
+    All element indices are positions in the respective pandapipes tables. Pipes and opened valves are oriented
+    along the solved mass flow (inlet -> outlet), the pipes are ordered by a topological sort of the resulting
+    flow graph. The adjacency lists used by the dynamic temperature flow calculation are derived once from these
+    arrays and only have to be rebuilt when the opened state of a valve or a flow direction changes
+    (see is_outdated).
+    '''
+
+    def __init__(self, net):
+        self.build(net)
+
+    def build(self, net):
+        # Incidence arrays
+        self.pipe_from = net.pipe['from_junction'].values.astype(int)
+        self.pipe_to = net.pipe['to_junction'].values.astype(int)
+        self.valve_from = net.valve['from_junction'].values.astype(int)
+        self.valve_to = net.valve['to_junction'].values.astype(int)
+        self.valve_opened = net.valve['opened'].values.astype(bool)
+        self.hex_from = net.heat_exchanger['from_junction'].values.astype(int)
+        self.hex_to = net.heat_exchanger['to_junction'].values.astype(int)
+        self.n_junction = len(net.junction)
+
+        # Orientation along the solved mass flow (True: from -> to)
+        self.pipe_forward = self._flow_direction(net, 'pipe')
+        self.valve_forward = self._flow_direction(net, 'valve')
+
+        self.pipe_in = np.where(self.pipe_forward, self.pipe_from, self.pipe_to)
+        self.pipe_out = np.where(self.pipe_forward, self.pipe_to, self.pipe_from)
+        valve_in = np.where(self.valve_forward, self.valve_from, self.valve_to)[self.valve_opened]
+        valve_out = np.where(self.valve_forward, self.valve_to, self.valve_from)[self.valve_opened]
+
+        # Junctions supplied by each pipe (pipe outlet plus junctions behind opened valves)
+        self.pipe_out_junctions = [
+            np.concatenate(([j], valve_out[valve_in == j])) for j in self.pipe_out
+        ]
+
+        # Heat exchangers supplied by each pipe
+        self.pipe_out_hex = [
+            np.flatnonzero(np.isin(self.hex_from, junctions)) for junctions in self.pipe_out_junctions
+        ]
+
+        # Pipes feeding each junction (directly or via opened valves)
+        self.junction_pipes_in = [
+            np.flatnonzero(np.isin(self.pipe_out, np.concatenate(([j], valve_in[valve_out == j]))))
+            for j in range(self.n_junction)
+        ]
+
+        # Pipes leaving the return side of each heat exchanger
+        self.hex_pipes_out = [np.flatnonzero(self.pipe_in == j) for j in self.hex_to]
+
+        # Processing order of the pipes (upstream first)
+        edges_in = np.concatenate((self.pipe_in, valve_in, self.hex_from))
+        edges_out = np.concatenate((self.pipe_out, valve_out, self.hex_to))
+        self.junction_level = self._sort_junctions(edges_in, edges_out)
+        self.pipe_order = np.argsort(self.junction_level[self.pipe_in], kind='stable')
+
+        # Pipes grouped by the level of their inlet junction (upstream first)
+        pipe_level = self.junction_level[self.pipe_in][self.pipe_order]
+        boundaries = np.flatnonzero(np.diff(pipe_level)) + 1
+        groups = [pipes for pipes in np.split(self.pipe_order, boundaries) if len(pipes)]
+
+        # Each junction is mixed once, in the level of its last feeding pipe (all feeding pipes are computed then)
+        pipe_group = np.zeros(len(self.pipe_in), dtype=int)
+        for g, pipes in enumerate(groups):
+            pipe_group[pipes] = g
+        self.junction_group = np.array([pipe_group[p].max(initial=-1) for p in self.junction_pipes_in], dtype=int)
+        self.levels = [self._build_level(pipes, g) for g, pipes in enumerate(groups)]
+
+    def is_outdated(self, net):
+        '''
+        True if the opened state of any valve or the flow direction of any pipe or valve differs from the state
+        the index was built with.
+        '''
+        return not (np.array_equal(net.valve['opened'].values.astype(bool), self.valve_opened)
+                    and np.array_equal(self._flow_direction(net, 'pipe'), self.pipe_forward)
+                    and np.array_equal(self._flow_direction(net, 'valve'), self.valve_forward))
+
+    @staticmethod
+    def _flow_direction(net, element):
+        res = net['res_' + element] if 'res_' + element in net else None
+        if res is None or len(res) != len(net[element]) or 'mdot_from_kg_per_s' not in res:
+            # No results available (yet), assume flow in the defined direction
+            return np.ones(len(net[element]), dtype=bool)
+        return ~(np.nan_to_num(res['mdot_from_kg_per_s'].values) < 0)
+
+    def _build_level(self, pipes, group):
+        junctions = np.unique(np.concatenate([self.pipe_out_junctions[p] for p in pipes]))
+        junctions = junctions[self.junction_group[junctions] == group]
+        mix_pipes = [self.junction_pipes_in[j] for j in junctions]
+        mix_slot = np.repeat(np.arange(len(junctions)), [len(m) for m in mix_pipes])
+        hexes = np.unique(np.concatenate([self.pipe_out_hex[p] for p in pipes])).astype(int)
+        hexes = hexes[self.junction_group[self.hex_from[hexes]] == group]
+        return PipeLevel(pipes=pipes, junctions=junctions, mix_pipes=np.concatenate(mix_pipes + [[]]).astype(int),
+                         mix_slot=mix_slot, hexes=hexes)
+
+    def _sort_junctions(self, edges_in, edges_out):
+        '''
+        Topological sort of the junctions along the directed flow edges (Kahn's algorithm).
+        Returns the level of each junction, i.e., the length of the longest flow path leading to it.
+        Junctions on flow cycles (only possible for inconsistent results) are placed after all other junctions.
+        '''
+        n = self.n_junction
+        in_degree = np.bincount(edges_out, minlength=n)
+        successors = [[] for _ in range(n)]
+        for j_in, j_out in zip(edges_in, edges_out):
+            successors[j_in].append(j_out)
+
+        level = np.zeros(n, dtype=int)
+        visited = np.zeros(n, dtype=bool)
+        queue = list(np.flatnonzero(in_degree == 0))
+        while queue:
+            j = queue.pop()
+            visited[j] = True
+            for k in successors[j]:
+                level[k] = max(level[k], level[j] + 1)
+                in_degree[k] -= 1
+                if in_degree[k] == 0:
+                    queue.append(k)
+
+        level[~visited] = level.max(initial=0) + 1
+        return level
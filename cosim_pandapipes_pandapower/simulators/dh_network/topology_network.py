@@ -0,0 +1,319 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import os
+import json
+from dataclasses import dataclass
+from typing import Dict
+import numpy as np
+import pandas as pd
+import pandapipes as pp
+from .simulator import DHNetwork, NETWORK_SOURCES
+
+# Topology tables: required columns and default values of the optional columns
+# (temperatures in degC, pressures in bar, heat in kW, mass flows in kg/s; None: use the DHNetwork parameter)
+TOPOLOGY_TABLES = {
+    'junctions': (['name'], {'pn_bar': None, 'tfluid_c': None, 'x': np.nan, 'y': np.nan}),
+    'pipes': (['name', 'from_junction', 'to_junction', 'length_km'],
+              {'diameter_m': 0.1, 'k_mm': 0.01, 'sections': 1, 'alpha_w_per_m2k': 1.5, 'text_c': None}),
+    'valves': (['name', 'from_junction', 'to_junction'],
+               {'diameter_m': 0.1, 'loss_coefficient': 1000, 'opened': True, 'mdot_set': np.nan, 'gain': -2000,
+                'tol': 0.25}),
+    'consumers': (['name', 'supply_junction', 'return_junction'],
+                  {'diameter_m': 0.1, 'Qdot_kw': 0, 'mdot_set': 0, 'gain': -100, 'tol': 0.1}),
+    'feed_ins': (['name', 'supply_junction', 'return_junction'],
+                 {'p_bar': None, 't_supply_c': None, 'mdot_set': np.nan, 'connect_junction': None, 'diameter_m': 0.1,
+                  'gain': -3000, 'tol': 0.25}),
+}
+
+
+def load_topology(path):
+    '''
+    Reads a district heating network description from a JSON file ({table: [{column: value, ...}, ...]}) or from a
+    directory with one CSV file per table (junctions.csv, pipes.csv, valves.csv, consumers.csv, feed_ins.csv).
+
+    Tables:
+        junctions: name, [pn_bar, tfluid_c, x, y]
+        pipes: name, from_junction, to_junction, length_km, [diameter_m, k_mm, sections, alpha_w_per_m2k, text_c]
+        valves: name, from_junction, to_junction, [diameter_m, loss_coefficient, opened, mdot_set, gain, tol]
+            Valves with mdot_set are flow controlled and count as consumption (e.g., bypasses).
+        consumers: name, supply_junction, return_junction, [diameter_m, Qdot_kw, mdot_set, gain, tol]
+            Each consumer is connected by a control valve and a heat exchanger. The return junction should only
+            connect the heat exchanger to the return pipe (its temperature is the consumer return temperature).
+        feed_ins: name, supply_junction, return_junction, [p_bar, t_supply_c, mdot_set, connect_junction, ...]
+            External grid with fixed pressure and supply temperature plus a return mass flow sink. Exactly one feed-in
+            has no mdot_set and balances the mass flows. With connect_junction the feed-in is connected by a
+            flow controlled valve (supply_junction -> connect_junction).
+
+    Junctions are referenced by name. Returns {table: pd.DataFrame} with the optional columns filled.
+    '''
+    if os.path.isdir(path):
+        raw = {}
+        for table in TOPOLOGY_TABLES:
+            csv_path = os.path.join(path, table + '.csv')
+            raw[table] = pd.read_csv(csv_path) if os.path.exists(csv_path) else pd.DataFrame()
+    else:
+        with open(path) as f:
+            raw = json.load(f)
+
+    return make_topology(raw)
+
+
+def make_topology(raw):
+    '''
+    Checks a topology description ({table: pd.DataFrame or list of rows}, see load_topology) and fills the
+    optional columns.
+    '''
+    raw = {table: pd.DataFrame(rows) for table, rows in raw.items()}
+    unknown = set(raw) - set(TOPOLOGY_TABLES)
+    if unknown:
+        raise ValueError(f'Unknown topology tables: {sorted(unknown)}')
+
+    tables = {}
+    for table, (required, defaults) in TOPOLOGY_TABLES.items():
+        df = raw.get(table, pd.DataFrame())
+        missing = [col for col in required if col not in df] if len(df) else []
+        if missing:
+            raise ValueError(f'Topology table {table} is missing the columns {missing}')
+        df = df.reindex(columns=list(dict.fromkeys(required + list(defaults) + list(df.columns))))
+        for col, default in defaults.items():
+            if default is not None:
+                df[col] = df[col].fillna(default)
+        tables[table] = df.reset_index(drop=True)
+
+    names = [name for table in ['junctions', 'valves', 'consumers', 'feed_ins'] for name in tables[table]['name']]
+    if len(names) != len(set(names)):
+        raise ValueError('Names of junctions, valves, consumers and feed-ins have to be unique')
+    if len(tables['consumers']) == 0:
+        raise ValueError('Topology has no consumers')
+    if np.count_nonzero(tables['feed_ins']['mdot_set'].isna()) != 1:
+        raise ValueError('Exactly one feed-in without mdot_set (balancing feed-in) is required')
+
+    return tables
+
+
+@dataclass
+class TopologyDHNetwork(DHNetwork):
+    '''
+    Pandapipes district heating network built from a topology description (see load_topology) instead of the
+    fixed benchmark topology. Controllers and the output mapping are generated from the description, inputs and
+    outputs are arrays with one entry per consumer / feed-in (ordered as in the description).
+    '''
+
+    topology_file: str = None  # JSON file or directory with CSV files
+    tables: Dict[str, pd.DataFrame] = None  # Topology description (alternative to topology_file)
+
+    # Input
+    Qdot_cons: np.ndarray = None  # Heat consumption per consumer [kW]
+    mdot_cons_set: np.ndarray = None  # Mass flow setpoint per consumer [kg/s]
+    T_feed_in: np.ndarray = None  # Supply temperature per feed-in [degC]
+    mdot_feed_in_set: np.ndarray = None  # Mass flow setpoint per feed-in (nan: balancing feed-in) [kg/s]
+    mdot_valve_set: np.ndarray = None  # Mass flow setpoint per flow controlled valve [kg/s]
+
+    # Output
+    T_supply_cons: np.ndarray = None  # Supply temperature per consumer [degC]
+    T_return_cons: np.ndarray = None  # Return temperature per consumer [degC]
+    mdot_cons: np.ndarray = None  # Mass flow per consumer [kg/s]
+    T_return_feed_in: np.ndarray = None  # Return temperature per feed-in [degC]
+    mdot_feed_in: np.ndarray = None  # Mass flow supplied per feed-in [kg/s]
+
+    # Network utils
+    consumers: list = None
+    feed_ins: list = None
+
+    def __post_init__(self):
+        if self.tables is None:
+            if self.topology_file is None:
+                raise ValueError('TopologyDHNetwork requires a topology_file or tables')
+            self.tables = load_topology(self.topology_file)
+
+        consumers = self.tables['consumers']
+        feed_ins = self.tables['feed_ins']
+        valves = self.tables['valves']
+        self.consumers = consumers['name'].tolist()
+        self.feed_ins = feed_ins['name'].tolist()
+        self.ctrl_valves = valves['name'][valves['mdot_set'].notna()].tolist()
+
+        self.Qdot_cons = consumers['Qdot_kw'].values.astype(float)
+        self.mdot_cons_set = consumers['mdot_set'].values.astype(float)
+        self.T_feed_in = feed_ins['t_supply_c'].fillna(self.T_supply_grid).values.astype(float)
+        self.mdot_feed_in_set = feed_ins['mdot_set'].values.astype(float)
+        self.mdot_valve_set = valves['mdot_set'].dropna().values.astype(float)
+        self.balancing = int(np.flatnonzero(np.isnan(self.mdot_feed_in_set))[0])
+
+        self.T_supply_cons = np.full(len(self.consumers), np.nan)
+        self.T_return_cons = np.full(len(self.consumers), np.nan)
+        self.mdot_cons = self.mdot_cons_set.copy()
+        self.T_return_feed_in = np.full(len(self.feed_ins), np.nan)
+        self.mdot_feed_in = np.zeros(len(self.feed_ins))
+
+        super().__post_init__()
+
+    def _get_network_params(self):
+        params = super()._get_network_params()
+        params['tables'] = {table: df.to_csv() for table, df in self.tables.items()}
+        return params
+
+    def _get_network_sources(self):
+        return NETWORK_SOURCES + [__file__]
+
+    def _create_network(self):
+        # create empty network
+        self.net = pp.create_empty_network('net', add_stdtypes=False)
+
+        # create fluid
+        pp.create_fluid_from_lib(self.net, 'water', overwrite=True)
+
+        self._create_junctions()
+        self._create_pipes()
+        self._create_valves()
+        self._create_substations()
+        self._create_feed_ins()
+        self._create_flow_control()
+
+    def _create_junctions(self):
+        net = self.net
+        for row in self.tables['junctions'].itertuples():
+            pn_bar = self.P_grid_bar if pd.isna(row.pn_bar) else row.pn_bar
+            tfluid_c = self.T_supply_grid if pd.isna(row.tfluid_c) else row.tfluid_c
+            geodata = None if pd.isna(row.x) or pd.isna(row.y) else (row.x, row.y)
+            pp.create_junction(net, pn_bar=pn_bar, tfluid_k=273.15 + tfluid_c, name=row.name, geodata=geodata)
+
+        self.junction = net.junction['name'].tolist()
+
+    def _create_pipes(self):
+        net = self.net
+        j = self.junction
+        for row in self.tables['pipes'].itertuples():
+            text_c = self.T_amb if pd.isna(row.text_c) else row.text_c
+            pp.create_pipe_from_parameters(net, from_junction=j.index(row.from_junction),
+                                           to_junction=j.index(row.to_junction), length_km=row.length_km,
+                                           diameter_m=row.diameter_m, k_mm=row.k_mm, sections=int(row.sections),
+                                           alpha_w_per_m2k=row.alpha_w_per_m2k, text_k=273.15 + text_c,
+                                           name=row.name)
+
+        self.pipe = net.pipe['name'].tolist()
+
+    def _create_valves(self):
+        net = self.net
+        j = self.junction
+        for row in self.tables['valves'].itertuples():
+            pp.create_valve(net, j.index(row.from_junction), j.index(row.to_junction), diameter_m=row.diameter_m,
+                            opened=bool(row.opened), loss_coefficient=row.loss_coefficient, name=row.name)
+
+        self.valve = net.valve['name'].tolist() if 'valve' in net else []
+
+    def _create_substations(self):
+        # control valve (supply junction -> <name>_s) and heat exchanger (<name>_s -> return junction) per consumer
+        net = self.net
+        j = self.junction
+        for row in self.tables['consumers'].itertuples():
+            inlet = pp.create_junction(net, pn_bar=self.P_grid_bar, tfluid_k=273.15 + self.T_supply_grid,
+                                       name=row.name + '_s')
+            pp.create_valve(net, j.index(row.supply_junction), inlet, diameter_m=row.diameter_m, opened=True,
+                            loss_coefficient=1000, name=row.name + '_v')
+            pp.create_heat_exchanger(net, from_junction=inlet, to_junction=j.index(row.return_junction),
+                                     diameter_m=row.diameter_m, qext_w=row.Qdot_kw * 1000, name=row.name + '_hex')
+
+        self.junction = net.junction['name'].tolist()
+        self.valve = net.valve['name'].tolist()
+        self.heat_exchanger = net.heat_exchanger['name'].tolist()
+
+    def _create_feed_ins(self):
+        net = self.net
+        j = self.junction
+        for row in self.tables['feed_ins'].itertuples():
+            p_bar = self.P_grid_bar if pd.isna(row.p_bar) else row.p_bar
+            t_supply_c = self.T_supply_grid if pd.isna(row.t_supply_c) else row.t_supply_c
+            mdot_init = 0 if pd.isna(row.mdot_set) else row.mdot_set
+
+            pp.create_ext_grid(net, junction=j.index(row.supply_junction), p_bar=p_bar, t_k=273.15 + t_supply_c,
+                               name=row.name, type='pt')
+            pp.create_sink(net, junction=j.index(row.return_junction), mdot_kg_per_s=mdot_init,
+                           name=row.name + '_sink')
+            if not pd.isna(row.connect_junction):
+                pp.create_valve(net, j.index(row.supply_junction), j.index(row.connect_junction),
+                                diameter_m=row.diameter_m, opened=True, loss_coefficient=1000, name=row.name + '_v')
+
+        self.valve = net.valve['name'].tolist()
+        self.sink = net.sink['name'].tolist()
+        self.source = net.ext_grid['name'].tolist()
+
+    def _get_ctrl_specs(self):
+        # Valve controllers: name, valve, gain, level, order, tol
+        specs = []
+
+        # supply flow control
+        feed_ins = self.tables['feed_ins']
+        for row in feed_ins[feed_ins['connect_junction'].notna()].itertuples():
+            specs.append((row.name + '_ctrl', row.name + '_v', row.gain, 0, len(specs), row.tol))
+
+        # load flow control (flow controlled valves and consumers)
+        order = 0
+        valves = self.tables['valves']
+        for row in valves[valves['mdot_set'].notna()].itertuples():
+            specs.append((row.name + '_ctrl', row.name, row.gain, 1, order, row.tol))
+            order += 1
+        for row in self.tables['consumers'].itertuples():
+            specs.append((row.name + '_ctrl', row.name + '_v', row.gain, 1, order, row.tol))
+            order += 1
+
+        return specs
+
+    def _init_element_index(self):
+        j = self.junction
+        v = self.valve
+        idx = self.idx
+        consumers = self.tables['consumers']
+        feed_ins = self.tables['feed_ins']
+
+        idx['cons_valve'] = np.array([v.index(name + '_v') for name in self.consumers], dtype=int)
+        idx['cons_hex'] = np.array([self.heat_exchanger.index(name + '_hex') for name in self.consumers], dtype=int)
+        idx['cons_supply'] = np.array([j.index(name + '_s') for name in self.consumers], dtype=int)
+        idx['cons_return'] = np.array([j.index(name) for name in consumers['return_junction']], dtype=int)
+        idx['feed_ext_grid'] = np.array([self.source.index(name) for name in self.feed_ins], dtype=int)
+        idx['feed_sink'] = np.array([self.sink.index(name + '_sink') for name in self.feed_ins], dtype=int)
+        idx['feed_return'] = np.array([j.index(name) for name in feed_ins['return_junction']], dtype=int)
+
+        # Controllers of the setpoints (in the order of mdot_cons_set, mdot_feed_in_set, mdot_valve_set)
+        self.cons_ctrl = [name + '_ctrl' for name in self.consumers]
+        self.feed_in_ctrl = [name + '_ctrl' if name + '_ctrl' in self.valve_ctrl else None for name in self.feed_ins]
+        self.valve_ctrl_names = [name + '_ctrl' for name in self.ctrl_valves]
+
+    def _get_feed_in_mdot(self):
+        # The balancing feed-in supplies the consumption not covered by the other feed-ins
+        mdot = self.mdot_feed_in_set.copy()
+        mdot[self.balancing] = 0
+        mdot[self.balancing] = self.mdot_cons_set.sum() + self.mdot_valve_set.sum() - mdot.sum()
+        return mdot
+
+    def _update(self):
+        net = self.net
+        idx = self.idx
+        mdot_feed_in = self._get_feed_in_mdot()
+
+        # Update controller(s)
+        for name, setpoint in zip(self.cons_ctrl, self.mdot_cons_set):
+            self._set_mdot_setpoint(name, setpoint)
+        for name, setpoint in zip(self.valve_ctrl_names, self.mdot_valve_set):
+            self._set_mdot_setpoint(name, setpoint)
+        for name, setpoint in zip(self.feed_in_ctrl, mdot_feed_in):
+            if name is not None:
+                self._set_mdot_setpoint(name, setpoint)
+
+        # Update feed-ins and load
+        net.sink.loc[idx['feed_sink'], 'mdot_kg_per_s'] = mdot_feed_in
+        net.ext_grid.loc[idx['feed_ext_grid'], 't_k'] = self.T_feed_in + 273.15
+        net.heat_exchanger.loc[idx['cons_hex'], 'qext_w'] = self.Qdot_cons * 1000
+
+    def _set_outputs(self):
+        idx = self.idx
+        t_k = self.net.res_junction['t_k'].values
+        self.T_supply_cons = np.round(t_k[idx['cons_supply']] - 273.15, 2)
+        self.T_return_cons = np.round(t_k[idx['cons_return']] - 273.15, 2)
+        self.T_return_feed_in = np.round(t_k[idx['feed_return']] - 273.15, 2)
+        self.mdot_cons = np.round(self.net.res_valve['mdot_from_kg_per_s'].values[idx['cons_valve']], 2)
+        self.mdot_feed_in = np.round(-self.net.res_ext_grid['mdot_kg_per_s'].values[idx['feed_ext_grid']], 2)
+
+    def _get_mdot_setpoints(self):
+        return np.concatenate((self.mdot_cons_set, self._get_feed_in_mdot(), self.mdot_valve_set))
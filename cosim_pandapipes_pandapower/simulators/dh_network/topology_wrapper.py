@@ -0,0 +1,165 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+from itertools import count
+from .topology_network import TopologyDHNetwork
+from mosaik_api import Simulator
+from typing import Dict
+
+META = {
+    'type': 'time-based',
+    'models': {
+        'DHTopologyNetwork': {
+            'public': True,
+            'params': [
+                'topology_file',  # JSON file or directory with CSV files (see load_topology)
+                'T_amb',  # Ambient ground temperature
+                'T_supply_grid',  # Default supply temperature of the feed-ins
+                'P_grid_bar',  # Default pressure of the feed-ins
+                'dynamic_temp_flow_enabled',
+                'warm_start_pipeflow',
+                'valve_control_mode',
+                'valve_controller',
+                'decoupled_solve',
+                'hydraulic_tol',
+                'hydraulic_cache_size',
+                'hydraulic_cache_tol',
+                'network_cache_dir',
+                'log_full_history',
+                'temp_flow_sections',
+                'profile_phases',
+                'log_convergence',
+                ],
+            'attrs': [],
+            },
+        'DHConsumer': {
+            'public': False,
+            'params': [],
+            'attrs': [
+                # Input
+                'Qdot',  # Heat consumption [kW]
+                'mdot_set',  # Mass flow setpoint [kg/s]
+                # Output
+                'T_supply',  # Supply temperature [degC]
+                'T_return',  # Return temperature [degC]
+                'mdot',  # Mass flow [kg/s]
+                ],
+            },
+        'DHFeedIn': {
+            'public': False,
+            'params': [],
+            'attrs': [
+                # Input
+                'T_supply',  # Supply temperature [degC]
+                'mdot_set',  # Mass flow setpoint [kg/s] (ignored for the balancing feed-in)
+                # Output
+                'T_return',  # Return temperature [degC]
+                'mdot',  # Mass flow supplied [kg/s]
+                ],
+            },
+        },
+    }
+
+# Entity attribute -> TopologyDHNetwork array
+CONSUMER_ATTRS = {'Qdot': 'Qdot_cons', 'mdot_set': 'mdot_cons_set', 'T_supply': 'T_supply_cons',
+                  'T_return': 'T_return_cons', 'mdot': 'mdot_cons'}
+FEED_IN_ATTRS = {'T_supply': 'T_feed_in', 'mdot_set': 'mdot_feed_in_set', 'T_return': 'T_return_feed_in',
+                 'mdot': 'mdot_feed_in'}
+INPUT_ATTRS = {'DHConsumer': {'Qdot', 'mdot_set'}, 'DHFeedIn': {'T_supply', 'mdot_set'}}
+# Inputs summed over multiple connections (heat and mass flows), all other inputs accept a single connection
+ADDITIVE_ATTRS = {'Qdot', 'mdot_set'}
+
+
+class DHTopologySimulator(Simulator):
+    '''
+    Mosaik simulator for district heating networks loaded from a topology description. Each network entity has one
+    child entity per consumer (DHConsumer) and per feed-in (DHFeedIn), named <network eid>.<name>.
+    Mass flows are positive in the direction of consumption (feed-in: supplied to the network).
+    '''
+
+    step_size = 10
+    eid_prefix = ''
+    convergence_log_file = None
+
+    def __init__(self, META=META):
+        super().__init__(META)
+
+        self.eid_counters = {}
+        self.simulators: Dict[str, TopologyDHNetwork] = {}
+        self.children = {}  # child eid -> (network eid, model, position)
+
+    def init(self, sid, time_resolution, step_size=10, eid_prefix='DHTopologyNetwork', convergence_log_file=None):
+        self.step_size = step_size
+        self.eid_prefix = eid_prefix
+        self.convergence_log_file = convergence_log_file  # HDF5 store for the convergence logs (frame per entity)
+
+        return self.meta
+
+    def create(self, num, model, **model_params):
+        if model != 'DHTopologyNetwork':
+            raise ValueError(f'DHTopologySimulator cannot create {model} entities directly.')
+
+        counter = self.eid_counters.setdefault(model, count())
+        entities = []
+
+        for _ in range(num):
+            eid = '%s_%s' % (self.eid_prefix, next(counter))
+            esim = TopologyDHNetwork(**model_params)
+            self.simulators[eid] = esim
+
+            children = []
+            for child_model, names in [('DHConsumer', esim.consumers), ('DHFeedIn', esim.feed_ins)]:
+                for k, name in enumerate(names):
+                    child_eid = '%s.%s' % (eid, name)
+                    self.children[child_eid] = (eid, child_model, k)
+                    children.append({'eid': child_eid, 'type': child_model})
+
+            entities.append({'eid': eid, 'type': model, 'children': children})
+
+        return entities
+
+    def step(self, time, inputs, max_advance):
+        for child_eid, data in inputs.items():
+            eid, model, k = self._get_child(child_eid)
+            esim = self.simulators[eid]
+            for attr, incoming in data.items():
+                if attr not in INPUT_ATTRS[model]:
+                    raise AttributeError(f'DHTopologySimulator {child_eid} has no input attribute {attr}.')
+                if attr not in ADDITIVE_ATTRS and 1 != len(incoming):
+                    raise RuntimeError(f'DHTopologySimulator does not support multiple inputs for {attr}')
+                values = [value for value in incoming.values() if value is not None]
+                if values:
+                    self._get_array(esim, model, attr)[k] = sum(values)
+
+        for esim in self.simulators.values():
+            esim.step_single(time)
+
+        return time + self.step_size
+
+    def get_data(self, outputs):
+        data = {}
+        for child_eid, attrs in outputs.items():
+            eid, model, k = self._get_child(child_eid)
+            esim = self.simulators[eid]
+            data[child_eid] = {attr: float(self._get_array(esim, model, attr)[k]) for attr in attrs}
+        return data
+
+    def finalize(self):
+        for eid, esim in self.simulators.items():
+            esim.close()
+        if self.convergence_log_file:
+            for eid, esim in self.simulators.items():
+                if esim.convergence_log is not None:
+                    esim.convergence_log.to_hdf(self.convergence_log_file, '%s_convergence' % eid)
+
+    def _get_child(self, child_eid):
+        if child_eid not in self.children:
+            raise ValueError(f'Unknown entity {child_eid} (only consumer and feed-in entities have attributes).')
+        return self.children[child_eid]
+
+    @staticmethod
+    def _get_array(esim, model, attr):
+        attrs = CONSUMER_ATTRS if model == 'DHConsumer' else FEED_IN_ATTRS
+        if attr not in attrs:
+            raise AttributeError(f'{model} has no attribute {attr}.')
+        return getattr(esim, attrs[attr])
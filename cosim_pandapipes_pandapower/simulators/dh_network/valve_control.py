@@ -11,10 +11,14 @@ from simple_pid import PID
 class CtrlValve(control.basic_controller.Controller):
     """
     Example class of a Valve-Controller. Models an abstract control valve.
+
+    With update='pid' the loss coefficient is adjusted with a fixed gain. With update='secant' the gain is
+    adapted in each iteration from the slope d(mdot)/d(loss_coeff) estimated from the last two iterations. The
+    secant step is damped and bounded, the fixed gain is used as fallback (first iteration, invalid slope).
     """
 
     def __init__(self, net, gid, data_source=None, profile_name=None, in_service=True, enable_plotting=False,
-                 mdot_set_kg_per_s=0, gain=-1000,
+                 mdot_set_kg_per_s=0, gain=-1000, update='pid', damping=0.8, max_rel_step=1.0, min_step=10.,
                  recycle=True, order=0, level=0, tol=0, **kwargs):
         super().__init__(net, in_service=in_service, recycle=recycle, order=order, level=level,
                          initial_powerflow=True, **kwargs)
@@ -38,6 +42,15 @@ class CtrlValve(control.basic_controller.Controller):
         self.tolerance = tol  # absolute tolerance
         self.i = 0
 
+        # adaptive gain (secant update)
+        if update not in ('pid', 'secant'):
+            raise ValueError(f'Unknown valve update method: {update}')
+        self.update = update
+        self.damping = damping  # damping factor of the secant step
+        self.max_rel_step = max_rel_step  # max. change of loss_coeff per iteration (relative) ...
+        self.min_step = min_step  # ... but at least this (absolute)
+        self._last_point = None  # (loss_coeff, mdot) of the previous iteration
+
         # profile attributes
         self.data_source = data_source
         self.profile_name = profile_name
@@ -58,6 +71,7 @@ class CtrlValve(control.basic_controller.Controller):
         """
         self.pid.setpoint = self.mdot_set_kg_per_s
         self.i = 0
+        self._last_point = None
 
         # # clear plot
         # if self.enable_plotting == True:
@@ -131,8 +145,11 @@ class CtrlValve(control.basic_controller.Controller):
         mdot_set = self.mdot_set_kg_per_s
 
         # set valve position
-        # PID control
-        output = self.pid(mdot)
+        if self.update == 'secant':
+            output = self._secant_step(mdot, mdot_set)
+        else:
+            # PID control
+            output = self.pid(mdot)
         self.loss_coeff += output
 
         # Validate limits of loss_coeff
@@ -149,6 +166,23 @@ class CtrlValve(control.basic_controller.Controller):
         self.i += 1
         # print(f'Next loss coeff of {self.name} is y{self.i} = {self.loss_coeff}')
 
+    def _secant_step(self, mdot, mdot_set):
+        step = None
+        if self._last_point is not None:
+            loss_coeff_last, mdot_last = self._last_point
+            d_loss_coeff = self.loss_coeff - loss_coeff_last
+            if d_loss_coeff != 0:
+                slope = (mdot - mdot_last) / d_loss_coeff
+                if slope < 0:  # mass flow has to decrease with increasing loss coefficient
+                    step = self.damping * (mdot_set - mdot) / slope
+        if step is None:
+            step = self.pid(mdot)
+        self._last_point = (self.loss_coeff, mdot)
+
+        # Bound step
+        max_step = max(self.max_rel_step * self.loss_coeff, self.min_step)
+        return float(np.clip(step, -max_step, max_step))
+
     # In a time-series simulation the battery should read new power values from a profile and keep track
     # of its state of charge as depicted below.
     def time_step(self, net, time):
@@ -165,6 +199,10 @@ class CtrlValve(control.basic_controller.Controller):
         if self.profile_name is None:
             self.mdot_set_kg_per_s = setpoint
 
+    def read_from_net(self, net):
+        self.loss_coeff = net.valve.at[self.gid, 'loss_coefficient']
+        self.opened = net.valve.at[self.gid, 'opened']
+
     # def update_plot(self, net):
         # loss_coeff = self.loss_coeff
 
@@ -182,4 +220,229 @@ class CtrlValve(control.basic_controller.Controller):
         # self.line.set_ydata(self.ydata)
         # plt.draw()
         # plt.pause(1e-17)
-        # # time.sleep(0.1)
\ No newline at end of file
+        # # time.sleep(0.1)
+
+
+class CtrlValveGroup(control.basic_controller.Controller):
+    """
+    Vectorized version of CtrlValve controlling several valves with one controller object. Setpoints, gains,
+    tolerances and loss coefficients are kept as arrays, the valve mass flows are read from and the loss coefficients
+    written to the net in one step per control iteration. Valves within the group are adjusted simultaneously,
+    control levels are realized with one group per level. Same update methods ('pid' or 'secant') as CtrlValve.
+    """
+
+    def __init__(self, net, gids, data_source=None, profile_name=None, mdot_set_kg_per_s=0, gain=-1000, update='pid',
+                 damping=0.8, max_rel_step=1.0, min_step=10., in_service=True, recycle=True, order=0, level=0, tol=0,
+                 **kwargs):
+        super().__init__(net, in_service=in_service, recycle=recycle, order=order, level=level,
+                         initial_powerflow=True, **kwargs)
+
+        # read valve attributes from net
+        self.gid = np.asarray(gids, dtype=int)  # indices of the controlled valves
+        self.loss_coeff = net.valve['loss_coefficient'].values[self.gid].astype(float)
+        self.opened = net.valve['opened'].values[self.gid].astype(bool)
+        self.name = net.valve['name'].values[self.gid]
+        self.applied = np.zeros(len(self.gid), dtype=bool)
+
+        # specific attributes
+        n = len(self.gid)
+        self.mdot_set_kg_per_s = np.broadcast_to(np.asarray(mdot_set_kg_per_s, dtype=float), n).copy()
+        self.gain = np.broadcast_to(np.asarray(gain, dtype=float), n).copy()
+        self.tolerance = np.broadcast_to(np.asarray(tol, dtype=float), n).copy()  # absolute tolerance
+        self.i = np.zeros(n, dtype=int)
+        self.loss_coeff_min = 0
+        self.loss_coeff_max = 1e6
+
+        # profile attributes (one profile name or None per valve)
+        self.data_source = data_source
+        self.profile_name = list(profile_name) if profile_name is not None else [None] * n
+
+        # adaptive gain (secant update)
+        if update not in ('pid', 'secant'):
+            raise ValueError(f'Unknown valve update method: {update}')
+        self.update = update
+        self.damping = damping
+        self.max_rel_step = max_rel_step
+        self.min_step = min_step
+        self._last_loss_coeff = np.full(n, np.nan)  # loss coefficients and mass flows of the previous iteration
+        self._last_mdot = np.full(n, np.nan)
+
+    def initialize_control(self, net):
+        """
+        At the beginning of each run_control call reset iteration counters
+        """
+        self.i[:] = 0
+        self._last_loss_coeff[:] = np.nan
+        self._last_mdot[:] = np.nan
+
+    def is_converged(self, net):
+        mdot = self._get_mdot(net)
+        self.applied = np.abs(mdot - self.mdot_set_kg_per_s) <= self.tolerance
+        return bool(np.all(self.applied))
+
+    def write_to_net(self, net):
+        net.valve.loc[self.gid, 'loss_coefficient'] = self.loss_coeff
+        net.valve.loc[self.gid, 'opened'] = self.opened
+
+    def control_step(self, net):
+        mdot = self._get_mdot(net)
+
+        # Set valve status (like CtrlValve, only valves that are not yet within their tolerance are closed)
+        self.opened &= ~(~self.applied & (self.mdot_set_kg_per_s < 1e-6))  # To avoid float issues
+
+        # Set valve positions of the opened valves that are not yet within their tolerance
+        adjust = self.opened & ~self.applied
+        if self.update == 'secant':
+            step = self._secant_step(mdot, adjust)
+        else:
+            step = self.gain * (self.mdot_set_kg_per_s - mdot)
+        self.loss_coeff[adjust] = np.clip(self.loss_coeff[adjust] + step[adjust],
+                                          self.loss_coeff_min, self.loss_coeff_max)
+        self.i[adjust] += 1
+
+        self.write_to_net(net)
+        self.applied[:] = True
+
+    def _secant_step(self, mdot, adjust):
+        step = self.gain * (self.mdot_set_kg_per_s - mdot)
+        d_loss_coeff = self.loss_coeff - self._last_loss_coeff
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = (mdot - self._last_mdot) / d_loss_coeff
+        valid = (d_loss_coeff != 0) & (slope < 0)  # mass flow has to decrease with increasing loss coefficient
+        step[valid] = self.damping * (self.mdot_set_kg_per_s[valid] - mdot[valid]) / slope[valid]
+        self._last_loss_coeff[adjust] = self.loss_coeff[adjust]
+        self._last_mdot[adjust] = mdot[adjust]
+
+        # Bound step
+        max_step = np.maximum(self.max_rel_step * self.loss_coeff, self.min_step)
+        return np.clip(step, -max_step, max_step)
+
+    def _get_mdot(self, net):
+        return np.nan_to_num(net.res_valve['mdot_from_kg_per_s'].values[self.gid])
+
+    def read_from_net(self, net):
+        self.loss_coeff = net.valve['loss_coefficient'].values[self.gid].astype(float)
+        self.opened = net.valve['opened'].values[self.gid].astype(bool)
+
+    def time_step(self, net, time):
+        # read new values from the profiles
+        if self.data_source:
+            for k, profile_name in enumerate(self.profile_name):
+                if profile_name is not None:
+                    self.mdot_set_kg_per_s[k] = self.data_source.get_time_step_value(time_step=time,
+                                                                                     profile_name=profile_name)
+
+        self.applied[:] = False  # reset applied variable
+
+    def set_mdot_setpoint(self, setpoint, k):
+        if self.profile_name[k] is None:
+            self.mdot_set_kg_per_s[k] = setpoint
+
+
+class CoupledValveControl:
+    """
+    Direct inverse valve sizing for a group of CtrlValve controllers. Instead of adjusting each valve with its own
+    P controller, the loss coefficients of all opened valves are solved for at once with a Newton scheme. The
+    scheme works on u = 1 / sqrt(1 + loss_coeff), to which the valve mass flow is nearly proportional. The
+    Jacobian d(mdot)/du is obtained by finite differences (one pipeflow per valve) and afterwards kept up to date
+    with Broyden updates, so that a handful of pipeflows per step is sufficient.
+    Setpoints, tolerances, valve closing and loss coefficient limits are taken from the controllers.
+    """
+
+    def __init__(self, net, controllers, run, max_iter=20, rel_step=0.05):
+        self.net = net
+        self.controllers = controllers
+        self.run = run  # pipeflow function
+        self.max_iter = max_iter
+        self.rel_step = rel_step  # relative finite difference step
+        self.i = 0
+        self._x_net = None  # loss coefficients of the last pipeflow
+
+    def run_control(self):
+        """
+        Adjusts the valves and returns True if all mass flows are within the tolerances of their controllers.
+        """
+        net = self.net
+
+        # Set valve status
+        for ctrl in self.controllers:
+            ctrl.initialize_control(net)
+            ctrl._set_valve_status()
+            ctrl.write_to_net(net)
+
+        active = [ctrl for ctrl in self.controllers if ctrl.opened]
+        self.gid = np.array([ctrl.gid for ctrl in active], dtype=int)
+        self.mdot_set = np.array([ctrl.mdot_set_kg_per_s for ctrl in active], dtype=float)
+        self.lo = self._to_u(np.array([ctrl.loss_coeff_max for ctrl in active], dtype=float))
+        self.hi = self._to_u(np.array([ctrl.loss_coeff_min for ctrl in active], dtype=float))
+        tol = np.array([ctrl.tolerance for ctrl in active], dtype=float)
+        x = self._to_u(np.array([ctrl.loss_coeff for ctrl in active], dtype=float))
+
+        r = self._residual(x)
+        jac = None
+        jac_is_fresh = False
+        converged = bool(np.all(np.abs(r) <= tol))
+        self.i = 0
+
+        while not converged and self.i < self.max_iter:
+            if jac is None:
+                jac = self._jacobian(x, r)
+                jac_is_fresh = True
+
+            # Newton step within the loss coefficient limits (u decreases with increasing loss coefficient)
+            dx = np.linalg.lstsq(jac, -r, rcond=None)[0]
+            x_new = np.clip(x + dx, self.lo, self.hi)
+            step = x_new - x
+            if not np.any(step):
+                if jac_is_fresh:
+                    break  # Limits reached, no further progress possible
+                jac = None
+                continue
+
+            r_new = self._residual(x_new)
+            self.i += 1
+
+            # Broyden update of the Jacobian
+            jac += np.outer(r_new - r - jac @ step, step) / (step @ step)
+            jac_is_fresh = False
+
+            x, r = x_new, r_new
+            converged = bool(np.all(np.abs(r) <= tol))
+
+        # Make sure the network results belong to the final valve positions
+        if not np.array_equal(self._x_net, x):
+            self._residual(x)
+
+        # Write final valve positions to controllers
+        for ctrl, loss_coeff in zip(active, self._to_loss_coeff(x)):
+            ctrl.loss_coeff = loss_coeff
+            ctrl.i = self.i
+            ctrl.applied = converged
+
+        return converged
+
+    def _residual(self, x):
+        net = self.net
+        net.valve.loc[self.gid, 'loss_coefficient'] = self._to_loss_coeff(x)
+        self.run(net)
+        self._x_net = x.copy()
+        return np.nan_to_num(net.res_valve['mdot_from_kg_per_s'].values[self.gid]) - self.mdot_set
+
+    def _jacobian(self, x, r):
+        jac = np.empty((len(x), len(x)))
+        for k in range(len(x)):
+            h = self.rel_step * x[k]
+            if x[k] + h > self.hi[k]:
+                h = -h  # Backward difference at the upper limit
+            x_h = x.copy()
+            x_h[k] += h
+            jac[:, k] = (self._residual(x_h) - r) / h
+        return jac
+
+    @staticmethod
+    def _to_u(loss_coeff):
+        return 1 / np.sqrt(1 + loss_coeff)
+
+    @staticmethod
+    def _to_loss_coeff(u):
+        return 1 / u ** 2 - 1
\ No newline at end of file
@@ -8,7 +8,7 @@ import logging
 import os
 import mosaik_api
 
-from .simulator import Pandapower, make_eid
+from .simulator import Pandapower, ResultCache, make_eid
 
 logger = logging.getLogger('pandapower.mosaik')
 
@@ -131,9 +131,10 @@ class ElectricNetworkSimulator(mosaik_api.Simulator):
         self._entities = {}
         self._relations = []  # List of pair-wise related entities (IDs)
         self._ppcs = []  # The pandapower cases
-        self._cache = {}  # Cache for load flow outputs
+        self._cache = ResultCache()  # Cache for load flow outputs
 
-    def init(self, sid, time_resolution, step_size, mode, pos_loads=True):
+    def init(self, sid, time_resolution, step_size, mode, pos_loads=True, pf_tol=1e-6, lin_max_change=0.05,
+             lin_max_error=1e-3):
         #TODO: check if we need to change signs or we leave it
         logger.debug('Power flow will be computed every %d seconds.' %
                      step_size)
@@ -142,7 +143,12 @@ class ElectricNetworkSimulator(mosaik_api.Simulator):
          #            signs if pos_loads else tuple(reversed(signs)))
 
         self.step_size = step_size
-        self.mode = mode
+        self.mode = mode  # 'pf', 'pf_warm', 'pf_sweep' (radial), 'pf_linear' (sensitivities) or 'pf_timeseries'
+        # 'pf_linear' only estimates the bus voltages between full power flows: in estimated steps the line,
+        # transformer and slack results (e.g. loading_percent) are NaN, so it is not suited for the benchmark analysis
+        self.pf_tol = pf_tol  # Injection change [MW, MVAr] that triggers a new power flow in 'pf_warm' mode
+        self.lin_max_change = lin_max_change  # Relative injection change for a new linearization ('pf_linear')
+        self.lin_max_error = lin_max_error  # Estimated voltage error [pu] for a new linearization ('pf_linear')
 
         return self.meta
 
@@ -204,6 +210,12 @@ class ElectricNetworkSimulator(mosaik_api.Simulator):
             self.simulator.powerflow_timeseries(self.time_step_index)
         elif self.mode == 'pf':
             self.simulator.powerflow()
+        elif self.mode == 'pf_warm':
+            self.simulator.powerflow_warm(self.pf_tol)
+        elif self.mode == 'pf_sweep':
+            self.simulator.powerflow_sweep()
+        elif self.mode == 'pf_linear':
+            self.simulator.powerflow_linear(self.lin_max_change, self.lin_max_error)
 
         self._cache = self.simulator.get_cache_entries()
 
@@ -224,7 +236,7 @@ class ElectricNetworkSimulator(mosaik_api.Simulator):
         for eid, attrs in outputs.items():
             for attr in attrs:
                 try:
-                    val = self._cache[eid][attr]
+                    val = self._cache.get(eid, attr)
                     if attr == 'P':
                         val *= self.pos_loads
                 except KeyError:
@@ -237,5 +249,19 @@ class ElectricNetworkSimulator(mosaik_api.Simulator):
 
         return data
 
+    def finalize(self):
+        if self.mode == 'pf_warm':
+            stats = self.simulator.pf_stats
+            print('     el network: %d full power flows, %d recycled, %d skipped (unchanged injections).' % (
+                    stats['full'], stats['recycled'], stats['skipped']))
+        elif self.mode == 'pf_sweep':
+            stats = self.simulator.sweep_stats
+            print('     el network: %d backward/forward sweeps, %d fallbacks to pp.runpp.' % (
+                    stats['sweep'], stats['fallback']))
+        elif self.mode == 'pf_linear':
+            stats = self.simulator.linear_stats
+            print('     el network: %d full power flows, %d linearized voltage estimates.' % (
+                    stats['full'], stats['estimated']))
+
 def main():
     mosaik_api.start_simulation(ElectricNetworkSimulator(), 'The mosaik pandapower adapter')
@@ -0,0 +1,224 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by LGPL-2.1.
+'''
+Backward/forward sweep power flow for radial networks.
+'''
+
+import math
+
+import numpy as np
+import pandas as pd
+
+# Element tables that are not modelled by the sweep (in service elements lead to a fallback to pp.runpp)
+UNSUPPORTED_TABLES = ['trafo', 'trafo3w', 'gen', 'shunt', 'impedance', 'ward', 'xward', 'storage', 'dcline', 'motor',
+                      'asymmetric_load', 'asymmetric_sgen']
+
+
+class RadialSweep(object):
+    '''
+    Backward/forward sweep power flow for radial networks with lines, constant power loads and static generators
+    fed by a single external grid.
+
+    The buses are numbered in depth-first order from the slack bus, so that the buses of each subtree are
+    contiguous. The backward sweep (branch current = sum of all currents of the subtree) and the forward sweep
+    (voltage = slack voltage minus the voltage drops of all upstream branches) are then computed with cumulative
+    sums over all buses at once.
+
+    Networks with meshes, unsupported elements (see UNSUPPORTED_TABLES), switches, voltage dependent loads or
+    isolated buses are not radial in this sense (see radial).
+    '''
+
+    def __init__(self, net, tol=1e-9, max_iter=100):
+        self.tol = tol  # Max. voltage change between two iterations [pu]
+        self.max_iter = max_iter
+        self.V = None  # Last solution (preorder) for the warm start
+        self.signature = self._get_signature(net)
+        self.radial = self._is_supported(net) and self._build(net)
+
+    @staticmethod
+    def _get_signature(net):
+        return net.line['in_service'].values.tobytes() + net.bus['in_service'].values.tobytes()
+
+    def is_outdated(self, net):
+        return self._get_signature(net) != self.signature
+
+    @staticmethod
+    def _is_supported(net):
+        for table in UNSUPPORTED_TABLES:
+            if table in net and len(net[table]) and net[table]['in_service'].any():
+                return False
+        if len(net.switch):
+            return False
+        if (net.load['const_z_percent'].values != 0).any() or (net.load['const_i_percent'].values != 0).any():
+            return False
+        return len(net.ext_grid) == 1 and bool(net.ext_grid['in_service'].values[0]) and \
+            bool(net.bus['in_service'].all())
+
+    def _build(self, net):
+        bus_pos = pd.Index(net.bus.index)
+        n = len(bus_pos)
+        lines = np.flatnonzero(net.line['in_service'].values)
+        f = bus_pos.get_indexer(net.line['from_bus'].values[lines])
+        t = bus_pos.get_indexer(net.line['to_bus'].values[lines])
+        if len(lines) != n - 1:
+            return False
+
+        # Depth-first search from the slack bus
+        adjacency = [[] for _ in range(n)]
+        for a, b in zip(f, t):
+            adjacency[a].append(b)
+            adjacency[b].append(a)
+        slack = bus_pos.get_loc(net.ext_grid['bus'].values[0])
+        order = []
+        parent = np.full(n, -1)
+        visited = np.zeros(n, dtype=bool)
+        stack = [slack]
+        visited[slack] = True
+        while stack:
+            b = stack.pop()
+            order.append(b)
+            for c in adjacency[b]:
+                if not visited[c]:
+                    visited[c] = True
+                    parent[c] = b
+                    stack.append(c)
+        if len(order) != n:
+            # Isolated buses (a mesh would leave buses unreached with n - 1 lines)
+            return False
+
+        # Subtree of the bus at preorder position i: positions i ... end[i] - 1
+        order = np.array(order)
+        pos = np.empty(n, dtype=int)
+        pos[order] = np.arange(n)
+        end = np.arange(1, n + 1)
+        for i in range(n - 1, 0, -1):
+            p = pos[parent[order[i]]]
+            end[p] = max(end[p], end[i])
+
+        self.bus_pos = bus_pos
+        self.order = order
+        self.pos = pos
+        self.end = end
+        self.lines = lines
+        self.line_child = pos[np.where(parent[t] == f, t, f)]  # Preorder position of the downstream bus
+        self.line_forward = parent[t] == f  # True: from_bus is upstream
+
+        # Per unit line parameters (base: net.sn_mva and the nominal voltage of the from bus)
+        sn_mva = net.sn_mva
+        vn_kv = net.bus['vn_kv'].values[f]
+        z_base = vn_kv ** 2 / sn_mva
+        line = net.line.iloc[lines]
+        parallel = line['parallel'].values
+        length = line['length_km'].values
+        z = (line['r_ohm_per_km'].values + 1j * line['x_ohm_per_km'].values) * length / parallel / z_base
+        g_us = line['g_us_per_km'].values if 'g_us_per_km' in line else 0
+        y = (g_us * 1e-6 + 2j * math.pi * net.f_hz * line['c_nf_per_km'].values * 1e-9) * length * parallel * z_base
+        self.z = np.zeros(n, dtype=complex)  # Impedance of the branch feeding each bus (preorder)
+        self.z[self.line_child] = z
+        self.y_half = np.zeros(n, dtype=complex)  # Line shunt admittance connected to each bus (preorder)
+        np.add.at(self.y_half, pos[f], y / 2)
+        np.add.at(self.y_half, pos[t], y / 2)
+        self.line_y_half = y / 2
+        self.line_i_base_ka = sn_mva / (math.sqrt(3) * vn_kv)
+        self.line_max_i_ka = line['max_i_ka'].values * line['df'].values * parallel
+        self.line_from = pos[f]
+        self.line_to = pos[t]
+        return True
+
+    def solve(self, net):
+        '''
+        Runs the sweep and writes the results to net. Returns False if the iteration did not converge.
+        '''
+        n = len(self.order)
+        sn_mva = net.sn_mva
+        load = net.load
+        sgen = net.sgen
+
+        # Complex power consumed at each bus [pu]
+        p_load = load['p_mw'].values * load['scaling'].values * load['in_service'].values
+        q_load = load['q_mvar'].values * load['scaling'].values * load['in_service'].values
+        p_sgen = sgen['p_mw'].values * sgen['scaling'].values * sgen['in_service'].values
+        q_sgen = sgen['q_mvar'].values * sgen['scaling'].values * sgen['in_service'].values
+        s = np.zeros(n, dtype=complex)
+        np.add.at(s, self.pos[self.bus_pos.get_indexer(load['bus'].values)], (p_load + 1j * q_load) / sn_mva)
+        np.add.at(s, self.pos[self.bus_pos.get_indexer(sgen['bus'].values)], - (p_sgen + 1j * q_sgen) / sn_mva)
+
+        ext_grid = net.ext_grid
+        v_slack = ext_grid['vm_pu'].values[0] * np.exp(1j * np.deg2rad(ext_grid['va_degree'].values[0]))
+        V = self.V if self.V is not None else np.full(n, v_slack, dtype=complex)
+        start = np.arange(n)
+
+        converged = False
+        for _ in range(self.max_iter):
+            # Backward sweep: branch current = sum of the bus currents of the subtree
+            i_bus = np.conj(s / V) + self.y_half * V
+            cum = np.concatenate(([0], np.cumsum(i_bus)))
+            i_branch = cum[self.end] - cum[start]
+
+            # Forward sweep: sum of the voltage drops of all upstream branches
+            drop = self.z * i_branch
+            diff = np.zeros(n + 1, dtype=complex)
+            diff[start] += drop
+            np.add.at(diff, self.end, - drop)
+            V_new = v_slack - np.cumsum(diff[:n])
+
+            if not np.all(np.isfinite(V_new)):
+                break
+            delta = np.max(np.abs(V_new - V))
+            V = V_new
+            if delta < self.tol:
+                converged = True
+                break
+
+        if not converged:
+            self.V = None
+            return False
+        self.V = V
+
+        i_bus = np.conj(s / V) + self.y_half * V
+        cum = np.concatenate(([0], np.cumsum(i_bus)))
+        i_branch = cum[self.end] - cum[start]
+        self._write_results(net, V, s, i_branch, p_load, q_load, p_sgen, q_sgen)
+        return True
+
+    def _write_results(self, net, V, s, i_branch, p_load, q_load, p_sgen, q_sgen):
+        sn_mva = net.sn_mva
+        n = len(self.order)
+
+        # External grid supply (total current of the network at the slack voltage)
+        s_ext = V[0] * np.conj(i_branch[0]) * sn_mva
+
+        # Buses (consumer viewpoint, in net.bus order)
+        s_bus = s * sn_mva
+        s_bus[0] -= s_ext
+        vm = np.abs(V)
+        va = np.rad2deg(np.angle(V))
+        bus_idx = self.pos
+        net.res_bus = pd.DataFrame({'vm_pu': vm[bus_idx], 'va_degree': va[bus_idx], 'p_mw': s_bus.real[bus_idx],
+                                    'q_mvar': s_bus.imag[bus_idx]}, index=net.bus.index)
+
+        # Lines: current into the line at the upstream and the downstream end
+        i_series = i_branch[self.line_child]
+        v_from = V[self.line_from]
+        v_to = V[self.line_to]
+        i_from = np.where(self.line_forward, i_series, - i_series) + self.line_y_half * v_from
+        i_to = np.where(self.line_forward, - i_series, i_series) + self.line_y_half * v_to
+        s_from = v_from * np.conj(i_from) * sn_mva
+        s_to = v_to * np.conj(i_to) * sn_mva
+        i_from_ka = np.abs(i_from) * self.line_i_base_ka
+        i_to_ka = np.abs(i_to) * self.line_i_base_ka
+        i_ka = np.maximum(i_from_ka, i_to_ka)
+
+        columns = ['p_from_mw', 'q_from_mvar', 'p_to_mw', 'q_to_mvar', 'pl_mw', 'ql_mvar', 'i_from_ka', 'i_to_ka',
+                   'i_ka', 'vm_from_pu', 'va_from_degree', 'vm_to_pu', 'va_to_degree', 'loading_percent']
+        values = np.zeros((len(net.line), len(columns)))  # Out of service lines: no flow
+        values[self.lines] = np.column_stack((
+            s_from.real, s_from.imag, s_to.real, s_to.imag, s_from.real + s_to.real, s_from.imag + s_to.imag,
+            i_from_ka, i_to_ka, i_ka, np.abs(v_from), np.rad2deg(np.angle(v_from)), np.abs(v_to),
+            np.rad2deg(np.angle(v_to)), i_ka / self.line_max_i_ka * 100))
+        net.res_line = pd.DataFrame(values, index=net.line.index, columns=columns)
+
+        net.res_load = pd.DataFrame({'p_mw': p_load, 'q_mvar': q_load}, index=net.load.index)
+        net.res_sgen = pd.DataFrame({'p_mw': p_sgen, 'q_mvar': q_sgen}, index=net.sgen.index)
+        net.res_ext_grid = pd.DataFrame({'p_mw': [s_ext.real], 'q_mvar': [s_ext.imag]}, index=net.ext_grid.index)
+        net['converged'] = True
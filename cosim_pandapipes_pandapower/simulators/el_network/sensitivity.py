@@ -0,0 +1,147 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by LGPL-2.1.
+'''
+Linearized bus voltage magnitudes around a power flow solution.
+'''
+
+import numpy as np
+from scipy.sparse import vstack, hstack
+from scipy.sparse.linalg import splu
+from pandapower.pypower.dSbus_dV import dSbus_dV
+
+
+class VoltageSensitivity(object):
+    '''
+    Sensitivity of the bus voltage magnitudes to the load and sgen injections (dV/dP, dV/dQ), computed from the
+    Newton-Raphson Jacobian of the last full power flow (pandapower internal variables).
+
+    Between full power flows, vm_pu is estimated as vm0 + A (x - x0), with x the injections of all elements (see
+    get_injections). The linearization is renewed if
+      - elements were switched in or out of service, a tap or the slack voltage changed,
+      - an injection changed by more than max_change relative to its value at the linearization (injections below
+        the mean absolute injection are referred to the mean), or
+      - the estimated error exceeds max_error [pu]. The error of the linear estimate grows with the square of the
+        injection change, the factor is the largest ratio observed between the prediction error and the squared
+        injection change at the full power flows. Estimates are only used once this factor has been calibrated,
+        i.e., after the second full power flow with the same structure.
+    '''
+
+    def __init__(self, max_change=0.05, max_error=1e-3):
+        self.max_change = max_change  # Relative injection change
+        self.max_error = max_error  # Estimated error of vm_pu [pu]
+        self.A = None  # dvm_pu / dx (bus x element injection)
+        self.x0 = None  # Injections of the linearization point
+        self.x_ref = None  # Reference of the relative injection changes [MW, MVAr]
+        self.vm0 = None  # Voltage magnitudes of the linearization point
+        self.signature = None  # Structure of the linearization point
+        self.curvature = None  # Max. observed error / injection change ** 2 (None: not calibrated)
+
+    @staticmethod
+    def get_injections(net):
+        '''
+        Injections [MW, MVAr]: load p, load q, sgen p, sgen q (consumer viewpoint for loads, generator viewpoint for
+        sgens, 0 if out of service).
+        '''
+        load = net.load
+        sgen = net.sgen
+        load_scaling = load['scaling'].values * load['in_service'].values
+        sgen_scaling = sgen['scaling'].values * sgen['in_service'].values
+        return np.concatenate((load['p_mw'].values * load_scaling, load['q_mvar'].values * load_scaling,
+                               sgen['p_mw'].values * sgen_scaling, sgen['q_mvar'].values * sgen_scaling))
+
+    @staticmethod
+    def _get_signature(net):
+        return b''.join(net[table]['in_service'].values.astype(bool).tobytes()
+                        for table in ['bus', 'line', 'trafo', 'ext_grid', 'load', 'sgen']) + \
+            net.trafo['tap_pos'].values.astype(float).tobytes() + net.ext_grid['vm_pu'].values.astype(float).tobytes()
+
+    def is_valid(self, net, x):
+        '''
+        Returns True if the voltages for the injections x can be estimated with the current linearization.
+        '''
+        if self.A is None or self._get_signature(net) != self.signature:
+            return False
+        delta = np.abs(x - self.x0)
+        change = np.max(delta, initial=0)
+        if change == 0:
+            return True
+        if np.max(delta / self.x_ref) > self.max_change or self.curvature is None:
+            return False
+        return self.curvature * change ** 2 <= self.max_error
+
+    def predict(self, x):
+        return self.vm0 + self.A @ (x - self.x0)
+
+    def update(self, net, x):
+        '''
+        Calibrates the error estimate with the (converged) power flow results of net for the injections x and
+        linearizes around them.
+        '''
+        signature = self._get_signature(net)
+        vm = net.res_bus['vm_pu'].values
+        if self.A is not None and signature == self.signature:
+            change = np.max(np.abs(x - self.x0), initial=0)
+            if change > 0:
+                curvature = np.nanmax(np.abs(vm - self.predict(x)), initial=0) / change ** 2
+                self.curvature = curvature if self.curvature is None else max(self.curvature, curvature)
+        else:
+            self.curvature = None
+
+        self.A = self._get_sensitivity(net)
+        self.x0 = x
+        self.x_ref = np.maximum(np.abs(x), max(np.mean(np.abs(x)) if len(x) else 0, 1e-6))
+        self.vm0 = vm.copy()
+        self.signature = signature
+
+    @staticmethod
+    def _get_sensitivity(net):
+        internal = net['_ppc']['internal']
+        V = internal['V']
+        pv = internal['pv']
+        pq = internal['pq']
+        base_mva = internal['baseMVA']
+        pvpq = np.r_[pv, pq]
+        n_pvpq = len(pvpq)
+
+        # Jacobian of the injections [P(pvpq), Q(pq)] w.r.t. [Va(pvpq), Vm(pq)]
+        dS_dVm, dS_dVa = dSbus_dV(internal['Ybus'], V)
+        J = vstack([
+            hstack([dS_dVa[pvpq][:, pvpq].real, dS_dVm[pvpq][:, pq].real]),
+            hstack([dS_dVa[pq][:, pvpq].imag, dS_dVm[pq][:, pq].imag])
+        ], format='csc')
+
+        # Rows / columns of the Jacobian per ppci bus (-1: not a state or mismatch variable)
+        n_bus = len(V)
+        p_col = np.full(n_bus, -1)
+        p_col[pvpq] = np.arange(n_pvpq)
+        q_col = np.full(n_bus, -1)
+        q_col[pq] = n_pvpq + np.arange(len(pq))
+
+        # Element buses (ppci), element injection signs (generator viewpoint) and Jacobian columns
+        lookup = net['_pd2ppc_lookups']['bus']
+        load_bus = lookup[net.load['bus'].values]
+        sgen_bus = lookup[net.sgen['bus'].values]
+        bus = np.concatenate((load_bus, load_bus, sgen_bus, sgen_bus))
+        sign = np.concatenate((- np.ones(2 * len(load_bus)), np.ones(2 * len(sgen_bus))))
+        is_p = np.concatenate((np.ones(len(load_bus), dtype=bool), np.zeros(len(load_bus), dtype=bool),
+                               np.ones(len(sgen_bus), dtype=bool), np.zeros(len(sgen_bus), dtype=bool)))
+        in_ppci = bus < n_bus
+        col = np.full(len(bus), -1)
+        col[in_ppci] = np.where(is_p[in_ppci], p_col[bus[in_ppci]], q_col[bus[in_ppci]])
+
+        # dVm(pq) / dS for all needed columns, then per element [pu / MW]
+        A = np.zeros((len(net.bus), len(bus)))
+        used = np.flatnonzero(col >= 0)
+        if len(pq) and len(used):
+            columns, inverse = np.unique(col[used], return_inverse=True)
+            rhs = np.zeros((J.shape[0], len(columns)))
+            rhs[columns, np.arange(len(columns))] = 1
+            dvm = splu(J).solve(rhs)[n_pvpq:]
+
+            ppci_bus = lookup[net.bus.index.values]
+            vm_row = np.full(n_bus, -1)
+            vm_row[pq] = np.arange(len(pq))
+            rows = np.where(ppci_bus < n_bus, vm_row[np.minimum(ppci_bus, n_bus - 1)], -1)
+            has_row = np.flatnonzero(rows >= 0)
+            A[np.ix_(has_row, used)] = dvm[rows[has_row]][:, inverse] * sign[used] / base_mva
+        return A
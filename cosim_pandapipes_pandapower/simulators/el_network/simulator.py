@@ -7,6 +7,7 @@ This is a modified version of the Mosaik Pandapower module.
 import json
 import os.path
 
+import numpy as np
 import pandas as pd
 import pandapower as pp
 from pandapower.timeseries import DFData
@@ -14,10 +15,155 @@ from pandapower.timeseries import OutputWriter
 from pandapower.control import ConstControl
 from pandapower.timeseries.run_time_series import run_time_step, init_time_series
 
+from .radial_sweep import RadialSweep
+from .sensitivity import VoltageSensitivity
+
+# Power flow results per entity type: result table and attributes
+RESULT_ATTRS = {
+    'Bus': ('res_bus', ['p_mw', 'q_mvar', 'vm_pu', 'va_degree']),
+    'Load': ('res_load', ['p_mw', 'q_mvar']),
+    'Sgen': ('res_sgen', ['p_mw', 'q_mvar']),
+    'Transformer': ('res_trafo', ['va_lv_degree', 'loading_percent']),
+    'Line': ('res_line', ['i_ka', 'loading_percent']),
+    'Ext_grid': ('res_ext_grid', ['p_mw', 'q_mvar']),
+}
+
+# Attributes set to NaN if the power flow failed to converge (other attributes are not available then)
+FAILED_ATTRS = {
+    'Bus': ['p_mw', 'q_mvar', 'vm_pu', 'va_degree'],
+    'Line': ['i_ka', 'p_from_mw', 'q_from_mvar', 'p_to_mw', 'q_to_mvar'],
+    'Transformer': ['va_lv_degree', 'loading_percent'],
+}
+
+# Results not computed by the linearized voltage estimate (set to NaN in estimated steps, None: all columns)
+LINEAR_STALE_RESULTS = {'res_bus': ['va_degree', 'p_mw', 'q_mvar'], 'res_line': None, 'res_trafo': None,
+                        'res_ext_grid': None}
+
+
+class ResultCache(object):
+    '''
+    Array-backed cache of the power flow results of all entities.
+
+    Each (entity, attribute) pair has a fixed slot in one value array. Only requested pairs are extracted: a pair
+    is registered on its first get() (and read from the last solved network right away), after each power flow
+    the result columns of the registered pairs are read once and scattered into their slots by integer indexing.
+    Pairs without a result (see FAILED_ATTRS) raise a KeyError in get(), like missing keys of the former
+    per-entity dicts.
+    '''
+
+    def __init__(self, entity_map=None):
+        self.slots = {}  # (eid, attr) -> slot
+        self.groups = []  # (result table, attribute, table positions, slots)
+        slot_group = []  # Group (-1: none) and table position of each slot
+        slot_pos = []
+        failed_slots = []
+
+        entity_map = entity_map or {}
+        for etype, (table, attrs) in RESULT_ATTRS.items():
+            eids = [eid for eid, entity in entity_map.items() if entity['etype'] == etype]
+            if not eids:
+                continue
+            if etype == 'Ext_grid':
+                # The slack entity is indexed by its bus, the results are in the first ext_grid row
+                positions = np.zeros(len(eids), dtype=int)
+            else:
+                positions = np.array([entity_map[eid]['idx'] for eid in eids], dtype=int)
+            for attr in attrs:
+                slots = self._add_slots(eids, attr, slot_group, slot_pos)
+                for slot, position in zip(slots, positions):
+                    slot_group[slot] = len(self.groups)
+                    slot_pos[slot] = position
+                self.groups.append((table, attr, positions, slots))
+            for attr in FAILED_ATTRS.get(etype, []):
+                failed_slots.append(self._add_slots(eids, attr, slot_group, slot_pos))
+
+        n = len(self.slots)
+        self.slot_group = np.array(slot_group, dtype=int)
+        self.slot_pos = np.array(slot_pos, dtype=int)
+        self.failed = np.zeros(n, dtype=bool)
+        if failed_slots:
+            self.failed[np.concatenate(failed_slots)] = True
+        self.values = np.full(n, np.nan)
+        self.valid = np.zeros(n, dtype=bool)
+        self.requested = np.zeros(n, dtype=bool)
+
+        self.net = None  # Network of the last update
+        self.converged = False
+        self.active_groups = []  # Groups reduced to the requested slots
+        self.active_failed = np.zeros(0, dtype=int)
+        self._selection_outdated = False
+
+    def _add_slots(self, eids, attr, slot_group, slot_pos):
+        slots = []
+        for eid in eids:
+            if (eid, attr) not in self.slots:
+                self.slots[(eid, attr)] = len(self.slots)
+                slot_group.append(-1)
+                slot_pos.append(-1)
+            slots.append(self.slots[(eid, attr)])
+        return np.array(slots, dtype=int)
+
+    def _select(self):
+        self.active_groups = []
+        for table, attr, positions, slots in self.groups:
+            mask = self.requested[slots]
+            if np.any(mask):
+                self.active_groups.append((table, attr, positions[mask], slots[mask]))
+        self.active_failed = np.flatnonzero(self.failed & self.requested)
+        self._selection_outdated = False
+
+    def update(self, net):
+        self.net = net
+        self.converged = not net.res_bus.empty
+        if self._selection_outdated:
+            self._select()
+
+        self.valid[:] = False
+        if self.converged:
+            for table, attr, positions, slots in self.active_groups:
+                self.values[slots] = net[table][attr].values[positions]
+                self.valid[slots] = True
+        else:
+            # Failed to converge.
+            self.values[self.active_failed] = np.nan
+            self.valid[self.active_failed] = True
+
+    def _extract(self, slot):
+        group = self.slot_group[slot]
+        if self.converged and group >= 0:
+            table, attr, _, _ = self.groups[group]
+            self.values[slot] = self.net[table][attr].values[self.slot_pos[slot]]
+            self.valid[slot] = True
+        elif not self.converged and self.failed[slot]:
+            self.values[slot] = np.nan
+            self.valid[slot] = True
+
+    def get(self, eid, attr):
+        slot = self.slots[(eid, attr)]
+        if not self.requested[slot]:
+            # First request: extract from now on
+            self.requested[slot] = True
+            self._selection_outdated = True
+            if self.net is not None:
+                self._extract(slot)
+        if not self.valid[slot]:
+            raise KeyError((eid, attr))
+        return self.values[slot]
+
+
 class Pandapower(object):
 
     def __init__(self):
         self.entity_map={}
+        self.result_cache = ResultCache()
+        self.pf_stats = {'full': 0, 'recycled': 0, 'skipped': 0}
+        self._injection_key = None  # Quantized injections of the last converged power flow
+        self._structure = None  # In service states of the last power flow
+        self._taps = None  # Transformer taps of the last power flow
+        self.sweep = None  # Backward/forward sweep solver (radial networks)
+        self.sweep_stats = {'sweep': 0, 'fallback': 0}
+        self.sensitivity = None  # Linearized voltages (see powerflow_linear)
+        self.linear_stats = {'full': 0, 'estimated': 0}
 
 
     def load_case(self,path,grid_idx):
@@ -67,6 +213,7 @@ class Pandapower(object):
 
         entity_map = self.entity_map
         ppc = self.net #pandapower case
+        self.result_cache = ResultCache(entity_map)
 
         if 'profiles' in self.net:
             time_steps = range(0, len(self.net.profiles['load']))
@@ -308,76 +455,100 @@ class Pandapower(object):
         pp.runpp(self.net)
 
 
-    def powerflow_timeseries(self, time_step):
-        '''Conduct power flow series'''
-
-        run_time_step(self.net, time_step, self.ts_variables, _ppc=True, is_elements=True)
+    def powerflow_warm(self, tol=1e-6, tolerance_mva=1e-8):
+        '''
+        Conduct power flow only if the injections changed by more than tol [MW, MVAr] since the last power flow.
+        The power flow starts from the previous results, the internal variables (Ybus, ppc) are reused as long as no
+        element was switched in or out of service. tolerance_mva is the power mismatch of pp.runpp (the warm start
+        usually converges in one iteration, the remaining error is in the order of this tolerance).
+        '''
+        net = self.net
+        structure = np.concatenate((net.load['in_service'].values, net.sgen['in_service'].values)).astype(bool)
+        taps = net.trafo['tap_pos'].values.astype(float)
+        injections = np.concatenate((net.load['p_mw'].values * net.load['scaling'].values, net.load['q_mvar'].values,
+                                     net.sgen['p_mw'].values * net.sgen['scaling'].values, net.sgen['q_mvar'].values))
+        key = hash((np.round(injections / tol).tobytes(), structure.tobytes(), taps.tobytes()))
+
+        solved = not net.res_bus.empty
+        if solved and key == self._injection_key:
+            self.pf_stats['skipped'] += 1
+            return
+
+        self._injection_key = None
+        if solved and self._structure is not None and np.array_equal(structure, self._structure):
+            recycle = dict(bus_pq=True, gen=False, trafo=not np.array_equal(taps, self._taps))
+            pp.runpp(net, init='results', recycle=recycle, tolerance_mva=tolerance_mva)
+            self.pf_stats['recycled'] += 1
+        else:
+            # Rebuild the internal variables
+            net['_ppc'] = None
+            pp.runpp(net, init='results' if solved else 'auto', recycle=dict(bus_pq=True, gen=False, trafo=False),
+                     tolerance_mva=tolerance_mva)
+            self.pf_stats['full'] += 1
 
+        self._injection_key = key
+        self._structure = structure
+        self._taps = taps
 
-    def get_cache_entries(self):
-        '''cache the results of the power flow to be communicated to other simulators'''
 
-        cache = {}
-        case = self.net
+    def powerflow_sweep(self):
+        '''
+        Conduct power flow with the backward/forward sweep, fall back to pp.runpp for meshed networks, unsupported
+        elements or if the sweep does not converge.
+        '''
+        if self.sweep is None or self.sweep.is_outdated(self.net):
+            self.sweep = RadialSweep(self.net)
 
-        for eid, attrs in self.entity_map.items():
-            etype = attrs['etype']
-            idx = attrs['idx']
-            data = {}
+        if self.sweep.radial and self.sweep.solve(self.net):
+            self.sweep_stats['sweep'] += 1
+        else:
+            pp.runpp(self.net)
+            self.sweep_stats['fallback'] += 1
 
-            if not case.res_bus.empty:
 
-                if etype == 'Bus':
-                    bus = case.res_bus.iloc[idx]
-                    data['p_mw'] = bus['p_mw']
-                    data['q_mvar'] = bus['q_mvar']
-                    data['vm_pu'] = bus['vm_pu']
-                    data['va_degree'] = bus['va_degree']
+    def powerflow_linear(self, max_change=0.05, max_error=1e-3):
+        '''
+        Estimate the bus voltages with the voltage sensitivities of the last full power flow, conduct a full power
+        flow (and linearize again) if an injection changed by more than max_change (relative) or the estimated
+        error exceeds max_error [pu]. Estimated steps update vm_pu and the load / sgen powers, the results that are
+        not estimated (branch flows, bus angles and powers, see LINEAR_STALE_RESULTS) are set to NaN.
+        '''
+        net = self.net
+        if self.sensitivity is None:
+            self.sensitivity = VoltageSensitivity(max_change, max_error)
+        x = self.sensitivity.get_injections(net)
+
+        if self.sensitivity.is_valid(net, x):
+            net.res_bus['vm_pu'] = self.sensitivity.predict(x)
+            n_load = len(net.load)
+            n_sgen = len(net.sgen)
+            net.res_load['p_mw'] = x[:n_load]
+            net.res_load['q_mvar'] = x[n_load:2 * n_load]
+            net.res_sgen['p_mw'] = x[2 * n_load:2 * n_load + n_sgen]
+            net.res_sgen['q_mvar'] = x[2 * n_load + n_sgen:]
+            for table, columns in LINEAR_STALE_RESULTS.items():
+                if columns is None:
+                    net[table] = pd.DataFrame(np.nan, index=net[table].index, columns=net[table].columns)
+                else:
+                    net[table][columns] = np.nan
+            self.linear_stats['estimated'] += 1
+        else:
+            pp.runpp(net)
+            self.sensitivity.update(net, x)
+            self.linear_stats['full'] += 1
 
-                elif etype == 'Load':
-                    load = case.res_load.iloc[idx]
-                    data['p_mw'] = load['p_mw']
-                    data['q_mvar'] = load['q_mvar']
 
-                elif etype == 'Sgen':
-                    sgen = case.res_sgen.iloc[idx]
-                    data['p_mw'] = sgen['p_mw']
-                    data['q_mvar'] = sgen['q_mvar']
+    def powerflow_timeseries(self, time_step):
+        '''Conduct power flow series'''
 
-                elif etype == 'Transformer':
-                    trafo = case.res_trafo.iloc[idx]
-                    data['va_lv_degree'] = trafo['va_lv_degree']
-                    data['loading_percent'] = trafo['loading_percent']
+        run_time_step(self.net, time_step, self.ts_variables, _ppc=True, is_elements=True)
 
-                elif etype == 'Line':
-                    line = case.res_line.iloc[idx]
-                    data['i_ka'] = line['i_ka']
-                    data['loading_percent'] = line ['loading_percent']
 
-                else:
-                    slack = case.res_ext_grid
-                    data['p_mw'] = slack['p_mw']
-                    data['q_mvar'] = slack['q_mvar']
+    def get_cache_entries(self):
+        '''cache the results of the power flow to be communicated to other simulators'''
 
-            else:
-                # Failed to converge.
-                if etype in 'Bus':
-                    data['p_mw'] = float('nan')
-                    data['q_mvar'] = float('nan')
-                    data['vm_pu'] = float('nan')
-                    data['va_degree'] = float('nan')
-                elif etype in 'Line':
-                    data['i_ka'] = float('nan')
-                    data['p_from_mw'] = float('nan')
-                    data['q_from_mvar'] = float('nan')
-                    data['p_to_mw'] = float('nan')
-                    data['q_to_mvar'] = float('nan')
-                elif etype in 'Transformer':
-                    data['va_lv_degree'] = float('nan')
-                    data['loading_percent'] = float('nan')
-
-            cache[eid] = data
-        return cache
+        self.result_cache.update(self.net)
+        return self.result_cache
 
 
 def make_eid(name, grid_idx):
@@ -0,0 +1,8 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import os
+import sys
+
+# Import the simulators package like the benchmark scripts do (from cosim_pandapipes_pandapower)
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
@@ -0,0 +1,359 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import copy
+import json
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('pandapipes')
+
+from simple_pid import PID
+from simulators.dh_network import valve_control
+from simulators.dh_network.simulator import DHNetwork
+from simulators.dh_network.topology_network import TopologyDHNetwork
+
+TOPOLOGY_FILE = os.path.join(os.path.dirname(__file__), os.pardir, 'resources', 'heat', 'dh_network_topology.json')
+
+
+class StepPID(PID):
+    '''
+    PID without wall clock sampling (the default sample_time skips controller calls depending on the run time).
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, sample_time=None, **kwargs)
+
+
+@pytest.fixture(autouse=True)
+def deterministic_valve_control(monkeypatch):
+    monkeypatch.setattr(valve_control, 'PID', StepPID)
+
+
+def run(esim, steps=10, step_size=60):
+    for k in range(steps):
+        esim.step_single(k * step_size)
+    return esim
+
+
+def test_history_horizon():
+    esim = run(DHNetwork(history_margin=600), steps=60)
+    horizon = esim.get_history_horizon()
+    t_min = esim.cur_t - horizon
+    for history in esim.store.values():
+        # Only the newest row before the horizon is kept
+        assert history.time[0] <= t_min < history.time[1]
+
+    dx = esim.net.pipe['length_km'].values * 1000
+    esim.v_mean_min[:] = np.inf
+    assert esim.get_history_horizon() == 600
+    esim.v_mean_min[[0, 3]] = [0.5, 0.1]
+    assert esim.get_history_horizon() == pytest.approx(max(dx[0] / 0.5, dx[3] / 0.1) + 600)
+
+
+def test_default_construction():
+    esim = DHNetwork()
+    assert esim.topology is not None
+    run(esim, steps=2)
+    assert np.isfinite(esim.T_supply_cons1)
+
+
+OUTPUTS = ['T_return_tank', 'T_evap_in', 'T_return_grid', 'T_supply_cons1', 'T_supply_cons2', 'T_return_cons1',
+           'T_return_cons2', 'mdot_cons1', 'mdot_cons2', 'mdot_bypass', 'mdot_grid', 'mdot_tank_out']
+
+
+def assert_outputs_close(esim, ref, atol):
+    for attr in OUTPUTS:
+        assert getattr(esim, attr) == pytest.approx(getattr(ref, attr), abs=atol, nan_ok=True), attr
+
+
+def test_warm_start_pipeflow():
+    ref = run(DHNetwork())
+    esim = run(DHNetwork(warm_start_pipeflow=True))
+    # The configured initial values are restored after each pipeflow
+    assert np.array_equal(esim.net.junction['pn_bar'].values, ref.net.junction['pn_bar'].values)
+    assert np.array_equal(esim.net.junction['tfluid_k'].values, ref.net.junction['tfluid_k'].values)
+    # Same solution within the pandapipes solver tolerance (tol_p, tol_v)
+    np.testing.assert_allclose(esim.net.res_junction['p_bar'].values, ref.net.res_junction['p_bar'].values,
+                               atol=1e-4, rtol=0)
+    assert_temperatures_close(esim, ref, atol=1e-4)
+    assert_outputs_close(esim, ref, atol=1e-4)
+    stats = esim.get_pipeflow_stats()
+    assert stats['warm_calls'] > stats['cold_calls']
+
+
+def test_hydraulic_cache_keeps_temperatures():
+    esim = run(DHNetwork(hydraulic_cache_size=4), steps=2)
+    state = esim._get_hydraulic_state()
+    assert not any(column.startswith('t_') for res in state['results'].values() for column in res.columns)
+
+    p_bar = esim.net.res_junction['p_bar'].values.copy()
+    esim.net.res_junction['p_bar'] = 0.
+    esim.net.res_junction['t_k'] = 300.
+    esim._set_hydraulic_state(state)
+    assert np.array_equal(esim.net.res_junction['p_bar'].values, p_bar)
+    assert np.all(esim.net.res_junction['t_k'].values == 300.)
+
+
+def test_hydraulic_cache():
+    def run_profile(esim):
+        for k in range(30):
+            esim.T_tank_forward = 70 if k < 15 else 60
+            esim.mdot_cons1_set = 4 if (k // 5) % 2 == 0 else 3
+            esim.step_single(k * 60)
+        return esim
+
+    ref = run_profile(DHNetwork())
+    esim = run_profile(DHNetwork(hydraulic_cache_size=8))
+    assert esim.get_hydraulic_cache_stats()['hits'] > 20
+    # Cached and re-solved valve positions differ within the valve control accuracy
+    assert_outputs_close(esim, ref, atol=1.)
+    assert esim.mdot_cons1 == pytest.approx(ref.mdot_cons1, abs=0.05)
+
+
+def run_tank_profile(esim, steps=30, step_size=60):
+    # Tank supply temperature lowered and consumer setpoint switched during the run
+    for k in range(steps):
+        esim.T_tank_forward = 70 if k < 15 else 60
+        esim.mdot_cons1_set = 4 if (k // 5) % 2 == 0 else 3
+        esim.step_single(k * step_size)
+    return esim
+
+
+def make_tank_network(**kwargs):
+    # Tank feeding in from the start
+    return DHNetwork(mdot_tank_in_set=-2, mdot_tank_out_set=2, mdot_tank_in=-2, mdot_tank_out=2, **kwargs)
+
+
+def assert_temperatures_close(esim, ref, atol=1e-9):
+    for table, columns in [('res_junction', ['t_k']), ('res_pipe', ['t_from_k', 't_to_k']),
+                           ('res_heat_exchanger', ['t_from_k', 't_to_k'])]:
+        np.testing.assert_allclose(esim.net[table][columns].values, ref.net[table][columns].values, atol=atol,
+                                   rtol=0, err_msg=table)
+
+
+def test_vectorized_temp_flow():
+    ref = run_tank_profile(make_tank_network(vectorized_temp_flow=False))
+    esim = run_tank_profile(make_tank_network(vectorized_temp_flow=True))
+    assert_temperatures_close(esim, ref)
+    assert_outputs_close(esim, ref, atol=1e-9)
+
+
+def test_vectorized_temp_flow_topology_file():
+    ref = run(TopologyDHNetwork(topology_file=TOPOLOGY_FILE, vectorized_temp_flow=False))
+    esim = run(TopologyDHNetwork(topology_file=TOPOLOGY_FILE, vectorized_temp_flow=True))
+    assert_temperatures_close(esim, ref)
+
+
+def test_topology_levels_mix_junctions_once():
+    esim = run(DHNetwork(), steps=1)
+    topology = esim.topology
+    pipe_level = np.zeros(len(topology.pipe_in), dtype=int)
+    for g, level in enumerate(topology.levels):
+        pipe_level[level.pipes] = g
+
+    mixed = np.concatenate([level.junctions for level in topology.levels])
+    assert len(mixed) == len(np.unique(mixed))
+    for g, level in enumerate(topology.levels):
+        # All pipes feeding a junction are computed when it is mixed
+        assert np.all(pipe_level[level.mix_pipes] <= g)
+
+
+def test_network_snapshot(tmp_path):
+    ref = run(DHNetwork())
+    DHNetwork(network_cache_dir=str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 1
+    esim = run(DHNetwork(network_cache_dir=str(tmp_path)))
+    assert len(list(tmp_path.iterdir())) == 1
+    assert_outputs_close(esim, ref, atol=1e-9)
+    # Other construction parameters are stored in a new snapshot
+    DHNetwork(network_cache_dir=str(tmp_path), T_supply_grid=70)
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_network_snapshot_key(tmp_path):
+    TopologyDHNetwork(topology_file=TOPOLOGY_FILE, network_cache_dir=str(tmp_path), T_amb=8)
+    esim = TopologyDHNetwork(topology_file=TOPOLOGY_FILE, network_cache_dir=str(tmp_path), T_amb=0)
+    assert len(list(tmp_path.iterdir())) == 2
+    cached = TopologyDHNetwork(topology_file=TOPOLOGY_FILE, network_cache_dir=str(tmp_path), T_amb=0)
+    assert len(list(tmp_path.iterdir())) == 2
+    assert np.array_equal(cached.net.pipe['text_k'].values, esim.net.pipe['text_k'].values)
+    assert np.any(esim.net.pipe['text_k'].values == 273.15)
+
+
+def test_topology_simulator_inputs():
+    from simulators.dh_network.topology_wrapper import DHTopologySimulator
+
+    sim = DHTopologySimulator()
+    sim.init('DHTopologySim', time_resolution=1, step_size=60)
+    entity = sim.create(1, 'DHTopologyNetwork', topology_file=TOPOLOGY_FILE)[0]
+    esim = sim.simulators[entity['eid']]
+    consumer = next(child['eid'] for child in entity['children'] if child['type'] == 'DHConsumer')
+    feed_in = next(child['eid'] for child in entity['children'] if child['type'] == 'DHFeedIn')
+
+    # Heat and mass flows of several connections are summed
+    sim.step(0, {consumer: {'Qdot': {'hp_0': 20., 'hp_1': 30.}}}, 60)
+    assert esim.Qdot_cons[0] == 50.
+
+    with pytest.raises(RuntimeError):
+        sim.step(60, {feed_in: {'T_supply': {'hp_0': 70., 'hp_1': 75.}}}, 120)
+
+
+def test_topology_without_valves(tmp_path):
+    # pandapipes creates the valve table with the first valve
+    topology = {
+        'junctions': [{'name': name} for name in ['n1s', 'n2s', 'n1r', 'n2r']],
+        'pipes': [{'name': 'l1s', 'from_junction': 'n1s', 'to_junction': 'n2s', 'length_km': 0.5},
+                  {'name': 'l1r', 'from_junction': 'n2r', 'to_junction': 'n1r', 'length_km': 0.5}],
+        'consumers': [{'name': 'cons1', 'supply_junction': 'n2s', 'return_junction': 'n2r', 'Qdot_kw': 500,
+                       'mdot_set': 4}],
+        'feed_ins': [{'name': 'grid', 'supply_junction': 'n1s', 'return_junction': 'n1r'}],
+    }
+    topology_file = tmp_path / 'topology.json'
+    topology_file.write_text(json.dumps(topology))
+    esim = run(TopologyDHNetwork(topology_file=str(topology_file)), steps=2)
+    assert esim.valve == ['cons1_v']
+    assert np.all(np.isfinite(esim.T_supply_cons))
+
+
+@pytest.mark.parametrize('layout', ['radial', 'ring'])
+def test_generated_network(layout):
+    from simulators.dh_network.network_generator import generate_network
+
+    ref = run(generate_network(6, layout, vectorized_temp_flow=False), steps=3)
+    esim = run(generate_network(6, layout, vectorized_temp_flow=True), steps=3)
+    assert np.all(np.isfinite(esim.T_supply_cons))
+    assert_temperatures_close(esim, ref)
+
+
+# Valve controller tolerances [kg/s] of the default network
+MDOT_TOL = {'cons1': 0.1, 'cons2': 0.1, 'bypass': 0.25, 'grid': 0.25}
+
+
+def run_setpoint_profile(esim, steps=30, step_size=60):
+    # Consumer setpoint and heat demand steps, each step has to meet the setpoints within the controller tolerance
+    # (plus the rounding of the mass flow outputs)
+    for k in range(steps):
+        esim.mdot_cons1_set = 4 if (k // 5) % 2 == 0 else 3
+        esim.Qdot_cons2 = 500 if k < 15 else 400
+        esim.step_single(k * step_size)
+        for name, tol in MDOT_TOL.items():
+            assert getattr(esim, 'mdot_' + name) == pytest.approx(getattr(esim, 'mdot_%s_set' % name), abs=tol + 0.01)
+    return esim
+
+
+def test_newton_valve_control():
+    ref = run_setpoint_profile(DHNetwork())
+    esim = run_setpoint_profile(DHNetwork(valve_control_mode='newton'))
+    assert esim.get_pipeflow_stats()['cold_calls'] < ref.get_pipeflow_stats()['cold_calls']
+    assert esim.T_supply_cons1 == pytest.approx(ref.T_supply_cons1, abs=0.1)
+    assert esim.T_supply_cons2 == pytest.approx(ref.T_supply_cons2, abs=0.1)
+
+
+def test_secant_valve_control():
+    ref = run_setpoint_profile(DHNetwork())
+    esim = run_setpoint_profile(DHNetwork(valve_control_mode='secant'))
+    assert esim.valve_control_stats['not_converged'] == 0
+    assert esim.valve_control_stats['iterations'] < ref.valve_control_stats['iterations']
+    assert esim.T_supply_cons1 == pytest.approx(ref.T_supply_cons1, abs=0.1)
+    assert esim.T_supply_cons2 == pytest.approx(ref.T_supply_cons2, abs=0.1)
+
+
+@pytest.mark.parametrize('mode', ['pid', 'secant'])
+def test_valve_controller_group(mode):
+    # The vectorized group controller takes the same steps as the single valve controllers
+    ref = run_setpoint_profile(DHNetwork(valve_control_mode=mode))
+    esim = run_setpoint_profile(DHNetwork(valve_control_mode=mode, valve_controller='group'))
+    assert esim.valve_control_stats == ref.valve_control_stats
+    assert_outputs_close(esim, ref, atol=1e-9)
+
+
+def test_valve_controller_group_step():
+    esim = run(DHNetwork(), steps=1)
+    net = copy.deepcopy(esim.net)
+    valves = [esim.valve.index('grid_v1'), esim.valve.index('tank_v1')]
+    net.valve.loc[valves, 'opened'] = True
+    net.res_valve.loc[valves, 'mdot_from_kg_per_s'] = [5., 0.]
+    group = valve_control.CtrlValveGroup(net, valves, mdot_set_kg_per_s=[7.5, 0.], tol=0.25)
+
+    # Like CtrlValve, a valve with zero setpoint is only closed if not yet within its tolerance
+    group.time_step(net, 0)
+    assert not group.is_converged(net)
+    group.control_step(net)
+    assert np.all(net.valve.loc[valves, 'opened'])
+    net.res_valve.loc[valves, 'mdot_from_kg_per_s'] = [5., 1.]
+    group.is_converged(net)
+    group.control_step(net)
+    assert list(net.valve.loc[valves, 'opened']) == [True, False]
+
+
+def test_valve_controller_group_profile():
+    esim = run(DHNetwork(), steps=1)
+    valves = [esim.valve.index('grid_v1'), esim.valve.index('tank_v1')]
+    group = valve_control.CtrlValveGroup(esim.net, valves, profile_name=[None, 'tank'], mdot_set_kg_per_s=[1., 2.])
+    # Setpoints of valves with a profile are not overwritten
+    group.set_mdot_setpoint(3., 0)
+    group.set_mdot_setpoint(4., 1)
+    assert list(group.mdot_set_kg_per_s) == [3., 2.]
+
+
+def test_decoupled_solve():
+    ref = run_setpoint_profile(DHNetwork())
+    esim = run_setpoint_profile(DHNetwork(decoupled_solve=True))
+    stats = esim.get_pipeflow_stats()
+    assert stats['hydraulic_skips'] > stats['hydraulic_runs']
+    assert_temperatures_close(esim, ref)
+    assert_outputs_close(esim, ref, atol=1e-9)
+
+
+@pytest.mark.parametrize('sections', [1, 4, -1])
+def test_temp_flow_sections(sections):
+    # In steady state, the sectioned pipes reach the temperatures of the lumped pipes (up to the heat loss
+    # discretization)
+    ref = run(DHNetwork(), steps=40)
+    esim = run(DHNetwork(temp_flow_sections=sections), steps=40)
+    assert_temperatures_close(esim, ref, atol=0.02)
+    assert_outputs_close(esim, ref, atol=0.02)
+
+
+def run_mosaik_simulator(workers, steps=5, step_size=60):
+    from simulators.dh_network.mosaik_wrapper import DHNetworkSimulator
+
+    sim = DHNetworkSimulator()
+    sim.init('DHSim', time_resolution=1, step_size=step_size, workers=workers)
+    eids = [entity['eid'] for entity in sim.create(2, 'DHNetwork')]
+    outputs = {eid: ['T_supply_cons1', 'T_return_cons1', 'T_return_grid', 'mdot_cons1', 'mdot_grid'] for eid in eids}
+    data = []
+    try:
+        for k in range(1, steps + 1):
+            # Different heat demands per entity
+            inputs = {eid: {'Qdot_cons1': {'load': 500. - 100 * i - 20 * k}} for i, eid in enumerate(eids)}
+            sim.step(k * step_size, inputs, None)
+            data.append(sim.get_data(outputs))
+    finally:
+        sim.finalize()
+    return data
+
+
+def test_entity_pool():
+    ref = run_mosaik_simulator(workers=0)
+    data = run_mosaik_simulator(workers=2)
+    assert len(data) == len(ref)
+    for step, step_ref in zip(data, ref):
+        for eid, values in step_ref.items():
+            assert step[eid] == pytest.approx(values, nan_ok=True, abs=0)
+
+
+def test_static_worker():
+    frames = []
+    for static_worker in [False, True]:
+        esim = run(DHNetwork(compare_to_static_results=True, static_worker=static_worker, log_full_history=True))
+        frames.append(esim.get_output_frame('static'))
+        esim.close()
+    ref, frame = frames
+    assert frame.index.equals(ref.index)
+    # Same values (and NaN pattern) as the static pipeflow in the simulation process
+    np.testing.assert_allclose(frame.values, ref.values, rtol=0, atol=1e-6)
+    assert np.isfinite(frame.values).sum() > 0
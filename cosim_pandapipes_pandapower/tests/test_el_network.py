@@ -0,0 +1,155 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by LGPL-2.1.
+
+import copy
+import os
+
+import numpy as np
+import pytest
+
+pp = pytest.importorskip('pandapower')
+
+from simulators.el_network.simulator import FAILED_ATTRS, RESULT_ATTRS, Pandapower
+
+GRID_FILE = os.path.join(os.path.dirname(__file__), os.pardir, 'resources', 'power', 'power_grid_model.json')
+
+
+def make_simulator():
+    sim = Pandapower()
+    sim.net = pp.from_json(GRID_FILE)
+    return sim
+
+
+def load_walk(net, steps, seed=0, jumps=()):
+    '''
+    Yields the load active powers of a random walk (1 % per step) with 10 % load steps at the given steps.
+    '''
+    rng = np.random.default_rng(seed)
+    p = net.load['p_mw'].values.copy()
+    for k in range(steps):
+        p = p * (1.1 if k in jumps else 1 + 0.01 * rng.standard_normal(len(p)))
+        yield k, p
+
+
+def test_linear_voltage_estimate():
+    sim = make_simulator()
+    ref = copy.deepcopy(sim.net)
+    for k, p in load_walk(sim.net, 40, jumps=(20,)):
+        sim.net.load['p_mw'] = p
+        ref.load['p_mw'] = p
+        full = sim.linear_stats['full']
+        sim.powerflow_linear(max_change=0.05, max_error=1e-3)
+        pp.runpp(ref)
+        assert np.max(np.abs(sim.net.res_bus['vm_pu'].values - ref.res_bus['vm_pu'].values)) < 1e-3
+        if sim.linear_stats['full'] == full:
+            # Estimated step: branch results are not available
+            assert sim.net.res_line['loading_percent'].isna().all()
+        else:
+            assert np.allclose(sim.net.res_line['loading_percent'].values, ref.res_line['loading_percent'].values)
+        if k < 2 or k == 20:
+            # First two power flows calibrate the error estimate, the 10 % load step exceeds max_change
+            assert sim.linear_stats['full'] == full + 1
+    assert sim.linear_stats['estimated'] > sim.linear_stats['full']
+
+
+def run_walk(sim, ref, powerflow, steps=30):
+    '''
+    Runs the power flow of sim and pp.runpp (tight tolerance) on ref for a load walk with unchanged loads in every
+    third step and the sgens switched off at step 20, yields the step.
+    '''
+    for k, p in load_walk(sim.net, steps, jumps=(10,)):
+        if k % 3 == 2:
+            p = sim.net.load['p_mw'].values
+        sim.net.load['p_mw'] = p
+        ref.load['p_mw'] = p
+        if k == 20:
+            sim.net.sgen['in_service'] = False
+            ref.sgen['in_service'] = False
+        powerflow()
+        pp.runpp(ref, tolerance_mva=1e-12)
+        yield k
+
+
+def assert_results_close(net, ref, atol=1e-8):
+    # Voltages [pu] and powers [MW] within atol, line loadings [%] within 100 atol
+    assert np.allclose(net.res_bus['vm_pu'].values, ref.res_bus['vm_pu'].values, rtol=0, atol=atol)
+    assert np.allclose(net.res_bus['p_mw'].values, ref.res_bus['p_mw'].values, rtol=0, atol=atol)
+    assert np.allclose(net.res_ext_grid['p_mw'].values, ref.res_ext_grid['p_mw'].values, rtol=0, atol=atol)
+    assert np.allclose(net.res_line['loading_percent'].values, ref.res_line['loading_percent'].values, rtol=0,
+                       atol=100 * atol)
+
+
+def test_radial_sweep():
+    sim = make_simulator()
+    ref = copy.deepcopy(sim.net)
+    for _ in run_walk(sim, ref, sim.powerflow_sweep):
+        assert_results_close(sim.net, ref)
+    assert sim.sweep_stats == {'sweep': 30, 'fallback': 0}
+
+
+def test_radial_sweep_fallback():
+    # Closing a mesh falls back to pp.runpp
+    sim = make_simulator()
+    line = sim.net.line.iloc[0]
+    buses = sim.net.bus.index.values
+    pp.create_line_from_parameters(sim.net, buses[0], buses[-1], line['length_km'], line['r_ohm_per_km'],
+                                   line['x_ohm_per_km'], line['c_nf_per_km'], line['max_i_ka'])
+    ref = copy.deepcopy(sim.net)
+    sim.powerflow_sweep()
+    pp.runpp(ref)
+    assert sim.sweep_stats == {'sweep': 0, 'fallback': 1}
+    assert np.allclose(sim.net.res_bus['vm_pu'].values, ref.res_bus['vm_pu'].values, rtol=0, atol=1e-10)
+
+
+def test_warm_powerflow():
+    sim = make_simulator()
+    ref = copy.deepcopy(sim.net)
+    for k in run_walk(sim, ref, lambda: sim.powerflow_warm(tolerance_mva=1e-12)):
+        assert_results_close(sim.net, ref)
+    assert sim.pf_stats['skipped'] == 9
+    assert sim.pf_stats['recycled'] > sim.pf_stats['full']
+
+
+def test_warm_powerflow_default_tolerance():
+    # The result of the warm start is within the power mismatch tolerance of pp.runpp
+    sim = make_simulator()
+    ref = copy.deepcopy(sim.net)
+    for _ in run_walk(sim, ref, sim.powerflow_warm):
+        assert_results_close(sim.net, ref, atol=1e-7)
+
+
+def expected_results(net, entity_map):
+    # Results per entity as read by the former per-entity dicts (ext_grid: first row)
+    expected = {}
+    for eid, entity in entity_map.items():
+        table, attrs = RESULT_ATTRS[entity['etype']]
+        row = 0 if entity['etype'] == 'Ext_grid' else entity['idx']
+        for attr in attrs:
+            expected[(eid, attr)] = net[table][attr].values[row]
+    return expected
+
+
+def test_result_cache():
+    sim = Pandapower()
+    sim.load_case(GRID_FILE, 0)
+    requested = None
+    for k, p in load_walk(sim.net, 5):
+        sim.net.load['p_mw'] = p
+        sim.powerflow()
+        cache = sim.get_cache_entries()
+        expected = expected_results(sim.net, sim.entity_map)
+        # Pairs are registered on their first request (half of them in the first step, all in the second)
+        requested = list(expected)[:len(expected) // 2] if requested is None else list(expected)
+        for key in requested:
+            assert cache.get(*key) == expected[key], key
+
+    # Failed power flow: NaN for FAILED_ATTRS, no other results
+    sim.net.res_bus = sim.net.res_bus.iloc[0:0]
+    cache = sim.get_cache_entries()
+    for eid, entity in sim.entity_map.items():
+        for attr in RESULT_ATTRS[entity['etype']][1]:
+            if attr in FAILED_ATTRS.get(entity['etype'], []):
+                assert np.isnan(cache.get(eid, attr))
+            else:
+                with pytest.raises(KeyError):
+                    cache.get(eid, attr)
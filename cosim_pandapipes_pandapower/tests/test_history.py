@@ -0,0 +1,90 @@
+# Copyright (c) 2021 by ERIGrid 2.0. All rights reserved.
+# Use of this source code is governed by a BSD-style license that can be found in the LICENSE file.
+
+import importlib.util
+import os
+
+import numpy as np
+
+# Load the history module directly, the simulators package imports all simulators (pandapipes, pandapower, mosaik)
+_spec = importlib.util.spec_from_file_location('dh_network_history', os.path.join(
+    os.path.dirname(__file__), os.pardir, 'simulators', 'dh_network', 'history.py'))
+history = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(history)
+
+
+def make_buffer(times, capacity=4):
+    buffer = history.HistoryBuffer(['a', 'b'], capacity=capacity)
+    for t in times:
+        buffer.append(t, [t, 2 * t])
+    return buffer
+
+
+def test_append():
+    buffer = make_buffer([0, 60, 120])
+    assert len(buffer) == 3
+    assert np.array_equal(buffer.time, [0, 60, 120])
+    assert np.array_equal(buffer.column('b'), [0, 120, 240])
+    assert buffer.to_dict() == {'a': {0.: 0., 60.: 60., 120.: 120.}, 'b': {0.: 0., 60.: 120., 120.: 240.}}
+
+
+def test_append_same_time():
+    # Same-time loops replace the newest row
+    buffer = make_buffer([0, 60])
+    buffer.append(60, [1, 2])
+    assert len(buffer) == 2
+    assert np.array_equal(buffer.column('a'), [0, 1])
+    assert np.array_equal(buffer.column('b'), [0, 2])
+
+
+def test_append_grow():
+    buffer = make_buffer(range(0, 600, 60))
+    assert buffer.capacity >= 10
+    assert np.array_equal(buffer.time, np.arange(0, 600, 60))
+    assert np.array_equal(buffer.column('b'), 2 * np.arange(0, 600, 60))
+
+
+def test_interp():
+    buffer = make_buffer([0, 60, 120])
+    assert buffer.interp(30, 'b') == 60
+    # Values are held constant outside the stored range
+    assert buffer.interp(-60, 'a') == 0
+    assert buffer.interp(180, 'a') == 120
+
+
+def test_evict_before():
+    buffer = make_buffer([0, 60, 120, 180])
+    buffer.evict_before(90)
+    # The newest row before t is kept for the interpolation at t
+    assert np.array_equal(buffer.time, [60, 120, 180])
+    assert buffer.interp(90, 'a') == 90
+    buffer.evict_before(180)
+    assert np.array_equal(buffer.time, [180])
+    buffer.evict_before(0)
+    assert np.array_equal(buffer.time, [180])
+
+
+def test_evict_before_reuses_memory():
+    buffer = make_buffer([0, 60, 120, 180])
+    buffer.evict_before(120)
+    buffer.append(240, [240, 480])
+    buffer.append(300, [300, 600])
+    # The evicted rows are compacted instead of growing the buffer
+    assert buffer.capacity == 4
+    assert np.array_equal(buffer.time, [120, 180, 240, 300])
+    assert np.array_equal(buffer.column('b'), [240, 360, 480, 600])
+
+
+def test_interp_columns():
+    buffer = make_buffer([0, 60, 120])
+    t = np.array([-60, 0, 30, 90, 120, 180])
+    cols = np.array([0, 1, 0, 1, 0, 1])
+    expected = [buffer.interp(tk, buffer.columns[col]) for tk, col in zip(t, cols)]
+    # Times outside the stored range are clamped like in interp
+    np.testing.assert_array_equal(buffer.interp_columns(t, cols), expected)
+    np.testing.assert_array_equal(expected, [0, 0, 30, 180, 120, 240])
+
+
+def test_interp_columns_single_row():
+    buffer = make_buffer([60])
+    np.testing.assert_array_equal(buffer.interp_columns(np.array([0, 120]), np.array([0, 1])), [60, 120])